@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of per segment isotopic image generation: the former pandas based
+implementation vs the vectorized _gen_iso_images
+"""
+import argparse
+from timeit import timeit
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+
+from sm.engine.msm_basic.formula_imager_segm import _segment_arrays, _gen_iso_images
+
+
+def _sp_df_gen(sp_it, sp_indexes):
+    for sp_id, mzs, intensities in sp_it:
+        for mz, ints in zip(mzs, intensities):
+            yield sp_indexes[sp_id], mz, ints
+
+
+def gen_iso_images_pandas(spectra_it, sp_indexes, centr_df, nrows, ncols, ppm, min_px=1):
+    """ Implementation used before vectorization, kept for comparison """
+    if len(centr_df) > 0:
+        sp_df = pd.DataFrame(_sp_df_gen(spectra_it, sp_indexes),
+                             columns=['idx', 'mz', 'ints']).sort_values(by='mz')
+        centr_df = centr_df[(centr_df.mz >= sp_df.mz.min() - 1) &
+                            (centr_df.mz <= sp_df.mz.max() + 1)]
+        lower = centr_df.mz.map(lambda mz: mz - mz * ppm * 1e-6)
+        upper = centr_df.mz.map(lambda mz: mz + mz * ppm * 1e-6)
+        lower_idx = np.searchsorted(sp_df.mz, lower, 'left')
+        upper_idx = np.searchsorted(sp_df.mz, upper, 'right')
+
+        for i, (l, u) in enumerate(zip(lower_idx, upper_idx)):
+            if u - l >= min_px:
+                data = sp_df.ints[l:u].values
+                if data.shape[0] > 0:
+                    idx = sp_df.idx[l:u].values
+                    m = coo_matrix((data, (idx // ncols, idx % ncols)), shape=(nrows, ncols))
+                    yield centr_df.index[i], (centr_df.peak_i.iloc[i], m)
+
+
+def generate_segment(nrows, ncols, peaks_per_sp, centr_n, mz_range=(300., 310.)):
+    rs = np.random.RandomState(0)
+    spectra = [(sp_id, np.sort(rs.uniform(*mz_range, peaks_per_sp)), rs.uniform(1, 100, peaks_per_sp))
+               for sp_id in range(nrows * ncols)]
+    centr_df = pd.DataFrame({'mz': np.sort(rs.uniform(*mz_range, centr_n)),
+                             'peak_i': rs.randint(0, 4, centr_n)},
+                            index=pd.Index(np.arange(centr_n) // 4, name='ion_i'))
+    return spectra, centr_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark isotopic image generation for one m/z segment')
+    parser.add_argument('--rows', type=int, default=100, help='Image rows')
+    parser.add_argument('--cols', type=int, default=100, help='Image columns')
+    parser.add_argument('--peaks', type=int, default=100, help='Segment peaks per spectrum')
+    parser.add_argument('--centroids', type=int, default=2000, help='Centroids in the segment')
+    parser.add_argument('--ppm', type=float, default=3.)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    spectra, centr_df = generate_segment(args.rows, args.cols, args.peaks, args.centroids)
+    sp_indexes = np.arange(len(spectra))
+
+    def run_pandas():
+        return list(gen_iso_images_pandas(spectra, sp_indexes, centr_df, args.rows, args.cols, args.ppm))
+
+    def run_vectorized():
+        segm_arrays = _segment_arrays(spectra, sp_indexes)
+        return list(_gen_iso_images(segm_arrays, centr_df, args.rows, args.cols, args.ppm))
+
+    assert len(run_pandas()) == len(run_vectorized())
+    pandas_time = timeit(run_pandas, number=args.repeat) / args.repeat
+    vectorized_time = timeit(run_vectorized, number=args.repeat) / args.repeat
+    print('Segment with {} peaks and {} centroids'.format(len(spectra) * args.peaks, args.centroids))
+    print('pandas:     {:.3f} s'.format(pandas_time))
+    print('vectorized: {:.3f} s'.format(vectorized_time))
+    print('speedup:    {:.1f}x'.format(pandas_time / vectorized_time))
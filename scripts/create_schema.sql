@@ -47,6 +47,7 @@ CREATE TABLE job (
 	status	text,
 	start   timestamp,
 	finish  timestamp,
+	plan    json,
 	CONSTRAINT job_id_pk PRIMARY KEY(id),
 	CONSTRAINT job_ds_id_fk FOREIGN KEY (ds_id)
       REFERENCES dataset (id) MATCH SIMPLE
@@ -0,0 +1,2 @@
+-- Search execution plan of a job, written by the engine since the search planner was added
+ALTER TABLE job ADD COLUMN IF NOT EXISTS plan json;
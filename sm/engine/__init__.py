@@ -6,6 +6,7 @@ from .queue import QueuePublisher, QueueConsumerAsync
 from .db import DB
 from .mol_db import MolecularDB
 from .ms_txt_converter import MsTxtConverter
+from .ms_npy_converter import MsNpyConverter
 from .util import SMConfig
 
 try:
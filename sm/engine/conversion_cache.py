@@ -0,0 +1,187 @@
+"""
+
+:synopsis: Content-addressed cache of converted datasets shared between dataset (re)submissions
+
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from hashlib import blake2b
+from os import listdir, walk, makedirs, stat, replace, getpid
+from os.path import join, exists, getsize, getmtime, isdir, realpath
+from time import time
+import fcntl
+import json
+import logging
+
+from sm.engine.util import SMConfig, split_s3_path
+from sm.engine.work_dir import WorkDirManager, delete_local_path, delete_s3_path
+
+logger = logging.getLogger('engine')
+
+CACHE_DIR = 'conversion_cache'
+LAST_USED_MARKER = '.last_used'
+LOCK_SUFFIX = '.lock'
+HASH_BLOCK_SIZE = 2**24
+FILE_HASHES = '.file_hashes.json'
+IN_USE_GRACE_PERIOD_H = 24
+
+
+class ConversionCache(object):
+    """ Cache of converted spectra and coordinates keyed by a content hash of the input mass spec files.
+    Entries are stored in the same layout as dataset work directories, locally and on S3 if it is configured.
+    The least recently used entries are evicted when the total cache size exceeds the limits,
+    entries used within the grace period are never evicted as a running job may be reading them.
+
+    Args
+    ----
+    s3 : boto3.resources.factory.s3.ServiceResource
+    """
+    def __init__(self, s3):
+        self._sm_config = SMConfig.get_conf()
+        self._s3 = s3
+        cache_config = self._sm_config['fs']['conversion_cache']
+        self._local_max_size = cache_config.get('local_max_size_gb', 0) * 2**30
+        self._s3_max_size = cache_config.get('s3_max_size_gb', 0) * 2**30
+        self._in_use_grace_period = cache_config.get('in_use_grace_period_h', IN_USE_GRACE_PERIOD_H) * 3600
+
+        self._local_path = join(self._sm_config['fs']['base_path'], CACHE_DIR)
+        s3_base_path = self._sm_config['fs'].get('s3_base_path', None)
+        self._s3_path = join(s3_base_path, CACHE_DIR) if s3_base_path else None
+
+    @staticmethod
+    def enabled():
+        return 'conversion_cache' in SMConfig.get_conf()['fs']
+
+    @staticmethod
+    def _ms_file_exts():
+        return {ext for h in SMConfig.get_conf()['ms_file_handlers'] for ext in h['extensions']}
+
+    def _file_hashes_path(self):
+        return join(self._local_path, FILE_HASHES)
+
+    def _load_file_hashes(self):
+        try:
+            with open(self._file_hashes_path()) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_file_hashes(self, file_hashes):
+        makedirs(self._local_path, exist_ok=True)
+        tmp_path = '{}.{}'.format(self._file_hashes_path(), getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(file_hashes, f)
+        replace(tmp_path, self._file_hashes_path())
+
+    @staticmethod
+    def _file_hash(path):
+        h = blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def key(self, input_path):
+        """ Content hash of the mass spec files in the input directory.
+        S3 object ETags are used for S3 inputs so that nothing has to be downloaded.
+        Hashes of local files are memoized by (path, size, mtime), the same way ETags are used for S3 objects
+        """
+        ms_file_exts = self._ms_file_exts()
+        h = blake2b(digest_size=16)
+        if input_path.startswith('s3a://'):
+            bucket_name, prefix = split_s3_path(input_path)
+            objs = [obj for obj in self._s3.Bucket(bucket_name).objects.filter(Prefix=prefix)
+                    if obj.key.lower().split('.')[-1] in ms_file_exts]
+            for obj in sorted(objs, key=lambda obj: obj.key.lower().split('.')[-1]):
+                h.update('{}:{}:{}'.format(obj.key.lower().split('.')[-1], obj.size, obj.e_tag).encode())
+        else:
+            file_hashes = self._load_file_hashes()
+            updated = False
+            fns = [fn for fn in listdir(input_path) if fn.lower().split('.')[-1] in ms_file_exts]
+            for fn in sorted(fns, key=lambda fn: fn.lower().split('.')[-1]):
+                path = realpath(join(input_path, fn))
+                st = stat(path)
+                file_hash = file_hashes.get(path, None)
+                if file_hash is None or file_hash[:2] != [st.st_size, st.st_mtime_ns]:
+                    file_hash = [st.st_size, st.st_mtime_ns, self._file_hash(path)]
+                    file_hashes[path] = file_hash
+                    updated = True
+                h.update('{}:{}'.format(fn.lower().split('.')[-1], file_hash[2]).encode())
+            if updated:
+                self._save_file_hashes(file_hashes)
+        return h.hexdigest()
+
+    def entry(self, key):
+        """ Work directory manager of the cache entry """
+        return WorkDirManager(join(CACHE_DIR, key))
+
+    @contextmanager
+    def lock(self, key):
+        """ Exclusive lock of the entry for jobs running on this host, held while converting into it.
+        Jobs on other hosts are not excluded, entries are only read once their success marker is written
+        """
+        makedirs(self._local_path, exist_ok=True)
+        with open(join(self._local_path, key + LOCK_SUFFIX), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def touch(self, key):
+        """ Mark the entry as recently used """
+        entry_path = join(self._local_path, key)
+        makedirs(entry_path, exist_ok=True)
+        open(join(entry_path, LAST_USED_MARKER), 'w').close()
+        if self._s3_path:
+            bucket, path = split_s3_path(self._s3_path)
+            self._s3.Object(bucket, join(path, key, LAST_USED_MARKER)).put(Body=b'')
+
+    def _local_entries(self):
+        """ Returns list of (last used timestamp, key, size) tuples """
+        entries = []
+        if exists(self._local_path):
+            for key in filter(lambda k: isdir(join(self._local_path, k)), listdir(self._local_path)):
+                entry_path = join(self._local_path, key)
+                marker_path = join(entry_path, LAST_USED_MARKER)
+                last_used = getmtime(marker_path if exists(marker_path) else entry_path)
+                size = sum(getsize(join(d, fn)) for d, _, fns in walk(entry_path) for fn in fns)
+                entries.append((last_used, key, size))
+        return entries
+
+    def _s3_entries(self):
+        bucket, path = split_s3_path(self._s3_path)
+        sizes, last_modified, last_used = defaultdict(int), {}, {}
+        for obj in self._s3.Bucket(bucket).objects.filter(Prefix=path + '/'):
+            key = obj.key[len(path) + 1:].split('/', 1)[0]
+            sizes[key] += obj.size
+            last_modified[key] = max(last_modified.get(key, obj.last_modified), obj.last_modified)
+            if obj.key.endswith('/' + LAST_USED_MARKER):
+                last_used[key] = obj.last_modified
+        return [(last_used.get(key, last_modified[key]).timestamp(), key, size) for key, size in sizes.items()]
+
+    def _evict_lru(self, entries, max_size, keep_key, delete):
+        in_use_since = time() - self._in_use_grace_period
+        total_size = sum(size for _, _, size in entries)
+        for last_used, key, size in sorted(entries):
+            if total_size <= max_size:
+                break
+            if key != keep_key and last_used < in_use_since:
+                logger.info('Evicting conversion cache entry %s (%.1f MB)', key, size / 2**20)
+                delete(key)
+                total_size -= size
+
+    def evict(self, keep_key=None):
+        """ Delete least recently used entries until the cache fits into the configured size limits
+
+        Args
+        ----
+        keep_key : str
+            Key of the entry in use that must not be deleted
+        """
+        self._evict_lru(self._local_entries(), self._local_max_size, keep_key,
+                        lambda key: delete_local_path(join(self._local_path, key)))
+        if self._s3_path:
+            bucket, path = split_s3_path(self._s3_path)
+            self._evict_lru(self._s3_entries(), self._s3_max_size, keep_key,
+                            lambda key: delete_s3_path(bucket, join(path, key) + '/', self._s3))
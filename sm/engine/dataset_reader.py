@@ -1,8 +1,17 @@
 import json
+from importlib import import_module
+from os import makedirs, listdir, replace
+from os.path import join, exists
+from uuid import uuid4
 import numpy as np
 import logging
 
 from sm.engine.ms_txt_converter import MsTxtConverter
+from sm.engine.ms_npy_converter import MsNpyConverter, decode_spectra_chunk, SUCCESS_MARKER
+from sm.engine.ibd_reader import IbdOffsets, find_ibd_path, read_ibd_spectra
+from sm.engine.work_dir import find_ms_file, LocalWorkDir, delete_local_path
+from sm.engine.conversion_cache import ConversionCache
+from sm.engine.spectra_stats import SpectraStats
 from sm.engine.util import SMConfig, read_json
 from sm.engine.db import DB
 from sm.engine.es_export import ESExporter
@@ -14,21 +23,43 @@ logger = logging.getLogger('engine')
 class DatasetReader(object):
     """ Class for reading dataset coordinates and spectra
 
+    Spectra are read from the work directory after conversion into the configured 'spectra_format'
+    ('txt' or 'npy'). With the 'imzml' format the conversion is skipped and Spark tasks read spectra
+    straight from the input .ibd file, so the input path has to be accessible from all Spark executors.
+    Without a Spark context everything is read from the local file system and spectra are
+    available through iter_spectra only.
+
     Args
     ----------
     input_path : str
         Input path with mass spec files
-    sc : pyspark.SparkContext
+    sc : pyspark.SparkContext | None
         Spark context object
+    wd_manager : sm.engine.work_dir.WorkDirManager
     """
     def __init__(self, input_path, sc, wd_manager):
         self.input_path = input_path
 
         self._wd_manager = wd_manager
+        # work dir with converted spectra, either the dataset one or a conversion cache entry
+        self._spectra_wd = wd_manager
         self._sc = sc
+        self._spectra_format = SMConfig.get_conf()['fs'].get('spectra_format', 'txt')
+        self._conversion_processes = SMConfig.get_conf()['fs'].get('conversion_processes', 1)
+        self._ibd_path = None
+        self._ibd_offsets = None
+        self._ms_file_path = None
+        self._spectra_stats = None
+        # minimal number of spectra RDD partitions, usually set from the search plan
+        self.spectra_partitions = 16
 
         self.coord_pairs = None
 
+    @property
+    def spectra_wd(self):
+        """ Work directory manager holding the converted spectra and files derived from them """
+        return self._spectra_wd
+
     @staticmethod
     def _parse_coord_row(s):
         res = []
@@ -44,11 +75,19 @@ class DatasetReader(object):
         return len(fields) == 2
 
     def _determine_pixel_order(self):
-        coord_path = self._wd_manager.coord_path
+        if self._sc is None:
+            if not self._spectra_wd.local_fs_only:
+                self._spectra_wd.download_from_remote(spectra=False)
+            with open(self._spectra_wd.local_dir.coord_path) as f:
+                coord_pairs = list(filter(self._is_valid_coord_row, map(self._parse_coord_row, f)))
+        else:
+            coord_pairs = (self._sc.textFile(self._spectra_wd.coord_path)
+                           .map(self._parse_coord_row)
+                           .filter(self._is_valid_coord_row).collect())
+        self._set_pixel_order(coord_pairs)
 
-        self.coord_pairs = (self._sc.textFile(coord_path)
-                            .map(self._parse_coord_row)
-                            .filter(self._is_valid_coord_row).collect())
+    def _set_pixel_order(self, coord_pairs):
+        self.coord_pairs = coord_pairs
         self.min_x, self.min_y = np.amin(np.asarray(self.coord_pairs), axis=0)
         self.max_x, self.max_y = np.amax(np.asarray(self.coord_pairs), axis=0)
 
@@ -95,24 +134,184 @@ class DatasetReader(object):
     def get_2d_sample_area_mask(self):
         return self.get_sample_area_mask().reshape(self.get_dims())
 
+    def _spectra_exist(self):
+        if self._spectra_format == 'npy':
+            return self._spectra_wd.exists(join(self._spectra_wd.npy_path, SUCCESS_MARKER))
+        else:
+            return self._spectra_wd.exists(self._spectra_wd.success_path)
+
+    def set_spark_context(self, sc):
+        """ Read spectra with Spark. The reader is created without Spark context
+        as the search engine is chosen after conversion, from the dataset size
+        """
+        self._sc = sc
+
+    def download_spectra(self):
+        """ Make sure converted spectra are in the local directory, for reading them without Spark """
+        if self._spectra_format != 'imzml' and not self._spectra_wd.local_fs_only:
+            self._spectra_wd.download_from_remote()
+
+    def _create_ms_converter(self, out_dir):
+        ms_file_path = self._wd_manager.local_dir.ms_file_path
+        if self._spectra_format == 'npy':
+            return MsNpyConverter(ms_file_path, out_dir.npy_path, out_dir.coord_path)
+        else:
+            return MsTxtConverter(ms_file_path, out_dir.txt_path, out_dir.coord_path)
+
+    @property
+    def ms_file_path(self):
+        """ Local path to the mass spec file the dataset was read from """
+        if not self._ms_file_path:
+            if not self._wd_manager.local_dir.ms_file_path:
+                # spectra came from the conversion cache, only the main mass spec file is needed
+                main_exts = [h['extensions'][0] for h in SMConfig.get_conf()['ms_file_handlers']]
+                self._wd_manager.copy_input_data(self.input_path, file_exts=main_exts)
+            self._ms_file_path = self._wd_manager.local_dir.ms_file_path
+        return self._ms_file_path
+
+    def _direct_read_possible(self):
+        if self.input_path.startswith('s3a://'):
+            logger.warning('Direct imzML reading is not possible for S3 input %s, converting instead',
+                           self.input_path)
+            return False
+        ms_file_path = find_ms_file(self.input_path)
+        if not (ms_file_path.lower().endswith('.imzml') and find_ibd_path(ms_file_path)):
+            logger.warning('No imzML/ibd file pair in %s, converting instead', self.input_path)
+            return False
+        return True
+
+    def _read_ibd_offsets(self):
+        self._ms_file_path = find_ms_file(self.input_path)
+        self._ibd_path = find_ibd_path(self._ms_file_path)
+        logger.info('Reading spectra offsets from %s', self._ms_file_path)
+
+        parser_factory_conf = SMConfig.get_ms_file_handler(self._ms_file_path)['parser_factory']
+        parser_factory = getattr(import_module(parser_factory_conf['path']), parser_factory_conf['name'])
+        parser = parser_factory(self._ms_file_path)
+        coordinates = [coo[:2] for coo in parser.coordinates]
+        MsTxtConverter._check_coord_duplicates(coordinates)
+
+        self._ibd_offsets = IbdOffsets(parser)
+        self._set_pixel_order([list(coo) for coo in coordinates])
+
     def copy_convert_input_data(self):
-        if not self._wd_manager.exists(self._wd_manager.txt_path):
-            self._wd_manager.copy_input_data(self.input_path)
-            ms_converter = MsTxtConverter(self._wd_manager.local_dir.ms_file_path,
-                                          self._wd_manager.local_dir.txt_path,
-                                          self._wd_manager.local_dir.coord_path)
-            ms_converter.convert()
+        if self._spectra_format == 'imzml':
+            if self._direct_read_possible():
+                self._read_ibd_offsets()
+                return
+            self._spectra_format = 'npy'
+
+        cache, cache_key = None, None
+        if ConversionCache.enabled():
+            cache = ConversionCache(self._wd_manager.s3)
+            cache_key = cache.key(self.input_path)
+            logger.info('Conversion cache key of %s: %s', self.input_path, cache_key)
+            self._spectra_wd = cache.entry(cache_key)
+            cache.touch(cache_key)
+
+        if not self._spectra_exist():
+            if cache:
+                with cache.lock(cache_key):
+                    # a concurrent job may have converted the same input while this one was waiting
+                    if not self._spectra_exist():
+                        self._convert_input_data()
+            else:
+                self._convert_input_data()
 
-            if not self._wd_manager.local_fs_only:
-                self._wd_manager.upload_to_remote()
+        if cache:
+            cache.evict(keep_key=cache_key)
 
         self._determine_pixel_order()
 
+    def _convert_input_data(self):
+        """ Convert into a temporary directory and move the results into the spectra work directory,
+        the success marker is written last so that an interrupted conversion is never read
+        """
+        self._wd_manager.copy_input_data(self.input_path)
+        out_dir = self._spectra_wd.local_dir
+        tmp_dir = LocalWorkDir(out_dir.ds_path, '.converting_{}'.format(uuid4().hex))
+        makedirs(tmp_dir.ds_path)
+        try:
+            ms_converter = self._create_ms_converter(tmp_dir)
+            ms_converter.convert(processes=self._conversion_processes)
+            self._spectra_stats = ms_converter.stats
+            self._spectra_stats.save(tmp_dir.stats_path)
+
+            for path_attr in ['coord_path', 'stats_path', 'txt_path', 'npy_path']:
+                tmp_path, path = getattr(tmp_dir, path_attr), getattr(out_dir, path_attr)
+                if exists(tmp_path):
+                    if exists(path):
+                        delete_local_path(path)
+                    replace(tmp_path, path)
+            open(out_dir.success_path, 'w').close()
+        finally:
+            delete_local_path(tmp_dir.ds_path)
+
+        if not self._spectra_wd.local_fs_only:
+            self._spectra_wd.upload_to_remote()
+
+    def _load_spectra_stats(self):
+        local_stats_path = self._spectra_wd.local_dir.stats_path
+        if not exists(local_stats_path) and not self._spectra_wd.local_fs_only:
+            remote_dir = self._spectra_wd.remote_dir
+            if remote_dir.exists(remote_dir.stats_path):
+                remote_dir.download(remote_dir.stats_path, local_stats_path)
+        if exists(local_stats_path):
+            logger.info('Reading spectra statistics from %s', local_stats_path)
+            return SpectraStats.load(local_stats_path)
+        return None
+
+    def _compute_spectra_stats(self):
+        logger.info('No spectra statistics found, computing them with a pass over the spectra')
+        if self._sc is None:
+            self.download_spectra()
+            stats = SpectraStats().update_all(self.iter_spectra())
+        else:
+            stats = (self.get_spectra()
+                     .mapPartitions(lambda spectra: [SpectraStats().update_all(spectra)])
+                     .reduce(lambda a, b: a.merge(b)))
+
+        local_dir = self._spectra_wd.local_dir
+        makedirs(local_dir.ds_path, exist_ok=True)
+        stats.save(local_dir.stats_path)
+        if self._spectra_format != 'imzml' and not self._spectra_wd.local_fs_only:
+            self._spectra_wd.remote_dir.copy(local_dir.stats_path, self._spectra_wd.remote_dir.stats_path)
+        return stats
+
+    def get_spectra_stats(self):
+        """ Dataset statistics collected during conversion. Loaded from the spectra work directory
+        or computed with one pass over the spectra if they are missing (direct imzML reading, old conversions)
+
+        Returns
+        -------
+        : sm.engine.spectra_stats.SpectraStats
+        """
+        if self._spectra_stats is None:
+            self._spectra_stats = self._load_spectra_stats() or self._compute_spectra_stats()
+        return self._spectra_stats
+
     @staticmethod
     def txt_to_spectrum_non_cum(s):
         arr = s.strip().split(b'|')
         return int(arr[0]), np.fromstring(arr[1], sep=' ').astype('float32'), np.fromstring(arr[2], sep=' ')
 
+    @staticmethod
+    def npy_chunk_to_spectra(item):
+        _, chunk = item
+        return decode_spectra_chunk(chunk)
+
+    def _get_ibd_spectra(self):
+        ibd_path = self._ibd_path
+        mz_dtype, int_dtype = self._ibd_offsets.mz_dtype, self._ibd_offsets.int_dtype
+
+        def read_chunk(chunk):
+            sp_ids, offsets_table = chunk
+            return read_ibd_spectra(ibd_path, sp_ids, offsets_table, mz_dtype, int_dtype)
+
+        chunks = self._ibd_offsets.split(min_chunks_n=self.spectra_partitions)
+        logger.info('Reading spectrum rdd directly from %s in %s chunks', ibd_path, len(chunks))
+        return self._sc.parallelize(chunks, numSlices=len(chunks)).flatMap(read_chunk)
+
     def get_spectra(self):
         """
         Returns
@@ -120,6 +319,38 @@ class DatasetReader(object):
         : pyspark.rdd.RDD
             Spark RDD with spectra. One spectrum as a triple (int, np.ndarray, np.ndarray) per RDD entry.
         """
-        txt_to_spectrum = self.txt_to_spectrum_non_cum
-        logger.info('Converting txt to spectrum rdd from %s', self._wd_manager.txt_path)
-        return self._sc.textFile(self._wd_manager.txt_path, minPartitions=16, use_unicode=False).map(txt_to_spectrum)
+        if self._spectra_format == 'imzml':
+            return self._get_ibd_spectra()
+        elif self._spectra_format == 'npy':
+            logger.info('Reading spectrum rdd from binary chunks in %s', self._spectra_wd.npy_path)
+            return (self._sc.binaryFiles(self._spectra_wd.npy_path, minPartitions=self.spectra_partitions)
+                    .flatMap(self.npy_chunk_to_spectra))
+        else:
+            txt_to_spectrum = self.txt_to_spectrum_non_cum
+            logger.info('Converting txt to spectrum rdd from %s', self._spectra_wd.txt_path)
+            return (self._sc.textFile(self._spectra_wd.txt_path, minPartitions=self.spectra_partitions,
+                                      use_unicode=False)
+                    .map(txt_to_spectrum))
+
+    def iter_spectra(self):
+        """ Read spectra from the local file system without Spark
+
+        Returns
+        -------
+        : iterator
+            Spectra as (int, np.ndarray, np.ndarray) triples
+        """
+        local_dir = self._spectra_wd.local_dir
+        if self._spectra_format == 'imzml':
+            mz_dtype, int_dtype = self._ibd_offsets.mz_dtype, self._ibd_offsets.int_dtype
+            for sp_ids, offsets_table in self._ibd_offsets.split():
+                yield from read_ibd_spectra(self._ibd_path, sp_ids, offsets_table, mz_dtype, int_dtype)
+        elif self._spectra_format == 'npy':
+            for fn in sorted(fn for fn in listdir(local_dir.npy_path) if fn.endswith('.npz')):
+                with open(join(local_dir.npy_path, fn), 'rb') as f:
+                    yield from decode_spectra_chunk(f.read())
+        else:
+            with open(local_dir.txt_path, 'rb') as f:
+                for line in f:
+                    if line.strip():
+                        yield self.txt_to_spectrum_non_cum(line)
@@ -2,49 +2,131 @@ import logging
 import numpy as np
 import pandas as pd
 
+from sm.engine.ion_catalog import IonCatalog
 
 logger = logging.getLogger('engine')
 
+DECOY_SAMPLE_SIZE = 20
 DECOY_ADDUCTS = ['+He', '+Li', '+Be', '+B', '+C', '+N', '+O', '+F', '+Ne', '+Mg', '+Al', '+Si', '+P', '+S', '+Cl', '+Ar', '+Ca', '+Sc', '+Ti', '+V', '+Cr', '+Mn', '+Fe', '+Co', '+Ni', '+Cu', '+Zn', '+Ga', '+Ge', '+As', '+Se', '+Br', '+Kr', '+Rb', '+Sr', '+Y', '+Zr', '+Nb', '+Mo', '+Ru', '+Rh', '+Pd', '+Ag', '+Cd', '+In', '+Sn', '+Sb', '+Te', '+I', '+Xe', '+Cs', '+Ba', '+La', '+Ce', '+Pr', '+Nd', '+Sm', '+Eu', '+Gd', '+Tb', '+Dy', '+Ho', '+Ir', '+Th', '+Pt', '+Os', '+Yb', '+Lu', '+Bi', '+Pb', '+Re', '+Tl', '+Tm', '+U', '+W', '+Au', '+Er', '+Hf', '+Hg', '+Ta']
 
 
 class FDR(object):
 
-    def __init__(self, job_id, decoy_sample_size, target_adducts, db):
+    def __init__(self, job_id, decoy_sample_size, target_adducts, db, catalog=None):
         self.job_id = job_id
         self.decoy_sample_size = decoy_sample_size
         self.db = db
         self.target_adducts = target_adducts
         self.td_df = None
+        self.catalog = catalog
+        self._td_ion_ids = None
         self.fdr_levels = [0.05, 0.1, 0.2, 0.5]
         self.random_seed = 42
 
-    def _decoy_adduct_gen(self, target_ions, decoy_adducts_cand):
-        np.random.seed(self.random_seed)
-        for sf, ta in target_ions:
-            for da in np.random.choice(decoy_adducts_cand, size=self.decoy_sample_size, replace=False):
-                yield (sf, ta, da)
+    def _decoy_adduct_choice(self, target_n, cand_n):
+        """ Indices of decoy_sample_size distinct decoy adduct candidates for each of target_n target ions.
+        Candidates with the smallest random keys are chosen, in the order of their keys
+
+        Returns
+        -------
+        : numpy.ndarray
+            (target_n x decoy_sample_size) matrix of candidate indices
+        """
+        keys = np.random.RandomState(self.random_seed).random_sample((target_n, cand_n))
+        choice = np.argpartition(keys, self.decoy_sample_size - 1, axis=1)[:, :self.decoy_sample_size]
+        choice_order = np.argsort(np.take_along_axis(keys, choice, axis=1), axis=1)
+        return np.take_along_axis(choice, choice_order, axis=1)
 
     def decoy_adducts_selection(self, target_ions):
         decoy_adduct_cand = [add for add in DECOY_ADDUCTS if add not in self.target_adducts]
-        self.td_df = pd.DataFrame(self._decoy_adduct_gen(target_ions, decoy_adduct_cand),
+        if isinstance(target_ions, np.recarray):
+            target_sfs, target_adducts = (target_ions[name].astype(object) for name in target_ions.dtype.names[:2])
+        else:
+            target_sfs = np.array([ion[0] for ion in target_ions], dtype=object)
+            target_adducts = np.array([ion[1] for ion in target_ions], dtype=object)
+
+        if self.catalog is None:
+            self.catalog = IonCatalog(target_sfs, np.concatenate([target_adducts, decoy_adduct_cand]))
+        sf_ids = self.catalog.sf_ids(target_sfs)
+        ta_ids = self.catalog.adduct_ids(target_adducts)
+        da_ids = self.catalog.adduct_ids(decoy_adduct_cand)[
+            self._decoy_adduct_choice(len(target_ions), len(decoy_adduct_cand))]
+
+        # decoys of the same target ion are consecutive rows, estimate_fdr relies on it
+        sf_ids = np.repeat(sf_ids, self.decoy_sample_size)
+        ta_ids = np.repeat(ta_ids, self.decoy_sample_size)
+        da_ids = da_ids.ravel()
+        self._td_ion_ids = np.stack([self.catalog.ion_ids_from_codes(sf_ids, ta_ids),
+                                     self.catalog.ion_ids_from_codes(sf_ids, da_ids)], axis=1)
+        # columns are categoricals over the catalog, strings are only built when a consumer needs them
+        self.td_df = pd.DataFrame({'sf': pd.Categorical.from_codes(sf_ids, categories=self.catalog.sfs),
+                                   'ta': pd.Categorical.from_codes(ta_ids, categories=self.catalog.adducts),
+                                   'da': pd.Categorical.from_codes(da_ids, categories=self.catalog.adducts)},
                                   columns=['sf', 'ta', 'da'])
 
+    def _target_decoy_ion_ids(self):
+        """ (target ion id, decoy ion id) matrix of the td_df rows """
+        if self._td_ion_ids is None:
+            if self.catalog is None:
+                self.catalog = IonCatalog(self.td_df.sf, np.concatenate([self.td_df.ta, self.td_df.da]))
+            self._td_ion_ids = np.stack([self.catalog.ion_ids(self.td_df.sf, self.td_df.ta),
+                                         self.catalog.ion_ids(self.td_df.sf, self.td_df.da)], axis=1)
+        return self._td_ion_ids
+
+    def ion_ids(self):
+        """ Sorted ids of all ions needed for FDR calculation
+
+        Returns
+        -------
+        : numpy.ndarray
+        """
+        td_ion_ids = self._target_decoy_ion_ids()
+        ion_mask = np.zeros(len(self.catalog.sfs) * self.catalog.adduct_n, dtype=bool)
+        ion_mask[td_ion_ids.ravel()] = True
+        return np.flatnonzero(ion_mask)
+
+    def ion_index(self):
+        """ All ions needed for FDR calculation
+
+        Returns
+        -------
+        : pandas.MultiIndex
+            lexsorted (sf, adduct) index
+        """
+        ion_ids = self.ion_ids()
+        return self.catalog.to_index(ion_ids)
+
     def ion_tuples(self):
-        """ All ions needed for FDR calculation """
-        d_ions = self.td_df[['sf', 'da']].drop_duplicates().values.tolist()
-        t_ions = self.td_df[['sf', 'ta']].drop_duplicates().values.tolist()
-        return list(map(tuple, t_ions + d_ions))
+        """ All ions needed for FDR calculation
+
+        Returns
+        -------
+        : numpy.ndarray
+            (ions x 2) matrix of catalog (formula id, adduct id) codes, sorted
+        """
+        return np.stack(self.catalog.split(self.ion_ids()), axis=1)
 
     @staticmethod
     def _msm_fdr_map(target_msm, decoy_msm):
-        target_msm_hits = pd.Series(target_msm.msm.value_counts(), name='target')
-        decoy_msm_hits = pd.Series(decoy_msm.msm.value_counts(), name='decoy')
-        msm_df = pd.concat([target_msm_hits, decoy_msm_hits], axis=1).fillna(0).sort_index(ascending=False)
-        msm_df['target_cum'] = msm_df.target.cumsum()
-        msm_df['decoy_cum'] = msm_df.decoy.cumsum()
-        msm_df['fdr'] = msm_df.decoy_cum / msm_df.target_cum
-        return msm_df.fdr
+        """ FDR at every distinct target msm value, median over the decoy samples
+
+        Args
+        ----
+        target_msm : numpy.ndarray
+            msm of the target ions
+        decoy_msm : numpy.ndarray
+            (samples x target formulas) matrix of decoy ion msm, -inf for missing decoys
+
+        Returns
+        -------
+        : pandas.Series
+            FDR indexed by the target msm values
+        """
+        msm_values = np.unique(target_msm)
+        target_cum = target_msm.shape[0] - np.searchsorted(np.sort(target_msm), msm_values, 'left')
+        decoy_cum = np.stack([decoy_msm.shape[1] - np.searchsorted(sample_msm, msm_values, 'left')
+                              for sample_msm in np.sort(decoy_msm, axis=1)])
+        return pd.Series(np.median(decoy_cum / target_cum, axis=0), index=msm_values, name='fdr')
 
     def _digitize_fdr(self, fdr_df):
         df = fdr_df.copy().sort_values(by='msm', ascending=False)
@@ -56,28 +138,62 @@ class FDR(object):
         df['fdr'] = df.fdr_d
         return df.drop('fdr_d', axis=1)
 
-    def estimate_fdr(self, sf_adduct_msm_df):
+    def estimate_ion_fdr(self, ion_msm):
+        """ Estimate FDR of the target ions
+
+        Args
+        ----
+        ion_msm : pandas.Series
+            msm indexed by catalog ion ids, ions without msm count as zero msm
+
+        Returns
+        -------
+        : pandas.DataFrame
+            fdr column indexed by the target ion ids
+        """
         logger.info('Estimating FDR')
 
-        all_sf_adduct_msm_df = (pd.DataFrame(self.ion_tuples(), columns=['sf', 'adduct'])
-                                .set_index(['sf', 'adduct']).sort_index())
-        all_sf_adduct_msm_df = all_sf_adduct_msm_df.join(sf_adduct_msm_df).fillna(0)
+        ion_ids = self.ion_ids()
+        td_ion_ids = self._target_decoy_ion_ids()
+        msm = np.zeros(ion_ids.shape[0])
+        pos = np.searchsorted(ion_ids, ion_msm.index.values)
+        pos[pos == ion_ids.shape[0]] = 0
+        found = ion_ids[pos] == ion_msm.index.values
+        msm[pos[found]] = np.nan_to_num(ion_msm.values[found].astype(float), nan=0)
+        _, ion_adduct_ids = self.catalog.split(ion_ids)
+        _, td_adduct_ids = self.catalog.split(td_ion_ids[:, 0])
 
         target_fdr_df_list = []
-        for ta in self.target_adducts:
-            target_msm = all_sf_adduct_msm_df.loc(axis=0)[:, ta]
-            full_decoy_df = self.td_df[self.td_df.ta == ta][['sf', 'da']]
-
-            msm_fdr_list = []
-            for i in range(self.decoy_sample_size):
-                decoy_subset_df = full_decoy_df[i::self.decoy_sample_size]
-                sf_da_list = [tuple(row) for row in decoy_subset_df.values]
-                decoy_msm = all_sf_adduct_msm_df.loc[sf_da_list]
-                msm_fdr = self._msm_fdr_map(target_msm, decoy_msm)
-                msm_fdr_list.append(msm_fdr)
-
-            msm_fdr_avg = pd.Series(pd.concat(msm_fdr_list, axis=1).median(axis=1), name='fdr')
+        for ta_id in self.catalog.adduct_ids(self.target_adducts):
+            target_mask = ion_adduct_ids == ta_id
+            target_msm = pd.DataFrame({'msm': msm[target_mask]}, index=pd.Index(ion_ids[target_mask], name='ion_id'))
+            # decoys of a target formula are consecutive rows, the i-th of them belongs to the i-th sample
+            ta_decoy_ion_inds = np.searchsorted(ion_ids, td_ion_ids[td_adduct_ids == ta_id, 1])
+            decoy_i = np.arange(ta_decoy_ion_inds.shape[0])
+            decoy_msm = np.full((self.decoy_sample_size, -(-decoy_i.shape[0] // self.decoy_sample_size)), -np.inf)
+            decoy_msm[decoy_i % self.decoy_sample_size, decoy_i // self.decoy_sample_size] = msm[ta_decoy_ion_inds]
+
+            msm_fdr_avg = self._msm_fdr_map(target_msm.msm.values, decoy_msm)
             target_fdr = self._digitize_fdr(target_msm.join(msm_fdr_avg, on='msm'))
             target_fdr_df_list.append(target_fdr.drop('msm', axis=1))
 
         return pd.concat(target_fdr_df_list, axis=0)
+
+    def estimate_fdr(self, sf_adduct_msm_df):
+        """ Estimate FDR of the target ions
+
+        Args
+        ----
+        sf_adduct_msm_df : pandas.DataFrame | pandas.Series
+            msm indexed by sf and adduct
+
+        Returns
+        -------
+        : pandas.DataFrame
+            fdr column indexed by sf and adduct of the target ions
+        """
+        msm = sf_adduct_msm_df.msm if isinstance(sf_adduct_msm_df, pd.DataFrame) else sf_adduct_msm_df
+        self._target_decoy_ion_ids()  # builds the catalog for a td_df set directly
+        fdr_df = self.estimate_ion_fdr(pd.Series(msm.values, index=self.catalog.index_ion_ids(msm.index)))
+        fdr_df.index = self.catalog.to_index(fdr_df.index.values)
+        return fdr_df
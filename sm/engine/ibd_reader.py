@@ -0,0 +1,87 @@
+"""
+
+:synopsis: Direct access to spectra stored in imzML/ibd file pairs via memory-mapped byte offsets
+
+"""
+from os import listdir
+from os.path import dirname, basename, splitext, join
+import mmap
+import logging
+import numpy as np
+
+logger = logging.getLogger('engine')
+
+CHUNK_PEAKS_N = 5 * 10**6
+
+
+def find_ibd_path(imzml_path):
+    """ Find the binary .ibd file accompanying the imzML file, the extension case may differ """
+    ds_dir, imzml_fn = dirname(imzml_path), basename(imzml_path)
+    name = splitext(imzml_fn)[0]
+    return next((join(ds_dir, fn) for fn in listdir(ds_dir)
+                 if splitext(fn)[0] == name and splitext(fn)[1].lower() == '.ibd'), None)
+
+
+class IbdOffsets(object):
+    """ Per spectrum byte offsets into an .ibd file extracted from the parsed imzML metadata
+
+    Args
+    ----
+    parser : pyimzml.ImzMLParser.ImzMLParser
+    """
+    def __init__(self, parser):
+        self.mz_dtype = np.dtype(parser.mzPrecision).newbyteorder('<')
+        self.int_dtype = np.dtype(parser.intensityPrecision).newbyteorder('<')
+        # columns: mz offset, mz length, intensity offset, intensity length
+        self.table = np.array([parser.mzOffsets, parser.mzLengths,
+                               parser.intensityOffsets, parser.intensityLengths], dtype=np.int64).T
+
+    @property
+    def spectra_n(self):
+        return self.table.shape[0]
+
+    @property
+    def peaks_n(self):
+        return int(self.table[:, 1].sum())
+
+    def split(self, min_chunks_n=1, chunk_peaks_n=CHUNK_PEAKS_N):
+        """ Split the offsets table into chunks of consecutive spectra with roughly equal number of peaks
+
+        Returns
+        -------
+        : list
+            (spectrum index array, offsets table rows) pairs
+        """
+        if self.spectra_n == 0:
+            return []
+        chunks_n = int(np.clip(self.peaks_n // chunk_peaks_n, min_chunks_n, max(1, self.spectra_n)))
+        cum_peaks = np.cumsum(self.table[:, 1])
+        bounds = np.searchsorted(cum_peaks, np.linspace(0, cum_peaks[-1], chunks_n + 1)[1:-1])
+        return [(sp_ids, self.table[sp_ids])
+                for sp_ids in np.split(np.arange(self.spectra_n, dtype=np.int32), bounds) if sp_ids.shape[0] > 0]
+
+
+def _read_spectrum(mm, offsets, mz_dtype, int_dtype):
+    mz_o, mz_n, int_o, int_n = offsets
+    mzs = np.frombuffer(mm, dtype=mz_dtype, count=mz_n, offset=mz_o)
+    ints = np.frombuffer(mm, dtype=int_dtype, count=int_n, offset=int_o)
+    mask = ints > 0
+    # boolean indexing copies the data, so no views of the mmap outlive this function
+    return mzs[mask].astype(np.float32), ints[mask].astype(np.float64)
+
+
+def read_ibd_spectra(ibd_path, sp_ids, offsets_table, mz_dtype, int_dtype):
+    """ Read a chunk of spectra from a memory-mapped .ibd file
+
+    Returns
+    -------
+    : list
+        (int, np.ndarray, np.ndarray) triples, the same as produced by the converted formats
+    """
+    with open(ibd_path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return [(sp_id,) + _read_spectrum(mm, offsets, mz_dtype, int_dtype)
+                    for sp_id, offsets in zip(sp_ids.tolist(), offsets_table.tolist())]
+        finally:
+            mm.close()
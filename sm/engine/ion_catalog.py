@@ -0,0 +1,92 @@
+"""
+
+:synopsis: Dense integer ids of formulas, adducts and ions
+
+"""
+import numpy as np
+import pandas as pd
+
+
+class IonCatalog(object):
+    """ Assigns dense integer ids to the formulas and adducts of a job. An ion id is
+    sf_id * adduct_n + adduct_id, ids of formulas and adducts follow their sort order,
+    so ion ids sort the same way as (sf, adduct) pairs
+
+    Args
+    ----
+    sfs : iterable
+        Formulas, duplicates are allowed
+    adducts : iterable
+        Adducts, duplicates are allowed
+    """
+    def __init__(self, sfs, adducts):
+        self.sfs = pd.Index(np.unique(np.asarray(list(sfs), dtype=object)), name='sf')
+        self.adducts = pd.Index(np.unique(np.asarray(list(adducts), dtype=object)), name='adduct')
+
+    @classmethod
+    def from_ions(cls, ions):
+        """ Catalog of the formulas and adducts of (sf, adduct) tuples or an (sf, adduct) pandas.MultiIndex """
+        ion_index = _to_multi_index(ions)
+        return cls(ion_index.levels[0], ion_index.levels[1])
+
+    @property
+    def adduct_n(self):
+        return len(self.adducts)
+
+    @staticmethod
+    def _ids(index, values):
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        return index.get_indexer(uniques)[codes] if len(codes) else np.zeros(0, dtype=np.int64)
+
+    def sf_ids(self, sfs):
+        """ Formula ids, -1 for formulas missing in the catalog """
+        return self._ids(self.sfs, sfs)
+
+    def adduct_ids(self, adducts):
+        """ Adduct ids, -1 for adducts missing in the catalog """
+        return self._ids(self.adducts, adducts)
+
+    def ion_ids_from_codes(self, sf_ids, adduct_ids):
+        sf_ids, adduct_ids = np.asarray(sf_ids, dtype=np.int64), np.asarray(adduct_ids, dtype=np.int64)
+        return np.where((sf_ids >= 0) & (adduct_ids >= 0), sf_ids * self.adduct_n + adduct_ids, -1)
+
+    def ion_ids(self, sfs, adducts):
+        """ Ion ids of the (sfs[i], adducts[i]) pairs, -1 for pairs missing in the catalog
+
+        Returns
+        -------
+        : numpy.ndarray
+        """
+        return self.ion_ids_from_codes(self.sf_ids(sfs), self.adduct_ids(adducts))
+
+    def index_ion_ids(self, ions):
+        """ Ion ids of (sf, adduct) tuples or an (sf, adduct) pandas.MultiIndex. Only the index levels
+        are looked up, so indexes built by to_index cost no string hashing
+
+        Returns
+        -------
+        : numpy.ndarray
+        """
+        ion_index = _to_multi_index(ions)
+        sf_ids = self.sfs.get_indexer(ion_index.levels[0])[ion_index.codes[0]]
+        adduct_ids = self.adducts.get_indexer(ion_index.levels[1])[ion_index.codes[1]]
+        return self.ion_ids_from_codes(sf_ids, adduct_ids)
+
+    def split(self, ion_ids):
+        """ (formula ids, adduct ids) of the ions """
+        ion_ids = np.asarray(ion_ids, dtype=np.int64)
+        return ion_ids // self.adduct_n, ion_ids % self.adduct_n
+
+    def to_index(self, ion_ids):
+        """ (sf, adduct) pandas.MultiIndex of the ions """
+        sf_ids, adduct_ids = self.split(ion_ids)
+        return pd.MultiIndex(levels=[self.sfs, self.adducts], codes=[sf_ids, adduct_ids], names=['sf', 'adduct'])
+
+
+def _to_multi_index(ions):
+    if isinstance(ions, pd.MultiIndex):
+        return ions
+    ions = list(map(tuple, ions))
+    if not ions:
+        return pd.MultiIndex(levels=[[], []], codes=[[], []], names=['sf', 'adduct'])
+    return pd.MultiIndex.from_tuples(ions, names=['sf', 'adduct'])
@@ -1,129 +1,367 @@
 import logging
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from os import makedirs, listdir, remove
+from os.path import join
 from pathlib import Path
+from uuid import uuid4
 import boto3
-from botocore.exceptions import ClientError
 from itertools import product, repeat
-from pyspark.sql import SparkSession
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from sm.engine.util import SMConfig, split_s3_path
 from sm.engine.isocalc_wrapper import IsocalcWrapper
+from sm.engine.ion_catalog import IonCatalog
+from sm.engine.errors import SMError
 
 logger = logging.getLogger('engine')
 
+FORMULA_REGEX = re.compile(r'([A-Z][a-z]*)(\d*)')
+# parts are sorted by ion_i, row group statistics let reads of a few ions skip the rest of a part
+PARQUET_ROW_GROUP_SIZE = 64 * 1024
+# longer ion lists are matched after reading instead of in a parquet 'in' filter
+PARQUET_IN_FILTER_MAX_IONS = 10000
+# attempts to append new ions to a store when concurrent jobs keep taking the same ion ids
+STORE_APPEND_ATTEMPTS = 3
+
+
+def _parse_formula(formula):
+    if not isinstance(formula, str) or FORMULA_REGEX.sub('', formula):
+        return None
+    counts = Counter()
+    for element, n in FORMULA_REGEX.findall(formula):
+        counts[element] += int(n or 1)
+    return counts
+
+
+def ion_formula(sf, adduct):
+    """ Formula of the ion in Hill notation. All (sf, adduct) pairs producing the same ion have the same one
+
+    Returns
+    -------
+    : str
+        sf + adduct if the formulas can't be parsed or the adduct removes atoms the sf doesn't have
+    """
+    counts = _parse_formula(sf)
+    adduct_counts = _parse_formula(adduct[1:]) if isinstance(adduct, str) and adduct[:1] in ('+', '-') else None
+    if counts is None or adduct_counts is None:
+        return '{}{}'.format(sf, adduct)
+    if adduct[0] == '+':
+        counts.update(adduct_counts)
+    else:
+        counts.subtract(adduct_counts)
+    if any(n < 0 for n in counts.values()):
+        return '{}{}'.format(sf, adduct)
+
+    hill_order = ['C', 'H'] if 'C' in counts else []
+    elements = hill_order + sorted(el for el in counts if el not in hill_order)
+    return ''.join(el + (str(counts[el]) if counts[el] > 1 else '') for el in elements if counts[el] > 0)
+
+
+def _calc_centroids(isocalc, ion_i, sf, adduct):
+    mzs, ints = isocalc.ion_centroids(sf, adduct)
+    if mzs is not None:
+        return zip(repeat(ion_i),
+                   range(0, len(mzs)),
+                   map(float, mzs),
+                   map(float, ints))
+    else:
+        return []
+
+
+def _calc_centroids_chunk(args):
+    isocalc, ion_rows = args
+    return [centr for ion_i, sf, adduct in ion_rows for centr in _calc_centroids(isocalc, ion_i, sf, adduct)]
+
+
+def _index_by_ion_formula(ion_df):
+    """ Number the (sf, adduct) pairs by their ion formula, pairs of the same ion share the ion_i """
+    formulas = [ion_formula(sf, adduct) for sf, adduct in zip(ion_df.sf, ion_df.adduct)]
+    ion_df = ion_df.set_index(pd.Index(pd.factorize(formulas)[0], name='ion_i'))
+    return ion_df
+
+
+def _ion_mask(ion_df, ions, catalog=None):
+    """ Mask of the ion_df rows of the 'ions', matched by their integer catalog ids.
+    The catalog is built from the ions if not given
+    """
+    catalog = catalog or IonCatalog.from_ions(ions)
+    ion_ids = catalog.index_ion_ids(ions)
+    return np.isin(catalog.ion_ids(ion_df.sf, ion_df.adduct), ion_ids[ion_ids >= 0])
+
+
+def _s3_client(sm_config):
+    cred_dict = dict(aws_access_key_id=sm_config['aws']['aws_access_key_id'],
+                     aws_secret_access_key=sm_config['aws']['aws_secret_access_key'])
+    return boto3.client('s3', **cred_dict)
+
+
+def _list_parquet_parts(path, sm_config):
+    """ Sorted names of the parquet files of a directory written by _write_parquet_part """
+    if path.startswith('s3a://'):
+        bucket, key = split_s3_path(path)
+        paginator = _s3_client(sm_config).get_paginator('list_objects_v2')
+        names = [obj['Key'][len(key) + 1:]
+                 for page in paginator.paginate(Bucket=bucket, Prefix=key + '/')
+                 for obj in page.get('Contents', [])]
+    else:
+        names = listdir(path) if Path(path).exists() else []
+    return sorted(name for name in names if name.endswith('.parquet'))
+
+
+def _write_parquet_part(df, path, part_name, sm_config):
+    """ Add the DataFrame to a parquet directory as one more part, rows are sorted by ion_i """
+    if 'ion_i' in df.columns:
+        df = df.sort_values(by='ion_i', kind='mergesort')
+    buf = BytesIO()
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), buf, row_group_size=PARQUET_ROW_GROUP_SIZE)
+    if path.startswith('s3a://'):
+        bucket, key = split_s3_path(path)
+        _s3_client(sm_config).put_object(Bucket=bucket, Key=key + '/' + part_name, Body=buf.getvalue())
+    else:
+        makedirs(path, exist_ok=True)
+        with open(join(path, part_name), 'wb') as f:
+            f.write(buf.getvalue())
+
+
+def _remove_parquet_part(path, part_name, sm_config):
+    if path.startswith('s3a://'):
+        bucket, key = split_s3_path(path)
+        _s3_client(sm_config).delete_object(Bucket=bucket, Key=key + '/' + part_name)
+    else:
+        remove(join(path, part_name))
+
+
+def _read_parquet(path, sm_config, part_names=None, columns=None, ion_ids=None):
+    """ Read the parts of a parquet directory, all of them if part_names not given.
+    Local parts are memory mapped, parts on S3 are downloaded whole
+
+    Args
+    ----
+    columns : list
+        Columns to read, all if not given
+    ion_ids : iterable
+        Read only the rows of these ions, all if not given. Row groups outside of the ion_i range
+        are skipped, a long list of ions is matched after reading
+    """
+    part_names = _list_parquet_parts(path, sm_config) if part_names is None else part_names
+    if path.startswith('s3a://'):
+        bucket, key = split_s3_path(path)
+        s3 = _s3_client(sm_config)
+        sources = [pa.BufferReader(s3.get_object(Bucket=bucket, Key=key + '/' + name)['Body'].read())
+                   for name in part_names]
+    else:
+        sources = [join(path, name) for name in part_names]
+
+    filters, match_after_read = None, False
+    if ion_ids is not None:
+        ion_ids = np.unique(np.asarray(ion_ids, dtype=np.int64))
+        if ion_ids.shape[0] == 0:
+            filters = [('ion_i', '<', 0)]
+        elif ion_ids.shape[0] <= PARQUET_IN_FILTER_MAX_IONS:
+            filters = [('ion_i', 'in', ion_ids.tolist())]
+        else:
+            filters = [('ion_i', '>=', int(ion_ids[0])), ('ion_i', '<=', int(ion_ids[-1]))]
+            match_after_read = True
+    read_columns = columns
+    if match_after_read and columns is not None and 'ion_i' not in columns:
+        read_columns = columns + ['ion_i']
+    tables = [pq.read_table(source, columns=read_columns, filters=filters, memory_map=isinstance(source, str))
+              for source in sources]
+    df = pa.concat_tables(tables).to_pandas()
+    if match_after_read:
+        df = df[np.isin(df.ion_i.values, ion_ids)].reset_index(drop=True)
+        df = df[columns] if columns is not None else df
+    return df
+
+
+def union_ion_centroids(centr_gens, ion_tuples_list, catalog=None):
+    """ Union of the ion centroids of several molecular databases. Ions present in more
+    than one database or produced by different (sf, adduct) pairs are included once, ions are numbered anew
+
+    Args
+    ----
+    centr_gens : list[IonCentroidsGenerator]
+    ion_tuples_list : list
+        (sf, adduct) tuples or pandas.MultiIndex of the ions needed from each of the generators
+    catalog : sm.engine.ion_catalog.IonCatalog
+        Catalog covering all the ions, built from each of the ion lists if not given
+
+    Returns
+    -------
+    : tuple
+        (ion_df with sf and adduct columns, ion_centroids_df), both indexed by the new ion_i.
+        The ion_df index is not unique when several (sf, adduct) pairs give the same ion
+    """
+    db_centr_dfs = []
+    for centr_gen, ions in zip(centr_gens, ion_tuples_list):
+        ion_df = centr_gen.ion_df[_ion_mask(centr_gen.ion_df, ions, catalog)]
+        db_centr_dfs.append(ion_df.join(centr_gen.ion_centroids_df, how='inner'))
+    centr_df = pd.concat(db_centr_dfs).drop_duplicates(subset=['sf', 'adduct', 'peak_i'])
+
+    ion_df = _index_by_ion_formula(centr_df[['sf', 'adduct']].drop_duplicates()
+                                   .sort_values(by=['sf', 'adduct']))
+    ion_centroids_df = (pd.merge(centr_df, ion_df.reset_index(), on=['sf', 'adduct'])
+                        .drop_duplicates(subset=['ion_i', 'peak_i'])
+                        [['ion_i', 'peak_i', 'mz', 'int']]
+                        .sort_values(by='mz')
+                        .set_index('ion_i'))
+    return ion_df, ion_centroids_df
+
+
+class IonCentroidsStore(object):
+    """ Isotope centroids of (sf, adduct) pairs shared by all molecular databases, one store per
+    isotope generation sigma and charge
+
+    Every generation appends a uniquely named part with the new (sf, adduct) pairs and the centroids
+    of their new ion formulas. Pairs of the same ion formula share the ion_i, stored ion_i values never change.
+    Jobs appending at the same time can give the same new ion_i to different formulas, a job that finds
+    its ion ids taken removes its part, see has_conflicts
+
+    Args
+    ----
+    sm_config : dict
+    sigma : float
+    charge : int
+    """
+    ION_COLUMNS = ['ion_i', 'sf', 'adduct', 'formula']
+    CENTROID_COLUMNS = ['ion_i', 'peak_i', 'mz', 'int']
+
+    def __init__(self, sm_config, sigma, charge):
+        self._sm_config = sm_config
+        self._path = '{}/centroids/{}/{}'.format(sm_config['isotope_storage']['path'], sigma, charge)
+
+    def _part_names(self):
+        # ions of a part are written last, parts without them are incomplete
+        return _list_parquet_parts(self._path + '/ions', self._sm_config)
+
+    def _read_ions(self):
+        part_names = self._part_names()
+        if not part_names:
+            return pd.DataFrame({'ion_i': np.zeros(0, dtype=np.int64)}, columns=self.ION_COLUMNS)
+        return (_read_parquet(self._path + '/ions', self._sm_config, part_names)
+                .sort_values(by='ion_i', kind='mergesort')
+                .reset_index(drop=True))
+
+    def load_ions(self):
+        """ All (sf, adduct) pairs in the store ordered by ion_i. A pair appended by several
+        concurrent jobs is returned once, with the lowest ion_i
+
+        Returns
+        -------
+        : pandas.DataFrame
+            ion_i, sf, adduct and ion formula columns
+        """
+        return self._read_ions().drop_duplicates(subset=['sf', 'adduct']).reset_index(drop=True)
+
+    def has_conflicts(self, ion_ids):
+        """ Check if any of the ion ids is given to more than one ion formula
+        """
+        ion_df = self._read_ions()
+        formula_n = ion_df[ion_df.ion_i.isin(ion_ids)].groupby('ion_i').formula.nunique()
+        return bool((formula_n > 1).any())
+
+    def load_centroids(self, ion_ids):
+        """ Centroids of the ions
+
+        Returns
+        -------
+        : pandas.DataFrame
+            peak_i, mz and int columns indexed by ion_i
+        """
+        part_names = self._part_names()
+        if not part_names:
+            return (pd.DataFrame({'ion_i': np.zeros(0, dtype=np.int64)}, columns=self.CENTROID_COLUMNS)
+                    .set_index('ion_i'))
+        return (_read_parquet(self._path + '/ion_centroids', self._sm_config, part_names,
+                              columns=self.CENTROID_COLUMNS, ion_ids=ion_ids)
+                .set_index('ion_i'))
+
+    def append(self, ion_df, ion_centroids_df):
+        """ Add new (sf, adduct) pairs and the centroids of their new ions as one more part
+
+        Args
+        ----
+        ion_df : pandas.DataFrame
+            ion_i, sf, adduct and ion formula columns
+        ion_centroids_df : pandas.DataFrame
+            Centroids indexed by ion_i
+
+        Returns
+        -------
+        : str
+            Name of the new part
+        """
+        part_name = 'part-{}.parquet'.format(uuid4().hex)
+        _write_parquet_part(ion_centroids_df.reset_index()[self.CENTROID_COLUMNS],
+                            self._path + '/ion_centroids', part_name, self._sm_config)
+        _write_parquet_part(ion_df[self.ION_COLUMNS], self._path + '/ions', part_name, self._sm_config)
+        return part_name
+
+    def remove(self, part_name):
+        """ Remove the part, its ions go first so that a partly removed part is ignored
+        """
+        _remove_parquet_part(self._path + '/ions', part_name, self._sm_config)
+        _remove_parquet_part(self._path + '/ion_centroids', part_name, self._sm_config)
+
 
 class IonCentroidsGenerator(object):
     """ Generator of theoretical isotope peaks for all molecules in a database.
 
+    Isotope peaks are generated once per ion formula, (sf, adduct) pairs of the same ion
+    share the ion_i, so the ion_df index is not unique
+
+    Peaks are kept in the IonCentroidsStore shared by all databases. Without a Spark context,
+    peaks are generated with a process pool
+
     Args
     ----------
-    sc : pyspark.SparkContext
+    sc : pyspark.SparkContext | None
     moldb_name : str
     isocalc: IsocalcWrapper
+    iso_gen_part_n : int
+        Number of partitions (chunks without Spark) for isotope pattern generation
     """
-    def __init__(self, sc, moldb_name, isocalc):
+    def __init__(self, sc, moldb_name, isocalc, iso_gen_part_n=512):
         self._sc = sc
         self._moldb_name = moldb_name
         self._isocalc = isocalc
         self._sm_config = SMConfig.get_conf()
-        self._parquet_chunks_n = 64
-        self._iso_gen_part_n = 512
-
-        self._spark_session = SparkSession(self._sc)
-        self._ion_centroids_path = '{}/{}/{}/{}'.format(self._sm_config['isotope_storage']['path'],
-                                                        self._moldb_name,
-                                                        self._isocalc.sigma,
-                                                        self._isocalc.charge)
+        self._iso_gen_part_n = iso_gen_part_n
         self.ion_df = None
         self.ion_centroids_df = None
 
-    def exists(self):
-        """ Check if ion centroids saved to parquet
-        """
-        if self._ion_centroids_path.startswith('s3a://'):
-            cred_dict = dict(aws_access_key_id=self._sm_config['aws']['aws_access_key_id'],
-                             aws_secret_access_key=self._sm_config['aws']['aws_secret_access_key'])
-            bucket, key = split_s3_path(self._ion_centroids_path)
-            s3 = boto3.client('s3', **cred_dict)
-            try:
-                s3.head_object(Bucket=bucket, Key=key + '/ions/_SUCCESS')
-            except ClientError:
-                return False
-            else:
-                return True
+    def _calc_centroids_df(self, isocalc, uniq_ion_df):
+        """ Isotope centroids of the ions, one (sf, adduct) pair per ion_i """
+        ion_rows = uniq_ion_df.reset_index()[['ion_i', 'sf', 'adduct']].values
+        if self._sc:
+            ion_centroids = (self._sc.parallelize(ion_rows, numSlices=self._iso_gen_part_n)
+                             .flatMap(lambda args: _calc_centroids(isocalc, *args))
+                             .collect())
         else:
-            return Path(self._ion_centroids_path + '/ions/_SUCCESS').exists()
-
-    def generate(self, isocalc, sfs, adducts):
-        """ Generate isotopic peaks
-
-        Args
-        ---
-        isocalc: IsocalcWrapper
-            Cannot be a class field as Spark doesn't allow to pass 'self' to functions
-        adducts: list
-        """
-        logger.info('Generating molecular isotopic peaks')
-
-        def calc_centroids(args):
-            ion_i, sf, adduct = args
-            mzs, ints = isocalc.ion_centroids(sf, adduct)
-            if mzs is not None:
-                return zip(repeat(ion_i),
-                           range(0, len(mzs)),
-                           map(float, mzs),
-                           map(float, ints))
-            else:
-                return []
-
-        ion_df = pd.DataFrame([(i, sf, adduct) for i, (sf, adduct) in
-                               enumerate(sorted(product(sfs, adducts)))],
-                              columns=['ion_i', 'sf', 'adduct']).set_index('ion_i')
-
-        ion_centroids_rdd = (self._sc.parallelize(ion_df.reset_index().values,
-                                                  numSlices=self._iso_gen_part_n)
-                             .flatMap(calc_centroids))
-        self.ion_centroids_df = (pd.DataFrame(data=ion_centroids_rdd.collect(),
-                                              columns=['ion_i', 'peak_i', 'mz', 'int'])
-                                 .sort_values(by='mz')
-                                 .set_index('ion_i'))
-
-        self.ion_df = ion_df.loc[self.ion_centroids_df.index.unique()]
-
-        # Use when pandas DataFrames get way too big
-        # ion_centroids_df = self._spark_session.createDataFrame(data=ion_centroids_rdd,
-        #                                                        schema=self.ion_centroids_df_fields)
-        # self.ion_centroids_df = (ion_centroids_df
-        #                          .sort(ion_centroids_df.mz.asc())
-        #                          .coalesce(self._parquet_chunks_n))
-
-    def save(self):
-        """ Save isotopic peaks
-        """
-        logger.info('Saving peaks')
-
-        centr_spark_df = self._spark_session.createDataFrame(self.ion_centroids_df.reset_index())
-        centr_spark_df.write.parquet(self._ion_centroids_path + '/ion_centroids', mode='overwrite')
-        ion_spark_df = self._spark_session.createDataFrame(self.ion_df.reset_index())
-        ion_spark_df.write.parquet(self._ion_centroids_path + '/ions', mode='overwrite')
-
-    def restore(self):
-        logger.info('Restoring peaks')
-
-        self.ion_df = self._spark_session.read.parquet(
-            self._ion_centroids_path + '/ions').toPandas().set_index('ion_i')
-        self.ion_centroids_df = self._spark_session.read.parquet(
-            self._ion_centroids_path + '/ion_centroids').toPandas().set_index('ion_i')
+            chunks = np.array_split(ion_rows, max(min(self._iso_gen_part_n, ion_rows.shape[0]), 1))
+            with ProcessPoolExecutor() as pool:
+                ion_centroids = [centr for chunk_centroids
+                                 in pool.map(_calc_centroids_chunk, [(isocalc, chunk) for chunk in chunks])
+                                 for centr in chunk_centroids]
+        return pd.DataFrame(data=ion_centroids, columns=['ion_i', 'peak_i', 'mz', 'int']).set_index('ion_i')
 
     def sf_adduct_centroids_df(self):
         return self.ion_df.join(self.ion_centroids_df).set_index(['sf', 'adduct'])
 
-    def centroids_subset(self, ions):
+    def centroids_subset(self, ions, catalog=None):
         """ Restore isotopic peaks dataframe only for the 'ions'
 
         Args
         ---
-        ions: list of tuples
+        ions: list of tuples | pandas.MultiIndex
+        catalog: sm.engine.ion_catalog.IonCatalog
+            Catalog covering the ions, built from them if not given
 
         Returns
         ---
@@ -131,16 +369,57 @@ class IonCentroidsGenerator(object):
         """
         assert self.ion_df is not None
 
-        ion_map = self.ion_df.reset_index().set_index(['sf', 'adduct']).ion_i
-        ion_ids = ion_map.loc[ions].values
-        return self.ion_centroids_df.loc[ion_ids].sort_values(by='mz')
+        ion_inds = np.unique(self.ion_df.index.values[_ion_mask(self.ion_df, ions, catalog)])
+        return self.ion_centroids_df.loc[ion_inds].sort_values(by='mz')
+
+    def _append_missing_pairs(self, isocalc, store, pair_df):
+        """ Generate centroids of the pairs missing in the store and append them as a new part
+
+        Returns
+        -------
+        : tuple
+            (part name or None if all pairs are stored, ids of the new ions)
+        """
+        store_ion_df = store.load_ions()
+        new_pair_df = (pair_df.merge(store_ion_df[['sf', 'adduct']], how='left', indicator=True)
+                       .query('_merge == "left_only"').drop('_merge', axis=1))
+        if new_pair_df.shape[0] == 0:
+            return None, []
+
+        new_pair_df['formula'] = [ion_formula(sf, adduct) for sf, adduct in zip(new_pair_df.sf, new_pair_df.adduct)]
+        formula_ion_i = store_ion_df.drop_duplicates(subset='formula').set_index('formula').ion_i
+        ion_i = new_pair_df.formula.map(formula_ion_i)
+        new_ion_mask = ion_i.isnull().values
+        next_ion_i = store_ion_df.ion_i.max() + 1 if store_ion_df.shape[0] > 0 else 0
+        ion_i[new_ion_mask] = next_ion_i + pd.factorize(new_pair_df.formula[new_ion_mask])[0]
+        new_pair_df['ion_i'] = ion_i.astype(np.int64)
+
+        new_ion_df = new_pair_df[new_ion_mask].drop_duplicates(subset='ion_i').set_index('ion_i')
+        logger.info('Generating isotopic peaks of %s new ions for %s new formula adduct pairs of %s',
+                    new_ion_df.shape[0], new_pair_df.shape[0], self._moldb_name)
+        part_name = store.append(new_pair_df, self._calc_centroids_df(isocalc, new_ion_df))
+        return part_name, new_ion_df.index.tolist()
 
     def generate_if_not_exist(self, isocalc, sfs, adducts):
-        if not self.exists():
-            self.generate(isocalc=isocalc, sfs=sfs, adducts=adducts)
-            self.save()
+        """ Get isotopic peaks of all (sf, adduct) pairs from the store shared by all databases,
+        only pairs missing in the store are generated and added to it
+        """
+        store = IonCentroidsStore(self._sm_config, isocalc.sigma, isocalc.charge)
+        pair_df = pd.DataFrame(sorted(product(sfs, adducts)), columns=['sf', 'adduct'])
+
+        for _ in range(STORE_APPEND_ATTEMPTS):
+            part_name, new_ion_ids = self._append_missing_pairs(isocalc, store, pair_df)
+            if part_name is None or not store.has_conflicts(new_ion_ids):
+                break
+            logger.warning('Ion ids of part %s were taken by a concurrent job, generating again', part_name)
+            store.remove(part_name)
         else:
-            self.restore()
+            raise SMError('Failed to add isotopic peaks of {} to the store in {} attempts'
+                          .format(self._moldb_name, STORE_APPEND_ATTEMPTS))
+
+        ion_df = pair_df.merge(store.load_ions()[['ion_i', 'sf', 'adduct']], on=['sf', 'adduct']).set_index('ion_i')
+        self.ion_centroids_df = store.load_centroids(ion_df.index.unique()).sort_values(by='mz')
+        self.ion_df = ion_df[ion_df.index.isin(self.ion_centroids_df.index)]
 
     def ions(self, adducts):
         return (self.ion_df[self.ion_df.adduct.isin(adducts)]
@@ -0,0 +1,128 @@
+"""
+
+:synopsis: Converter of mass spec files into chunks of binary numpy arrays accessible from pyspark
+
+"""
+from io import BytesIO
+from os import makedirs
+from os.path import exists, join
+import logging
+import numpy as np
+
+from sm.engine.ms_txt_converter import MsTxtConverter
+
+
+logger = logging.getLogger('engine')
+
+CHUNK_PEAKS_N = 5 * 10**6
+SUCCESS_MARKER = '_SUCCESS'
+
+
+def encode_spectra_chunk(sp_ids, mzs_list, ints_list):
+    """ Encodes given spectra into a columnar chunk: spectra indices, an offsets table
+    and flat m/z and intensity arrays
+
+    Returns
+    -------
+    : bytes
+        Content of a numpy .npz file
+    """
+    offsets = np.zeros(len(sp_ids) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([mzs.shape[0] for mzs in mzs_list])
+    buf = BytesIO()
+    np.savez(buf,
+             sp_ids=np.asarray(sp_ids, dtype=np.int32),
+             offsets=offsets,
+             mzs=np.concatenate(mzs_list).astype(np.float32) if mzs_list else np.zeros(0, dtype=np.float32),
+             ints=np.concatenate(ints_list).astype(np.float64) if ints_list else np.zeros(0, dtype=np.float64))
+    return buf.getvalue()
+
+
+def decode_spectra_chunk(chunk):
+    """ Decodes a chunk produced by encode_spectra_chunk into spectra
+
+    Returns
+    -------
+    : generator
+        (int, np.ndarray, np.ndarray) triples, the same as in the text format
+    """
+    with np.load(BytesIO(chunk)) as arrays:
+        sp_ids, offsets = arrays['sp_ids'], arrays['offsets']
+        mzs, ints = arrays['mzs'], arrays['ints'].astype(np.float64, copy=False)
+    for sp_id, l, r in zip(sp_ids.tolist(), offsets[:-1], offsets[1:]):
+        yield sp_id, mzs[l:r], ints[l:r]
+
+
+class MsNpyConverter(MsTxtConverter):
+    """ Converts spectra from mass spec file formats to a directory of binary chunks
+    with float32 m/z and float64 intensity arrays for later access from Spark
+
+    Args
+    ----
+    ms_file_path : str
+        Path to a mass spec data file
+    npy_path : str
+        Directory to store spectra chunks in
+    coord_path : str
+        Path to store spectra coordinates in plain text format
+    chunk_peaks_n : int
+        Approximate number of peaks per chunk file
+    chunk_prefix : str
+        File name prefix of the chunks
+    """
+    def __init__(self, ms_file_path, npy_path, coord_path=None, chunk_peaks_n=CHUNK_PEAKS_N,
+                 chunk_prefix='chunk_'):
+        super().__init__(ms_file_path, None, coord_path)
+        self.npy_path = npy_path
+        self.chunk_peaks_n = chunk_peaks_n
+        self.chunk_prefix = chunk_prefix
+        self._chunk_i = 0
+        self._chunk = None
+        self._chunk_peaks_n = 0
+
+    @property
+    def spectra_path(self):
+        return self.npy_path
+
+    def save_spectrum(self, i, mzs, ints):
+        sp_ids, mzs_list, ints_list = self._chunk
+        sp_ids.append(i)
+        mzs_list.append(mzs)
+        ints_list.append(ints)
+        self._chunk_peaks_n += mzs.shape[0]
+        if self._chunk_peaks_n >= self.chunk_peaks_n:
+            self._flush_chunk()
+
+    def _flush_chunk(self):
+        if self._chunk[0]:
+            chunk_path = join(self.npy_path, '{}{:05d}.npz'.format(self.chunk_prefix, self._chunk_i))
+            with open(chunk_path, 'wb') as f:
+                f.write(encode_spectra_chunk(*self._chunk))
+            self._chunk_i += 1
+        self._chunk = ([], [], [])
+        self._chunk_peaks_n = 0
+
+    def _spectra_exist(self):
+        return exists(join(self.npy_path, SUCCESS_MARKER))
+
+    def _open_spectra_file(self):
+        makedirs(self.npy_path, exist_ok=True)
+        self._chunk_i = 0
+        self._chunk = ([], [], [])
+        self._chunk_peaks_n = 0
+
+    def _close_spectra_file(self):
+        self._flush_chunk()
+
+    def _part_converter(self, part_i):
+        converter = MsNpyConverter(self.ms_file_path, self.npy_path, chunk_peaks_n=self.chunk_peaks_n,
+                                   chunk_prefix='part_{:05d}_chunk_'.format(part_i))
+        converter.preprocess = self.preprocess
+        return converter
+
+    def _merge_parts(self, part_converters):
+        # part chunks are written into the same directory and read by Spark as they are
+        pass
+
+    def _mark_converted(self):
+        open(join(self.npy_path, SUCCESS_MARKER), 'w').close()
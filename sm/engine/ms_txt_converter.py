@@ -5,8 +5,11 @@
 .. moduleauthor:: Vitaly Kovalev <intscorpio@gmail.com>
 """
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from importlib import import_module
+from os import remove
 from os.path import exists
+from shutil import copyfileobj
 import logging
 import numpy as np
 import scipy.signal as signal
@@ -14,10 +17,16 @@ from sm.engine.errors import SMError
 from pyMSpec.centroid_detection import gradient
 
 from sm.engine.util import SMConfig
+from sm.engine.spectra_stats import SpectraStats
 
 
 logger = logging.getLogger('engine')
 
+PARTS_PER_PROCESS = 4
+
+# parser of the mass spec file in a conversion worker process, set once per process by _init_worker
+_worker_parser = None
+
 
 def preprocess_spectrum(mzs, ints):
     ints = signal.savgol_filter(ints, 5, 2)
@@ -92,6 +101,7 @@ class MsTxtConverter(object):
         self.coord_file = None
 
         self.parser = None
+        self.stats = SpectraStats()
 
     def parse_save_spectrum(self, i, x, y):
         """ Parse and save to files spectrum with index i and its coordinates x,y"""
@@ -99,10 +109,29 @@ class MsTxtConverter(object):
         if self.preprocess:
             mzs, ints = preprocess_spectrum(mzs, ints)
 
-        self.txt_file.write(encode_data_line(i, mzs[ints > 0], ints[ints > 0], decimals=9) + '\n')
+        mzs, ints = mzs[ints > 0], ints[ints > 0]
+        self.stats.update(mzs, ints)
+        self.save_spectrum(i, mzs, ints)
         if self.coord_file:
             self.coord_file.write(encode_coord_line(i, x, y) + '\n')
 
+    def save_spectrum(self, i, mzs, ints):
+        """ Save spectrum with index i to the spectra file """
+        self.txt_file.write(encode_data_line(i, mzs, ints, decimals=9) + '\n')
+
+    @property
+    def spectra_path(self):
+        return self.txt_path
+
+    def _spectra_exist(self):
+        return exists(self.txt_path)
+
+    def _open_spectra_file(self):
+        self.txt_file = open(self.txt_path, 'w')
+
+    def _close_spectra_file(self):
+        self.txt_file.close()
+
     def _init_ms_parser_factory(self):
         ms_file_type_config = SMConfig.get_ms_file_handler(self.ms_file_path)
         ms_parser_factory_module = ms_file_type_config['parser_factory']
@@ -116,10 +145,65 @@ class MsTxtConverter(object):
             coord_counts = {coo: cnt for coo, cnt in top_n_coord_counts if cnt > 1}
             logger.warning('Duplicated coordinates in ((x,y), n) format: {}'.format(coord_counts)[:1000])
 
-    def convert(self, preprocess=False, print_progress=True):
+    def _part_converter(self, part_i):
+        """ Create a converter writing one part of the output in a separate process """
+        converter = self.__class__(self.ms_file_path, '{}.part{:05d}'.format(self.txt_path, part_i))
+        converter.preprocess = self.preprocess
+        return converter
+
+    def _merge_parts(self, part_converters):
+        with open(self.txt_path, 'wb') as txt_file:
+            for converter in part_converters:
+                with open(converter.txt_path, 'rb') as part_file:
+                    copyfileobj(part_file, txt_file)
+                remove(converter.txt_path)
+
+    def _mark_converted(self):
+        pass
+
+    def _save_coordinates(self, coordinates):
+        if self.coord_path:
+            with open(self.coord_path, 'w') as coord_file:
+                for i, (x, y) in enumerate(coordinates):
+                    coord_file.write(encode_coord_line(i, x, y) + '\n')
+
+    def _convert_serial(self, coordinates, print_progress):
+        self._open_spectra_file()
+        self.coord_file = open(self.coord_path, 'w') if self.coord_path else None
+
+        track_progress = get_track_progress(points_n=len(coordinates), steps_n=10, active=print_progress)
+        for i, (x, y) in enumerate(coordinates):
+            try:
+                self.parse_save_spectrum(i, x, y)
+                track_progress(i)
+            except Exception as e:
+                logger.error('Spectrum parsing failed i=%s, x=%s y=%s: %s', i, x, y, e)
+                raise
+
+        self._close_spectra_file()
+        if self.coord_file:
+            self.coord_file.close()
+
+    def _convert_parallel(self, coordinates, processes, print_progress):
+        chunks = np.array_split(np.arange(len(coordinates)), processes * PARTS_PER_PROCESS)
+        parts = [(self._part_converter(part_i), int(chunk[0]), int(chunk[-1]) + 1)
+                 for part_i, chunk in enumerate(chunk for chunk in chunks if chunk.shape[0] > 0)]
+
+        track_progress = get_track_progress(points_n=len(parts), steps_n=10, active=print_progress)
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                                 initargs=(self._parser_factory, self.ms_file_path)) as pool:
+            for part_i, part_stats in enumerate(pool.map(_convert_part, parts)):
+                self.stats.merge(part_stats)
+                track_progress(part_i)
+
+        self._merge_parts([converter for converter, _, _ in parts])
+        self._save_coordinates(coordinates)
+
+    def convert(self, preprocess=False, print_progress=True, processes=1):
         """
         Converts MS data provided by given parser to a text-based format.
         Optionally writes the coordinates into a coordinate file.
+        Dataset statistics are collected on the way and available as the 'stats' attribute.
 
         Args
         ----
@@ -127,34 +211,53 @@ class MsTxtConverter(object):
             Apply filter and centroid detection to all spectra before writing (rarely useful)
         print_progress : bool
             Whether or not to print progress information to stdout
+        processes : int
+            Number of worker processes. With more than one, the pixel range is split into chunks
+            that are parsed in parallel and written into part files
         """
         logger.info("MS -> Txt conversion")
         self.preprocess = preprocess
 
-        if not exists(self.txt_path):
-            self.txt_file = open(self.txt_path, 'w')
-            self.coord_file = open(self.coord_path, 'w') if self.coord_path else None
-
+        if not self._spectra_exist():
             self.parser = self._parser_factory(self.ms_file_path)
             coordinates = [coo[:2] for coo in self.parser.coordinates]
             self._check_coord_duplicates(coordinates)
 
-            pixels_n = len(coordinates)
-            track_progress = get_track_progress(points_n=pixels_n, steps_n=10, active=print_progress)
-
-            logger.info('Converting %s spectra', pixels_n)
-            for i, (x, y) in enumerate(coordinates):
-                try:
-                    self.parse_save_spectrum(i, x, y)
-                    track_progress(i)
-                except Exception as e:
-                    logger.error('Spectrum parsing failed i=%s, x=%s y=%s: %s', i, x, y, e)
-                    raise
-
-            self.txt_file.close()
-            if self.coord_file:
-                self.coord_file.close()
+            logger.info('Converting %s spectra using %s process(es)', len(coordinates), processes)
+            if processes > 1:
+                self._convert_parallel(coordinates, processes, print_progress)
+            else:
+                self._convert_serial(coordinates, print_progress)
+            self._mark_converted()
 
             logger.info("Conversion finished successfully")
         else:
-            logger.info('File %s already exists', self.txt_path)
+            logger.info('File %s already exists', self.spectra_path)
+
+
+def _init_worker(parser_factory, ms_file_path):
+    """ Parse the mass spec file metadata once per worker process instead of once per part """
+    global _worker_parser
+    _worker_parser = parser_factory(ms_file_path)
+
+
+def _convert_part(args):
+    """ Convert spectra from the [start, stop) index range. Runs in a worker process
+    initialized with _init_worker
+
+    Returns
+    -------
+    : sm.engine.spectra_stats.SpectraStats
+        Statistics of the converted part
+    """
+    converter, start, stop = args
+    converter.parser = _worker_parser
+    converter._open_spectra_file()
+    for i in range(start, stop):
+        try:
+            converter.parse_save_spectrum(i, None, None)
+        except Exception as e:
+            logger.error('Spectrum parsing failed i=%s: %s', i, e)
+            raise
+    converter._close_spectra_file()
+    return converter.stats
@@ -1,45 +1,37 @@
 import sys
+import json
 from collections import defaultdict
-import pandas as pd
+from os import makedirs
+from os.path import exists
 import numpy as np
-from scipy.sparse import coo_matrix
+import pandas as pd
 import logging
 
-from sm.engine.errors import JobFailedError
+from sm.engine.errors import SMError
+from sm.engine.spectra_stats import MAX_MZ_VALUE, MAX_INTENS_VALUE
+from sm.engine.util import SMConfig, read_json
+from sm.engine.sparse_image import SparseImage
+from sm.engine.search_plan import SearchPlan
 
-MAX_MZ_VALUE = 10**5
-MAX_INTENS_VALUE = 10**12
 ABS_MZ_TOLERANCE_DA = 0.002
+# defaults of the principal peak image thresholds, see principal_image_filter
+PRINCIPAL_MIN_PX = 1
+PRINCIPAL_MIN_INT = 0.
 
 logger = logging.getLogger('engine')
 
 
-def _check_spectra_quality(spectra_sample):
-    err_msgs = []
-
-    mz_arr = np.concatenate([sp[1] for sp in spectra_sample])
-    wrong_mz_n = mz_arr[(mz_arr < 0) | (mz_arr > MAX_MZ_VALUE)].shape[0]
-    if wrong_mz_n > 0:
-        err_msgs.append('Sample mz arrays contain {} values outside of allowed range [0, {}]'\
-                        .format(wrong_mz_n, MAX_MZ_VALUE))
-
-    int_arr = np.concatenate([sp[2] for sp in spectra_sample])
-    wrong_int_n = mz_arr[(int_arr < 0) | (int_arr > MAX_INTENS_VALUE)].shape[0]
-    if wrong_int_n > 0:
-        err_msgs.append('Sample intensity arrays contain {} values outside of allowed range [0, {}]'\
-                        .format(wrong_int_n, MAX_INTENS_VALUE))
-
-    if len(err_msgs) > 0:
-        raise JobFailedError(' '.join(err_msgs))
-
-
-def _estimate_mz_workload(spectra_sample, sf_peak_df, bins=1000):
-    mz_arr = np.sort(np.concatenate([sp[1] for sp in spectra_sample]))
-    mz_arr = mz_arr[(np.isfinite(mz_arr)) & (np.isnan(mz_arr) == False)]
-    mz_range = (mz_arr.min(), mz_arr.max())
-    spectrum_mz_freq, mz_grid = np.histogram(mz_arr, bins=bins, range=mz_range)
-    sf_peak_mz_freq, _ = np.histogram(sf_peak_df.mz, bins=bins, range=mz_range)
-    workload_per_mz = spectrum_mz_freq * sf_peak_mz_freq
+def _estimate_mz_workload(spectra_stats, sf_peak_df, bins=1000):
+    """ Rebin the full resolution dataset m/z histogram and weight it with the ion peak m/z histogram """
+    hist_edges, hist_counts = spectra_stats.mz_histogram()
+    mz_range = (hist_edges[0], hist_edges[-1])
+    hist_centers = (hist_edges[:-1] + hist_edges[1:]) / 2
+    spectrum_mz_freq, mz_grid = np.histogram(hist_centers, bins=bins, range=mz_range, weights=hist_counts)
+    if sf_peak_df is None:
+        workload_per_mz = spectrum_mz_freq
+    else:
+        sf_peak_mz_freq, _ = np.histogram(sf_peak_df.mz, bins=bins, range=mz_range)
+        workload_per_mz = spectrum_mz_freq * sf_peak_mz_freq
     return mz_grid, workload_per_mz, spectrum_mz_freq
 
 
@@ -74,10 +66,51 @@ def _segment_spectrum(sp, mz_buckets):
         yield s_i, (sp_id, mzs[smask], ints[smask])
 
 
-def _sp_df_gen(sp_it, sp_indexes):
-    for sp_id, mzs, intensities in sp_it:
-        for mz, ints in zip(mzs, intensities):
-            yield sp_indexes[sp_id], mz, ints
+def _segment_arrays(sp_it, sp_indexes):
+    """ Spectra of one m/z segment -> (pixel indices, m/z values, intensities) arrays sorted by m/z """
+    inds_list, mzs_list, ints_list = [np.zeros(0, dtype=np.int32)], [np.zeros(0)], [np.zeros(0)]
+    for sp_id, mzs, ints in sp_it:
+        inds_list.append(np.full(mzs.shape[0], sp_indexes[sp_id], dtype=np.int32))
+        mzs_list.append(mzs)
+        ints_list.append(ints)
+    mzs = np.concatenate(mzs_list)
+    order = np.argsort(mzs, kind='mergesort')
+    return np.concatenate(inds_list)[order], mzs[order], np.concatenate(ints_list)[order]
+
+
+def _segment_partition(segm_i):
+    """ Partition function keeping segment i in partition i """
+    return segm_i
+
+
+def _single_value(value_it):
+    """ The only value of a segment """
+    values = list(value_it)
+    if len(values) != 1:
+        raise SMError('One value per segment expected, {} found'.format(len(values)))
+    return values[0]
+
+
+def _partition_by_segment(rdd, segm_n, segment_value):
+    """ RDD of (segment index, value) -> RDD with partition i holding exactly one (i, segment_value(values)) pair.
+    RDDs partitioned this way are combined with _zip_segments without a shuffle
+    """
+    def segment_values(segm_i, item_it):
+        yield segm_i, segment_value(value for _, value in item_it)
+
+    return (rdd
+            .partitionBy(segm_n, _segment_partition)
+            .mapPartitionsWithIndex(segment_values, preservesPartitioning=True))
+
+
+def _zip_segments(*segm_rdds):
+    """ Combine RDDs with one pair per segment partition, see _partition_by_segment,
+    into RDD of (segment index, tuple of the segment values)
+    """
+    zipped = segm_rdds[0].mapValues(lambda value: (value,))
+    for segm_rdd in segm_rdds[1:]:
+        zipped = zipped.zip(segm_rdd).map(lambda pairs: (pairs[0][0], pairs[0][1] + (pairs[1][1],)))
+    return zipped
 
 
 # def _create_lower_upper_mz_bounds(sf_peak_df, ppm):
@@ -92,109 +125,401 @@ def _sp_df_gen(sp_it, sp_indexes):
 #     return lower, upper
 
 
-def _gen_iso_images(spectra_it, sp_indexes, centr_df, nrows, ncols, ppm, min_px=1):
-    if len(centr_df) > 0:
-        # a bit slower than using pure numpy arrays but much shorter
-        # may leak memory because of https://github.com/pydata/pandas/issues/2659 or smth else
-        sp_df = pd.DataFrame(_sp_df_gen(spectra_it, sp_indexes),
-                             columns=['idx', 'mz', 'ints']).sort_values(by='mz')
+def _gen_iso_images(segm_arrays, centr_df, nrows, ncols, ppm, min_px=1):
+    """ Generate isotopic peak images for centroids falling into the m/z segment.
+    Centroid m/z windows are located with one vectorized search, so the loop only slices arrays
+    and creates images
 
+    Args
+    ----
+    segm_arrays : tuple
+        Pixel indices, m/z values and intensities of the segment peaks sorted by m/z
+    """
+    sp_inds, sp_mzs, sp_ints = segm_arrays
+    if len(centr_df) > 0 and sp_mzs.shape[0] > 0:
+        centr_mzs = centr_df.mz.values
         # -1, + 1 are needed to extend sf_peak_mz range so that it covers 100% of spectra
-        # sf_peak_df = sf_peak_df[(sf_peak_df.mz >= sp_df.mz.min()-1) & (sf_peak_df.mz <= sp_df.mz.max()+1)]
-        # lower, upper = _create_lower_upper_mz_bounds(sf_peak_df, ppm)
-        centr_df = centr_df[(centr_df.mz >= sp_df.mz.min() - 1) &
-                            (centr_df.mz <= sp_df.mz.max() + 1)]
-        lower = centr_df.mz.map(lambda mz: mz - mz * ppm * 1e-6)
-        upper = centr_df.mz.map(lambda mz: mz + mz * ppm * 1e-6)
-        lower_idx = np.searchsorted(sp_df.mz, lower, 'l')
-        upper_idx = np.searchsorted(sp_df.mz, upper, 'r')
-
-        for i, (l, u) in enumerate(zip(lower_idx, upper_idx)):
-            if u - l >= min_px:
-                data = sp_df.ints[l:u].values
-                if data.shape[0] > 0:
-                    idx = sp_df.idx[l:u].values
-                    row_inds = idx / ncols
-                    col_inds = idx % ncols
-                    m = coo_matrix((data, (row_inds, col_inds)), shape=(nrows, ncols))
-                    yield centr_df.index[i], (centr_df.peak_i.iloc[i], m)
+        centr_mask = (centr_mzs >= sp_mzs[0] - 1) & (centr_mzs <= sp_mzs[-1] + 1)
+        centr_mzs = centr_mzs[centr_mask]
+        ion_keys = centr_df.index[centr_mask]
+        peak_inds = centr_df.peak_i.values[centr_mask]
+
+        lower_idx = np.searchsorted(sp_mzs, centr_mzs - centr_mzs * ppm * 1e-6, 'left')
+        upper_idx = np.searchsorted(sp_mzs, centr_mzs + centr_mzs * ppm * 1e-6, 'right')
+
+        for i in np.nonzero(upper_idx - lower_idx >= max(min_px, 1))[0]:
+            l, u = lower_idx[i], upper_idx[i]
+            img = SparseImage.from_pixels(sp_inds[l:u], sp_ints[l:u], (nrows, ncols))
+            yield ion_keys[i], (peak_inds[i], img)
 
 
 def _img_pairs_to_list(pairs, shape):
-    """ list of (coord, value) pairs -> list of values """
+    """ list of (peak index, image) pairs -> list of images indexed by peak, None for peaks without image.
+    Every peak is imaged once, by the segment owning it
+    """
     if not pairs:
         return None
 
-    d = defaultdict(lambda: coo_matrix(shape))
-    for k, m in pairs:
-        _m = d[k]
-        d[k] = _m if _m.nnz >= m.nnz else m
-    distinct_pairs = d.items()
+    res = [None] * (max(k for k, _ in pairs) + 1)
+    for k, img in pairs:
+        res[k] = img
+    return res
 
-    res = np.ndarray((max(d.keys()) + 1,), dtype=object)
-    for i, m in distinct_pairs:
-        res[i] = m
-    return res.tolist()
 
+def filter_occupied_ions(ion_centroids_df, spectra_stats, ppm):
+    """ Drop ions without dataset peaks within the ppm tolerance of their principal peak.
+    The measure of chaos of an empty principal peak image is zero, so such ions can only get zero msm.
+    Ions without metrics are counted with zero msm by FDR estimation
 
-def define_mz_segments(spectra, sf_peak_df, ppm):
-    first_spectrum = spectra.take(1)[0]
-    spectra_n = spectra.count()
-    if first_spectrum[1].shape[0] > 10**5:
-        spectra_sample = [first_spectrum]
-    else:
-        n = min(200, max(1, spectra_n // 10))
-        spectra_sample = spectra.takeSample(withReplacement=False, num=n)
-    _check_spectra_quality(spectra_sample)
+    Args
+    ----
+    ion_centroids_df : pandas.DataFrame
+        Ion peaks indexed by ion_i
+    spectra_stats : sm.engine.spectra_stats.SpectraStats
+    ppm : int
+
+    Returns
+    -------
+    : pandas.DataFrame
+        Peaks of the ions that may match
+    """
+    principal_peaks = ion_centroids_df[ion_centroids_df.peak_i == 0]
+    occupied = spectra_stats.mz_occupied(principal_peaks.mz.values, ppm)
+    occupied_ion_inds = principal_peaks.index[occupied]
+    logger.info('%s of %s ions have dataset peaks within %s ppm of their principal peak',
+                occupied_ion_inds.shape[0], principal_peaks.shape[0], ppm)
+    return ion_centroids_df[ion_centroids_df.index.isin(occupied_ion_inds)]
+
+
+def define_mz_segments(spectra_stats, sf_peak_df, ppm, segm_n=None):
+    """ Split the m/z axis into segments with even spectra and imaging workload
+
+    Args
+    ----
+    spectra_stats : sm.engine.spectra_stats.SpectraStats
+        Dataset statistics, no pass over the spectra is needed
+    sf_peak_df : pandas.DataFrame | None
+        Ion peaks. If None, only the spectra workload is balanced which makes segments
+        independent of the molecular database
+    ppm : int
+    segm_n : int
+        Planned number of segments, derived from the number of peaks if not given
 
-    peaks_per_sp = max(1, int(np.mean([mzs.shape[0] for (sp_id, mzs, ints) in spectra_sample])))
-    plan_mz_segm_n = (spectra_n * peaks_per_sp) // 10**6  # 1M peaks per segment
-    plan_mz_segm_n = int(np.clip(plan_mz_segm_n, 32, 2048))
+    Returns
+    -------
+    : list
+        List of (left, right) m/z segment bounds
+    """
+    spectra_stats.check_quality()
 
-    mz_grid, workload_per_mz, sp_workload_per_mz = _estimate_mz_workload(spectra_sample, sf_peak_df, bins=10**4)
+    if segm_n:
+        plan_mz_segm_n = segm_n
+    else:
+        plan_mz_segm_n = spectra_stats.peaks_n // 10**6  # 1M peaks per segment
+        plan_mz_segm_n = int(np.clip(plan_mz_segm_n, 32, 2048))
+
+    mz_grid, workload_per_mz, sp_workload_per_mz = _estimate_mz_workload(spectra_stats, sf_peak_df, bins=10**4)
     mz_bounds = _define_mz_bounds(mz_grid, workload_per_mz, sp_workload_per_mz, n=plan_mz_segm_n)
     mz_segments = _create_mz_segments(mz_bounds, ppm=ppm)
     logger.debug('Generated m/z segments: %s', mz_segments)
     return mz_segments
 
 
-def gen_iso_peak_images(sc, ds_reader, ion_centroids_df, segm_spectra, ppm):
+def _load_segment_files(sc, ds_reader, ppm):
+    spectra_wd = ds_reader.spectra_wd
+    meta_path = spectra_wd.local_dir.segments_meta_path
+    if not exists(meta_path) and not spectra_wd.local_fs_only:
+        remote_dir = spectra_wd.remote_dir
+        if remote_dir.exists(remote_dir.segments_meta_path):
+            remote_dir.download(remote_dir.segments_meta_path, meta_path)
+    if exists(meta_path):
+        meta = read_json(meta_path)
+        if meta['ppm'] >= ppm:
+            mz_segments = [tuple(segm) for segm in meta['mz_segments']]
+            logger.info('Reading %s m/z segment files from %s', len(mz_segments), spectra_wd.segments_path)
+            return mz_segments, _read_segment_files(sc, spectra_wd.segments_path, len(mz_segments))
+    return None
+
+
+def _read_segment_files(sc, path, segm_n):
+    """ Read segment files and move each segment to its own partition. File splits are not
+    guaranteed to follow segments, so the segments are partitioned by index after reading
+    """
+    return _partition_by_segment(sc.pickleFile(path), segm_n, _single_value)
+
+
+def _save_segment_files(sc, ds_reader, ppm, segm_n=None):
+    """ Split spectra into m/z segments, sort each by m/z and store one file per segment """
+    spectra_wd = ds_reader.spectra_wd
+    spectra_wd.clean_segments()
+
+    mz_segments = define_mz_segments(ds_reader.get_spectra_stats(), None, ppm, segm_n)
+    logger.info('Writing %s m/z segment files to %s', len(mz_segments), spectra_wd.segments_path)
     sp_indexes_brcast = sc.broadcast(ds_reader.get_norm_img_pixel_inds())
-    ion_centroids_df_brcast = sc.broadcast(ion_centroids_df)  # TODO: replace broadcast variable with rdd and cogroup
+    segm_peaks = ds_reader.get_spectra().flatMap(lambda sp: _segment_spectrum(sp, mz_segments))
+    segm_arrays = _partition_by_segment(segm_peaks, len(mz_segments),
+                                        lambda sp_it: _segment_arrays(sp_it, sp_indexes_brcast.value))
+    segm_arrays.saveAsPickleFile(spectra_wd.segments_path)
+
+    # the description is written last and marks the segment files as complete
+    meta_path = spectra_wd.local_dir.segments_meta_path
+    makedirs(spectra_wd.local_dir.ds_path, exist_ok=True)
+    with open(meta_path, 'w') as f:
+        json.dump({'ppm': ppm, 'mz_segments': mz_segments}, f)
+    if not spectra_wd.local_fs_only:
+        spectra_wd.remote_dir.copy(meta_path, spectra_wd.remote_dir.segments_meta_path)
+
+
+def get_segment_files(sc, ds_reader, ppm, segm_n=None):
+    """ Read dataset peaks split into m/z segment files, writing the files first if needed.
+    The files are reused by all later jobs on the same converted spectra
+
+    Returns
+    -------
+    : tuple
+        List of m/z segments and RDD of (segment index, (pixel indices, m/z values, intensities)),
+        see _partition_by_segment
+    """
+    res = _load_segment_files(sc, ds_reader, ppm)
+    if res is None:
+        _save_segment_files(sc, ds_reader, ppm, segm_n)
+        res = _load_segment_files(sc, ds_reader, ppm)
+    return res
+
+
+def _segment_centroids(ion_centroids_df, mz_segments, ppm):
+    """ Assign each centroid to exactly one owner segment. A centroid is owned by the first segment
+    covering its whole ppm window, segments overlap by at least ppm so that segment has all peaks the image needs.
+    Ions with all centroid windows covered by the segment owning their first given peak (the principal one
+    unless only other peaks are imaged) are owned by it as a whole, images of such ions are complete within one segment
+
+    Returns
+    -------
+    : list
+        (segment index, centroids DataFrame with the 'complete' ion flag) pairs, one per segment
+    """
+    segm_lefts = np.array([l for l, _ in mz_segments])
+    segm_rights = np.array([r for _, r in mz_segments])
+    mzs = ion_centroids_df.mz.values
+    segm_inds = np.maximum(np.searchsorted(segm_lefts, mzs - mzs * ppm * 1e-6, 'right') - 1, 0)
+
+    ion_inds = ion_centroids_df.index.values
+    peak_inds = ion_centroids_df.peak_i.values
+    first_mask = peak_inds == pd.Series(peak_inds, index=ion_inds).groupby(level=0).transform('min').values
+    ion_segm = pd.Series(segm_inds[first_mask], index=ion_inds[first_mask])
+    ion_mz_min = pd.Series(mzs, index=ion_inds).groupby(level=0).min()
+    ion_mz_max = pd.Series(mzs, index=ion_inds).groupby(level=0).max()
+    ion_segm = ion_segm.reindex(ion_mz_max.index).fillna(-1).astype(int)
+    ion_complete = ((ion_segm >= 0)
+                    & (ion_mz_min * (1 - ppm * 1e-6) >= segm_lefts[ion_segm.values])
+                    & (ion_mz_max * (1 + ppm * 1e-6) <= segm_rights[ion_segm.values]))
+
+    complete = ion_complete.reindex(ion_inds).values
+    segm_inds = np.where(complete, ion_segm.reindex(ion_inds).values, segm_inds)
+    centr_df = ion_centroids_df.assign(complete=complete)
+    segm_centr_dfs = dict(list(centr_df.groupby(segm_inds)))
+    return [(segm_i, segm_centr_dfs.get(segm_i, centr_df.iloc[:0])) for segm_i in range(len(mz_segments))]
+
+
+def _ion_segments(segm_centroids):
+    """ Ion ids sorted and the indices of the segments owning their centroids, one pair per ion and segment """
+    ions = [df.index.unique().values for _, df in segm_centroids]
+    segms = [np.full(ion_ids.shape[0], segm_i) for (segm_i, _), ion_ids in zip(segm_centroids, ions)]
+    if not ions:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    ions, segms = np.concatenate(ions), np.concatenate(segms)
+    order = np.argsort(ions, kind='mergesort')
+    return ions[order], segms[order]
+
+
+def partition_centroids(sc, ion_centroids_df, mz_segments, ppm):
+    """ Partition centroids by the segment owning them, see _segment_centroids
+
+    Returns
+    -------
+    : tuple
+        RDD of (segment index, centroids DataFrame), see _partition_by_segment,
+        and the segments owning centroids of each ion, see _ion_segments
+    """
+    segm_n = len(mz_segments)
+    segm_centroids = _segment_centroids(ion_centroids_df, mz_segments, ppm)
+    segm_centroids_rdd = _partition_by_segment(sc.parallelize(segm_centroids, numSlices=segm_n),
+                                               segm_n, _single_value)
+    return segm_centroids_rdd, _ion_segments(segm_centroids)
+
+
+def gen_principal_images(ds_reader, segm_arrays, segm_centroids, ppm, passes):
+    """ Generate principal peak images of the ions owned by each segment, first phase of imaging
+
+    Args
+    ----
+    segm_centroids : pyspark.rdd.RDD
+        Centroids partitioned by segment, see partition_centroids
+    passes : function
+        Principal image check, see principal_image_filter
+
+    Returns
+    -------
+    : pyspark.rdd.RDD
+        RDD of (segment index, list of (ion, complete, principal image)), see _partition_by_segment.
+        Only images passing the check are kept
+    """
     nrows, ncols = ds_reader.get_dims()
 
+    def principal_images(arrays_centroids):
+        arrays, centr_df = arrays_centroids
+        centr_df = centr_df[centr_df.peak_i.values == 0]
+        images = []
+        for complete in [True, False]:
+            ion_images = _gen_iso_images(arrays, centr_df[centr_df.complete.values == complete], nrows, ncols, ppm)
+            images.extend((ion, complete, img) for ion, (_, img) in ion_images if passes(img))
+        return images
+
+    return _zip_segments(segm_arrays, segm_centroids).mapValues(principal_images)
+
+
+def _gen_segment_ion_images(segm_arrays, centr_df, principal_images, nrows, ncols, ppm):
+    """ Generate images of the other peaks owned by the segment and add the principal images of the segment
+
+    Returns
+    -------
+    : generator
+        (ion, (True, list of images)) for ions complete within the segment,
+        (ion, (False, (peak index, image))) for the others
+    """
+    complete_pairs = defaultdict(list)
+    for ion, complete, img in principal_images:
+        if complete:
+            complete_pairs[ion].append((0, img))
+        else:
+            yield ion, (False, (0, img))
+
+    complete_mask = centr_df.complete.values
+    for ion, pair in _gen_iso_images(segm_arrays, centr_df[complete_mask], nrows, ncols, ppm):
+        complete_pairs[ion].append(pair)
+    for ion, pairs in complete_pairs.items():
+        yield ion, (True, _img_pairs_to_list(pairs, (nrows, ncols)))
+    for ion, pair in _gen_iso_images(segm_arrays, centr_df[~complete_mask], nrows, ncols, ppm):
+        yield ion, (False, pair)
+
+
+def gen_iso_peak_images(sc, ds_reader, segm_arrays, segm_centroids, ion_segments, principal_images, ppm):
+    """ Generate images of the other isotope peaks of ions with a passed principal image, second phase of imaging.
+    Segment arrays, centroids and principal images are partitioned the same way and zipped, images of ions
+    complete within one segment are merged by it. Only ids of the other passed ions are sent to
+    the segments owning their other centroids
+
+    Args
+    ----
+    segm_centroids : pyspark.rdd.RDD
+    ion_segments : tuple
+        See partition_centroids
+    principal_images : pyspark.rdd.RDD
+        See gen_principal_images
+
+    Returns
+    -------
+    : pyspark.rdd.RDD
+        RDD of (ion, (complete, images)), see _gen_segment_ion_images
+    """
+    nrows, ncols = ds_reader.get_dims()
+    segm_n = segm_arrays.getNumPartitions()
+    ion_segms_brcast = sc.broadcast(ion_segments)
+
+    def segment_ion_ids(item):
+        segm_i, images = item
+        ions = np.array([ion for ion, complete, _ in images if not complete], dtype=np.int64)
+        segm_ions, segms = ion_segms_brcast.value
+        lefts = np.searchsorted(segm_ions, ions, 'left')
+        rights = np.searchsorted(segm_ions, ions, 'right')
+        for ion, l, r in zip(ions, lefts, rights):
+            for other_segm_i in segms[l:r]:
+                if other_segm_i != segm_i:
+                    yield int(other_segm_i), int(ion)
+
+    segm_ion_ids = _partition_by_segment(principal_images.flatMap(segment_ion_ids), segm_n,
+                                         lambda ion_it: np.fromiter(ion_it, dtype=np.int64))
+
     def generate_images_for_segment(item):
-        _, sp_segm = item
-        return _gen_iso_images(sp_segm, sp_indexes_brcast.value, ion_centroids_df_brcast.value,
-                               nrows, ncols, ppm)
-    iso_peak_images = segm_spectra.flatMap(generate_images_for_segment)
-    return iso_peak_images
+        _, (arrays, centr_df, images, ions) = item
+        ions = np.concatenate([np.array([ion for ion, _, _ in images], dtype=np.int64), ions])
+        centr_df = centr_df[(centr_df.peak_i.values > 0) & centr_df.index.isin(ions)]
+        return _gen_segment_ion_images(arrays, centr_df, images, nrows, ncols, ppm)
 
+    return (_zip_segments(segm_arrays, segm_centroids, principal_images, segm_ion_ids)
+            .flatMap(generate_images_for_segment))
 
-def gen_iso_sf_images(iso_peak_images, shape):
-    iso_sf_images = (iso_peak_images
-                     .groupByKey(numPartitions=256)
-                     .mapValues(lambda img_pairs_it: _img_pairs_to_list(list(img_pairs_it), shape)))
-    return iso_sf_images
 
+def principal_image_filter(img_gen_config):
+    """ Returns a function checking if a principal peak image passes the thresholds set by
+    the 'principal_min_px' and 'principal_min_int' image_generation options. Options missing in the
+    dataset config are taken from 'defaults.image_generation' of the engine config, then from
+    PRINCIPAL_MIN_PX and PRINCIPAL_MIN_INT. With these only ions with an empty principal image
+    are rejected, their msm is zero anyway
+    """
+    defaults = SMConfig.get_conf().get('defaults', {}).get('image_generation', {})
+    min_px = img_gen_config.get('principal_min_px', defaults.get('principal_min_px', PRINCIPAL_MIN_PX))
+    min_int = img_gen_config.get('principal_min_int', defaults.get('principal_min_int', PRINCIPAL_MIN_INT))
 
-# TODO: add tests
-def compute_sf_images(sc, ds_reader, ion_centroids_df, ppm):
-    """ Compute isotopic images for all formulas
+    def passes(img):
+        return img.nnz >= min_px and img.sum() >= min_int
+
+    return passes
+
+
+def gen_iso_sf_images(iso_peak_images, shape, partitions=256):
+    """ Group isotope peak images by ion. Images of ions complete within one segment are passed through,
+    only images of ions spanning several segments are shuffled
+
+    Args
+    ----
+    iso_peak_images : pyspark.rdd.RDD
+        RDD of (ion, (complete, images)) generated by gen_iso_peak_images
+    shape : tuple
+    partitions : int
+        Number of partitions for grouping images of ions spanning several segments
 
     Returns
-    ----------
+    -------
     : pyspark.rdd.RDD
-        RDD of sum formula, list[sparse matrix of intensities]
+        RDD of (ion, list[sm.engine.sparse_image.SparseImage])
     """
-    spectra_rdd = ds_reader.get_spectra()
+    complete_images = (iso_peak_images
+                       .filter(lambda item: item[1][0])
+                       .mapValues(lambda complete_images: complete_images[1]))
+    grouped_images = (iso_peak_images
+                      .filter(lambda item: not item[1][0])
+                      .mapValues(lambda complete_pair: complete_pair[1])
+                      .groupByKey(numPartitions=partitions)
+                      .mapValues(lambda img_pairs_it: _img_pairs_to_list(list(img_pairs_it), shape)))
+    return complete_images.union(grouped_images)
+
 
-    mz_segments = define_mz_segments(spectra_rdd, ion_centroids_df, ppm)
-    segm_spectra = (spectra_rdd
-                    .flatMap(lambda sp: _segment_spectrum(sp, mz_segments))
-                    .groupByKey(numPartitions=len(mz_segments)))
+def get_segment_arrays(sc, ds_reader, ion_centroids_df, ppm, plan=None):
+    """ Dataset peaks split into m/z segments
 
-    iso_peak_images = gen_iso_peak_images(sc, ds_reader, ion_centroids_df, segm_spectra, ppm)
-    iso_sf_images = gen_iso_sf_images(iso_peak_images, shape=ds_reader.get_dims())
+    With the 'mz_segment_files' option the spectra are read from m/z segment files
+    instead of being shuffled into segments by every job
 
-    return iso_sf_images
+    Args
+    ----
+    plan : sm.engine.search_plan.SearchPlan
+        Number of segments, the default is used if not given
+
+    Returns
+    -------
+    : tuple
+        List of m/z segments and RDD of (segment index, (pixel indices, m/z values, intensities)),
+        see _partition_by_segment
+    """
+    plan = plan or SearchPlan()
+    if SMConfig.get_conf()['fs'].get('mz_segment_files', False):
+        mz_segments, segm_arrays = get_segment_files(sc, ds_reader, ppm, plan.mz_segment_n)
+    else:
+        spectra_rdd = ds_reader.get_spectra()
+        mz_segments = define_mz_segments(ds_reader.get_spectra_stats(), ion_centroids_df, ppm, plan.mz_segment_n)
+        sp_indexes_brcast = sc.broadcast(ds_reader.get_norm_img_pixel_inds())
+        segm_arrays = _partition_by_segment(spectra_rdd.flatMap(lambda sp: _segment_spectrum(sp, mz_segments)),
+                                            len(mz_segments),
+                                            lambda sp_it: _segment_arrays(sp_it, sp_indexes_brcast.value))
+    return mz_segments, segm_arrays
@@ -4,13 +4,18 @@ Classes and functions for isotope image validation
 import numpy as np
 import pandas as pd
 from operator import mul, add
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+from itertools import islice
 
 from pyImagingMSpec.image_measures import isotope_image_correlation, isotope_pattern_match
 # from pyImagingMSpec.image_measures import measure_of_chaos
 from cpyImagingMSpec import measure_of_chaos
 from pyImagingMSpec import smoothing
 
+METRICS_BATCH_SIZE = 1000
+SPARSE_SCORING_MAX_DENSITY = 0.25
+METRICS_BATCH_MAX_COLUMNS = 10**7
+
 
 class ImgMetrics(object):
     """ Container for isotope image metrics
@@ -55,16 +60,30 @@ class ImgMetrics(object):
             return tuple(self.map.values())
 
 
-def get_compute_img_metrics(metrics, sample_area_mask, empty_matrix, img_gen_conf):
+def _sampled_pixel_vector(img, sampled_pixel_inds):
+    """ Image intensities at the sampled pixels only, in the order of sampled_pixel_inds """
+    vec = np.zeros(sampled_pixel_inds.shape[0])
+    if img is not None and img.nnz > 0:
+        pos = np.searchsorted(sampled_pixel_inds, img.inds)
+        pos[pos == sampled_pixel_inds.shape[0]] = 0
+        valid = sampled_pixel_inds[pos] == img.inds
+        vec[pos[valid]] = img.vals[valid]
+    return vec
+
+
+def get_compute_img_metrics(metrics, sampled_pixel_inds, shape, img_gen_conf):
     """ Returns a function for computing isotope image metrics
 
+    Images are compared as vectors over the sampled pixels only, a dense 2D image is built
+    just for the measure of chaos of the principal peak image
+
     Args
     ------------
     metrics: OrderedDict
-    sample_area_mask: ndarray[bool]
-        mask for separating sampled pixels (True) from non-sampled (False)
-    empty_matrix : ndarray
-        empty matrix of the same shape as isotope images
+    sampled_pixel_inds: ndarray
+        sorted flat indices of pixels where spectra were sampled
+    shape : tuple
+        number of rows and columns of isotope images
     img_gen_conf : dict
         isotope_generation section of the dataset config
     Returns
@@ -76,29 +95,196 @@ def get_compute_img_metrics(metrics, sample_area_mask, empty_matrix, img_gen_con
         np.seterr(invalid='ignore')  # to ignore division by zero warnings
 
         diff = len(sf_ints) - len(iso_images_sparse)
-        iso_imgs = [empty_matrix if img is None else img.toarray()
-                    for img in iso_images_sparse + [None] * diff]
-        iso_imgs_flat = [img.flat[:][sample_area_mask] for img in iso_imgs]
-
-        if img_gen_conf['do_preprocessing']:
-            for img in iso_imgs_flat:
-                smoothing.hot_spot_removal(img)
+        iso_images_sparse = iso_images_sparse + [None] * diff
 
         m = ImgMetrics(metrics)
-        if len(iso_imgs) > 0:
+        if len(iso_images_sparse) > 0:
+            iso_imgs_flat = [_sampled_pixel_vector(img, sampled_pixel_inds) for img in iso_images_sparse]
+            if img_gen_conf['do_preprocessing']:
+                for img in iso_imgs_flat:
+                    smoothing.hot_spot_removal(img)
             m.map['spectral'] = isotope_pattern_match(iso_imgs_flat, sf_ints)
             m.map['spatial'] = isotope_image_correlation(iso_imgs_flat, weights=sf_ints[1:])
-            moc = measure_of_chaos(iso_imgs[0], img_gen_conf['nlevels'])
+
+        if len(iso_images_sparse) > 0:
+            first_img = iso_images_sparse[0]
+            moc = measure_of_chaos(np.zeros(shape) if first_img is None else first_img.toarray(),
+                                   img_gen_conf['nlevels'])
             m.map['chaos'] = 0 if np.isclose(moc, 1.0) else moc
 
-            m.map['total_iso_ints'] = [img.sum() for img in iso_imgs]
-            m.map['min_iso_ints'] = [img.min() for img in iso_imgs]
-            m.map['max_iso_ints'] = [img.max() for img in iso_imgs]
+            # reductions over the whole image grid, non-sampled pixels count as zeros
+            m.map['total_iso_ints'] = [0. if img is None else img.sum() for img in iso_images_sparse]
+            m.map['min_iso_ints'] = [0. if img is None else img.min() for img in iso_images_sparse]
+            m.map['max_iso_ints'] = [0. if img is None else img.max() for img in iso_images_sparse]
         return m.to_tuple()
 
     return compute
 
 
+def _stack_iso_vectors(ion_images, n, sampled_pixel_inds):
+    """ Stack isotope images of a batch of ions into a matrix of compacted sampled pixel vectors.
+    A column is a sampled pixel of an ion where at least one of its images is non-zero,
+    columns of the same ion are contiguous
+
+    Returns
+    -------
+    : tuple
+        (n x columns matrix of intensities, ion index of each column)
+    """
+    sampled_n = sampled_pixel_inds.shape[0]
+    keys, rows, vals = [], [], []
+    for b, images in enumerate(ion_images):
+        for i, img in enumerate(images[:n]):
+            if img is not None and img.nnz > 0:
+                pos = np.searchsorted(sampled_pixel_inds, img.inds)
+                pos[pos == sampled_n] = 0
+                valid = sampled_pixel_inds[pos] == img.inds
+                keys.append(b * sampled_n + pos[valid])
+                rows.append(np.full(valid.sum(), i))
+                vals.append(img.vals[valid])
+    if not keys:
+        return np.zeros((n, 0)), np.zeros(0, dtype=int)
+
+    col_keys, cols = np.unique(np.concatenate(keys), return_inverse=True)
+    iso_vectors = np.zeros((n, col_keys.shape[0]))
+    iso_vectors[np.concatenate(rows), cols] = np.concatenate(vals)
+    return iso_vectors, col_keys // sampled_n
+
+
+def _stack_dense_iso_vectors(ion_images, n, sampled_pixel_inds):
+    """ Same as _stack_iso_vectors with all sampled pixels of every ion as columns. Cheaper for dense images,
+    no column has to be looked up
+    """
+    sampled_n = sampled_pixel_inds.shape[0]
+    iso_vectors = np.zeros((n, len(ion_images) * sampled_n))
+    for b, images in enumerate(ion_images):
+        for i, img in enumerate(images[:n]):
+            iso_vectors[i, b * sampled_n:(b + 1) * sampled_n] = _sampled_pixel_vector(img, sampled_pixel_inds)
+    return iso_vectors, np.repeat(np.arange(len(ion_images)), sampled_n)
+
+
+def _split_batch(batch, ion_columns, max_columns):
+    """ Split a batch of ions into chunks of at most max_columns stacked columns, at least one ion per chunk """
+    chunk, chunk_columns = [], 0
+    for item in batch:
+        if chunk and chunk_columns + ion_columns(item) > max_columns:
+            yield chunk
+            chunk, chunk_columns = [], 0
+        chunk.append(item)
+        chunk_columns += ion_columns(item)
+    if chunk:
+        yield chunk
+
+
+def _batch_isotope_pattern_match(iso_vectors, col_ions, theor_ints):
+    """ Vectorized pyImagingMSpec.image_measures.isotope_pattern_match for ions with the same number of peaks """
+    ion_n, n = theor_ints.shape
+    not_null = iso_vectors[0] > 0
+    image_ints = np.stack([np.bincount(col_ions, weights=iso_vectors[i] * not_null, minlength=ion_n)
+                           for i in range(n)], axis=1)
+    theor_norm = theor_ints / np.linalg.norm(theor_ints, axis=1)[:, None]
+    image_norm = image_ints / np.linalg.norm(image_ints, axis=1)[:, None]
+    pattern_match = 1 - np.mean(np.abs(theor_norm - image_norm), axis=1)
+    pattern_match[pattern_match == 1.] = 0
+    return pattern_match
+
+
+def _batch_isotope_image_correlation(iso_vectors, col_ions, theor_ints, sampled_n):
+    """ Vectorized pyImagingMSpec.image_measures.isotope_image_correlation for ions with the same number of peaks.
+    Pixels missing from the compacted vectors are zeros, their contribution to the centered sums is added analytically
+    """
+    ion_n, n = theor_ints.shape
+    if n < 2:
+        return np.zeros(ion_n)
+
+    col_n = np.bincount(col_ions, minlength=ion_n)
+    zero_n = sampled_n - col_n
+    means = np.stack([np.bincount(col_ions, weights=iso_vectors[i], minlength=ion_n)
+                      for i in range(n)]) / sampled_n
+    centered = iso_vectors - means[:, col_ions]
+
+    def centered_prod_sum(i, j):
+        return (np.bincount(col_ions, weights=centered[i] * centered[j], minlength=ion_n)
+                + zero_n * means[i] * means[j])
+
+    var_0 = centered_prod_sum(0, 0)
+    corr = np.stack([centered_prod_sum(0, i) / np.sqrt(var_0 * centered_prod_sum(i, i))
+                     for i in range(1, n)], axis=1)
+    corr[np.isinf(corr) | np.isnan(corr)] = 0
+
+    weights = theor_ints[:, 1:]
+    spatial = np.clip((corr * weights).sum(axis=1) / weights.sum(axis=1), 0, 1)
+    not_null_n = np.bincount(col_ions, weights=iso_vectors[0] > 0, minlength=ion_n)
+    spatial[not_null_n < 2] = 0
+    return spatial
+
+
+def get_compute_batch_img_metrics(metrics, sampled_pixel_inds, shape, img_gen_conf):
+    """ Returns a function for computing isotope image metrics of many ions at once
+
+    Ions with the same number of isotope peaks are scored together, their sampled pixel vectors
+    are stacked into one matrix and spectral and spatial scores are computed with matrix operations.
+    Vectors of ions with all images sparser than SPARSE_SCORING_MAX_DENSITY are compacted to the union
+    of their non-zero pixels, zero pixels are accounted for analytically.
+    The scores match the ones of get_compute_img_metrics
+
+    Args
+    ------------
+    metrics: OrderedDict
+    sampled_pixel_inds: ndarray
+        sorted flat indices of pixels where spectra were sampled
+    shape : tuple
+        number of rows and columns of isotope images
+    img_gen_conf : dict
+        isotope_generation section of the dataset config
+    Returns
+    ------------
+    : function
+        function that returns a list of (ion,) + metrics tuples for a list of (ion, isotope images) pairs
+    """
+    compute_metrics = get_compute_img_metrics(metrics, sampled_pixel_inds, shape, img_gen_conf)
+
+    def compute(ion_images, ion_centr_ints):
+        # hot spot removal clips at an intensity percentile of the full pixel vectors
+        if img_gen_conf['do_preprocessing']:
+            return [(ion,) + compute_metrics(images, ion_centr_ints[ion]) for ion, images in ion_images]
+
+        sampled_n = sampled_pixel_inds.shape[0]
+        batches = defaultdict(list)
+        for ion, images in ion_images:
+            n = len(ion_centr_ints[ion])
+            max_nnz = max([0] + [img.nnz for img in images[:n] if img is not None])
+            batches[(n, max_nnz > SPARSE_SCORING_MAX_DENSITY * sampled_n)].append((ion, images, max_nnz))
+
+        ion_metrics = {}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for (n, dense), ion_batch in batches.items():
+                stack = _stack_dense_iso_vectors if dense else _stack_iso_vectors
+                ion_columns = (lambda item: n * sampled_n) if dense else (lambda item: n * item[2])
+                for batch in _split_batch(ion_batch, ion_columns, METRICS_BATCH_MAX_COLUMNS):
+                    batch = [(ion, images) for ion, images, _ in batch]
+                    theor_ints = np.array([ion_centr_ints[ion] for ion, _ in batch], dtype=float)
+                    iso_vectors, col_ions = stack([images for _, images in batch], n, sampled_pixel_inds)
+                    spectral = _batch_isotope_pattern_match(iso_vectors, col_ions, theor_ints)
+                    spatial = _batch_isotope_image_correlation(iso_vectors, col_ions, theor_ints, sampled_n)
+
+                    for b, (ion, images) in enumerate(batch):
+                        images = images + [None] * (n - len(images))
+                        m = ImgMetrics(metrics.copy())
+                        m.map['spectral'] = spectral[b]
+                        m.map['spatial'] = spatial[b]
+                        moc = measure_of_chaos(np.zeros(shape) if images[0] is None else images[0].toarray(),
+                                               img_gen_conf['nlevels'])
+                        m.map['chaos'] = 0 if np.isclose(moc, 1.0) else moc
+                        m.map['total_iso_ints'] = [0. if img is None else img.sum() for img in images]
+                        m.map['min_iso_ints'] = [0. if img is None else img.min() for img in images]
+                        m.map['max_iso_ints'] = [0. if img is None else img.max() for img in images]
+                        ion_metrics[ion] = m.to_tuple()
+        return [(ion,) + ion_metrics[ion] for ion, _ in ion_images]
+
+    return compute
+
+
 def _calculate_msm(sf_metrics_df):
     return sf_metrics_df.chaos * sf_metrics_df.spatial * sf_metrics_df.spectral
 
@@ -118,17 +304,20 @@ def sf_image_metrics(sf_images, metrics, ds, ds_reader, ion_centr_ints, sc):
     ------------
     : pandas.DataFrame
     """
-    nrows, ncols = ds_reader.get_dims()
-    empty_matrix = np.zeros((nrows, ncols))
-    compute_metrics = get_compute_img_metrics(metrics, ds_reader.get_sample_area_mask(),
-                                              empty_matrix, ds.config['image_generation'])
+    sampled_pixel_inds = np.unique(ds_reader.get_norm_img_pixel_inds())
+    compute_metrics = get_compute_batch_img_metrics(metrics, sampled_pixel_inds, ds_reader.get_dims(),
+                                                    ds.config['image_generation'])
     sf_add_ints_map_brcast = sc.broadcast(ion_centr_ints)
 
-    def calculate_ion_metrics(item):
-        ion, images = item
-        return (ion,) + compute_metrics(images, sf_add_ints_map_brcast.value[ion])
+    def calculate_batch_metrics(ion_images_it):
+        ion_images_it = iter(ion_images_it)
+        while True:
+            ion_images = list(islice(ion_images_it, METRICS_BATCH_SIZE))
+            if not ion_images:
+                break
+            yield from compute_metrics(ion_images, sf_add_ints_map_brcast.value)
 
-    sf_metrics = sf_images.map(calculate_ion_metrics).collect()
+    sf_metrics = sf_images.mapPartitions(calculate_batch_metrics).collect()
     index_columns = ['ion_i']
     columns = index_columns + list(metrics.keys())
     sf_metrics_df = pd.DataFrame(sf_metrics, columns=columns).set_index(index_columns)
@@ -1,10 +1,14 @@
 from collections import OrderedDict
+import numpy as np
 import pandas as pd
 
 from sm.engine.util import SMConfig
-from sm.engine.msm_basic.formula_imager_segm import compute_sf_images
+from sm.engine.ion_centroids_gen import union_ion_centroids
+from sm.engine.msm_basic.formula_imager_segm import get_segment_arrays, partition_centroids, \
+    gen_principal_images, gen_iso_peak_images, gen_iso_sf_images, filter_occupied_ions, principal_image_filter
 from sm.engine.msm_basic.formula_img_validator import sf_image_metrics
 from sm.engine.search_algorithm import SearchAlgorithm
+from sm.engine.search_plan import SearchPlan
 
 import logging
 logger = logging.getLogger('engine')
@@ -12,7 +16,7 @@ logger = logging.getLogger('engine')
 
 class MSMBasicSearch(SearchAlgorithm):
 
-    def __init__(self, sc, ds, ds_reader, mol_db, centr_gen, fdr, ds_config):
+    def __init__(self, sc, ds, ds_reader, mol_db, centr_gen, fdr, ds_config, plan=None):
         super(MSMBasicSearch, self).__init__(sc, ds, ds_reader, mol_db, fdr, ds_config)
         self.metrics = OrderedDict([('chaos', 0), ('spatial', 0), ('spectral', 0),
                                     ('total_iso_ints', [0, 0, 0, 0]),
@@ -20,6 +24,7 @@ class MSMBasicSearch(SearchAlgorithm):
                                     ('max_iso_ints', [0, 0, 0, 0])])
         self.max_fdr = 0.5
         self._centr_gen = centr_gen
+        self._plan = plan
 
     def search(self):
         """ Search for molecules in the dataset
@@ -27,19 +32,91 @@ class MSMBasicSearch(SearchAlgorithm):
         Returns
         -------
         : tuple
-            (ion metrics DataFrame, ion image pyspark.RDD)
+            (ion metrics DataFrame, ion image pyspark.RDD). The images stay persisted until unpersist is called
         """
         logger.info('Running molecule search')
-        ion_centroids_df = self._centr_gen.centroids_subset(self._fdr.ion_tuples())
-        ion_images = compute_sf_images(self._sc, self._ds_reader, ion_centroids_df,
-                                       self.ds_config['image_generation']['ppm'])
-        ion_metrics_df = self.calc_metrics(ion_images, ion_centroids_df)
+        ion_centroids_df = self._centr_gen.centroids_subset(self._fdr.ion_index(), self._fdr.catalog)
+        ion_images, ion_metrics_df = self.compute_images_metrics(ion_centroids_df)
         ion_metrics_fdr_df = self.estimate_fdr(ion_metrics_df)
         ion_metrics_fdr_df = self.filter_sf_metrics(ion_metrics_fdr_df)
         ion_images = self.filter_sf_images(ion_images, ion_metrics_fdr_df)
 
         return ion_metrics_fdr_df, ion_images
 
+    def search_multi(self, centr_gens, fdrs):
+        """ Search for molecules of several databases at once. Images and metrics are computed
+        once for the union of all target and decoy ions, FDR is estimated for each database separately
+
+        Args
+        ----
+        centr_gens : list[sm.engine.ion_centroids_gen.IonCentroidsGenerator]
+        fdrs : list[sm.engine.fdr.FDR]
+            Decoy adducts selected for each database
+
+        Returns
+        -------
+        : tuple
+            (list of ion metrics DataFrames, one per database, images of ions from any of them)
+        """
+        logger.info('Running molecule search for %s databases', len(fdrs))
+        ion_df, ion_centroids_df = union_ion_centroids(centr_gens, [fdr.ion_index() for fdr in fdrs])
+        logger.info('%s unique ions to search for', ion_df.shape[0])
+        ion_images, ion_metrics_df = self.compute_images_metrics(ion_centroids_df)
+
+        ion_metrics_fdr_dfs = []
+        for fdr in fdrs:
+            db_ion_df = ion_df[np.isin(fdr.catalog.ion_ids(ion_df.sf, ion_df.adduct), fdr.ion_ids())]
+            db_ion_metrics_df = ion_metrics_df[ion_metrics_df.index.isin(db_ion_df.index)]
+            ion_metrics_fdr_df = self.estimate_fdr(db_ion_metrics_df, ion_df=db_ion_df, fdr=fdr)
+            ion_metrics_fdr_dfs.append(self.filter_sf_metrics(ion_metrics_fdr_df))
+        ion_images = self.filter_sf_images(ion_images, pd.concat(ion_metrics_fdr_dfs))
+
+        return ion_metrics_fdr_dfs, ion_images
+
+    def compute_images_metrics(self, ion_centroids_df):
+        """ Compute ion images and their metrics
+
+        Returns
+        -------
+        : tuple
+            (ion image pyspark.RDD, ion metrics DataFrame)
+        """
+        ion_centroids_df = self.filter_ions(ion_centroids_df)
+        # images are used both for metrics and for the upload of the filtered ones
+        ion_images = self.persist(self.compute_sf_images(ion_centroids_df))
+        ion_metrics_df = self.calc_metrics(ion_images, ion_centroids_df)
+        # segments and principal images are only needed until the images are computed
+        self.unpersist(keep=[ion_images])
+        return ion_images, ion_metrics_df
+
+    def compute_sf_images(self, ion_centroids_df):
+        """ Compute isotopic images in two phases. Principal peak images are generated for all ions,
+        images of the other peaks only for ions whose principal image passes the thresholds of
+        principal_image_filter. Both phases are keyed by the m/z segment owning the centroids, so images
+        of ions complete within one segment are merged with their principal images without a shuffle.
+        Rejected ions get no images and metrics, FDR estimation counts them with zero msm
+
+        Returns
+        -------
+        : pyspark.rdd.RDD
+            RDD of (ion, list[sm.engine.sparse_image.SparseImage])
+        """
+        ppm = self.ds_config['image_generation']['ppm']
+        shape = self._ds_reader.get_dims()
+        plan = self._plan or SearchPlan()
+        # segments are imaged in both phases
+        mz_segments, segm_arrays = get_segment_arrays(self._sc, self._ds_reader, ion_centroids_df, ppm, self._plan)
+        segm_arrays = self.persist(segm_arrays)
+        segm_centroids, ion_segments = partition_centroids(self._sc, ion_centroids_df, mz_segments, ppm)
+
+        passes = principal_image_filter(self.ds_config['image_generation'])
+        # principal images select the other peaks to image and are merged into the result
+        principal_images = self.persist(gen_principal_images(self._ds_reader, segm_arrays, segm_centroids,
+                                                             ppm, passes))
+        iso_peak_images = gen_iso_peak_images(self._sc, self._ds_reader, segm_arrays, segm_centroids,
+                                              ion_segments, principal_images, ppm)
+        return gen_iso_sf_images(iso_peak_images, shape=shape, partitions=plan.image_partitions)
+
     def calc_metrics(self, sf_images, ion_centroids_df):
         ion_centr_ints = (ion_centroids_df.reset_index().groupby(['ion_i'])
                           .apply(lambda df: df.int.tolist()).to_dict())
@@ -47,13 +124,30 @@ class MSMBasicSearch(SearchAlgorithm):
                                              ds_reader=self._ds_reader, ion_centr_ints=ion_centr_ints, sc=self._sc)
         return all_sf_metrics_df
 
-    def estimate_fdr(self, ion_metrics_df):
-        ion_metrics_sf_adduct_df = ion_metrics_df.join(self._centr_gen.ion_df)
-        sf_adduct_fdr_df = self._fdr.estimate_fdr(
-            ion_metrics_sf_adduct_df.set_index(['sf', 'adduct']).msm)
-        ion_metrics_sf_adduct_fdr_df = pd.merge(ion_metrics_sf_adduct_df.reset_index(),
-                                                sf_adduct_fdr_df.reset_index(),
-                                                how='inner', on=['sf', 'adduct']).set_index('ion_i')
+    def filter_ions(self, ion_centroids_df):
+        """ Skip imaging of ions that can't match any dataset peak """
+        return filter_occupied_ions(ion_centroids_df, self._ds_reader.get_spectra_stats(),
+                                    self.ds_config['image_generation']['ppm'])
+
+    def estimate_fdr(self, ion_metrics_df, ion_df=None, fdr=None):
+        """ Estimate FDR of the ions from their msm values
+
+        Args
+        ----
+        ion_df : pandas.DataFrame
+            sf and adduct of the ions, taken from the centroids generator if not given
+        fdr : sm.engine.fdr.FDR
+            Used instead of the search one if given
+        """
+        ion_df = self._centr_gen.ion_df if ion_df is None else ion_df
+        fdr = fdr or self._fdr
+        # (sf, adduct) pairs are mapped to catalog ion ids once, FDR and the results join work on them
+        ion_df = ion_df.assign(ion_id=fdr.catalog.ion_ids(ion_df.sf, ion_df.adduct))
+        ion_metrics_sf_adduct_df = ion_metrics_df.join(ion_df)
+        ion_fdr_df = fdr.estimate_ion_fdr(ion_metrics_sf_adduct_df.set_index('ion_id').msm)
+        ion_metrics_sf_adduct_fdr_df = (ion_metrics_sf_adduct_df
+                                        .join(ion_fdr_df, on='ion_id', how='inner')
+                                        .drop('ion_id', axis=1))
         return ion_metrics_sf_adduct_fdr_df
 
     def filter_sf_metrics(self, sf_metrics_df):
@@ -0,0 +1,134 @@
+"""
+
+:synopsis: Molecule search for small datasets on a single machine without Spark
+
+"""
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import logging
+
+from sm.engine.msm_basic.msm_basic_search import MSMBasicSearch
+from sm.engine.msm_basic.formula_imager_segm import _segment_arrays, _gen_iso_images, _img_pairs_to_list, \
+    principal_image_filter
+from sm.engine.msm_basic.formula_img_validator import get_compute_batch_img_metrics, _calculate_msm
+
+logger = logging.getLogger('engine')
+
+TASKS_PER_PROCESS = 4
+
+
+def _gen_segment_images(args):
+    segm_arrays, centr_df, nrows, ncols, ppm = args
+    return list(_gen_iso_images(segm_arrays, centr_df, nrows, ncols, ppm))
+
+
+def _calc_ion_metrics(args):
+    metrics, sampled_pixel_inds, shape, img_gen_conf, ion_images, ion_centr_ints = args
+    compute_metrics = get_compute_batch_img_metrics(metrics, sampled_pixel_inds, shape, img_gen_conf)
+    return compute_metrics(ion_images, ion_centr_ints)
+
+
+class MSMLocalSearch(MSMBasicSearch):
+    """ Same search as MSMBasicSearch without Spark. All dataset peaks are loaded into memory,
+    imaging and metrics computation run in a pool of worker processes
+
+    Args
+    ----
+    processes : int
+        Number of worker processes
+    """
+    def __init__(self, ds, ds_reader, mol_db, centr_gen, fdr, ds_config, processes=4):
+        super(MSMLocalSearch, self).__init__(sc=None, ds=ds, ds_reader=ds_reader, mol_db=mol_db,
+                                             centr_gen=centr_gen, fdr=fdr, ds_config=ds_config)
+        self._processes = processes
+        self._pool = None
+
+    def compute_images_metrics(self, ion_centroids_df):
+        """ Compute ion images and their metrics
+
+        Returns
+        -------
+        : tuple
+            (list of (ion, list of ion images) pairs, ion metrics DataFrame)
+        """
+        logger.info('Running local molecule search with %s processes', self._processes)
+        ion_centroids_df = self.filter_ions(ion_centroids_df)
+        with ProcessPoolExecutor(max_workers=self._processes) as self._pool:
+            ion_images = self.compute_sf_images(ion_centroids_df)
+            ion_metrics_df = self.calc_metrics(ion_images, ion_centroids_df)
+        self._pool = None
+        return ion_images, ion_metrics_df
+
+    def _split(self, items):
+        return [chunk for chunk in np.array_split(np.arange(len(items)), self._processes * TASKS_PER_PROCESS)
+                if chunk.shape[0] > 0]
+
+    def _gen_img_pairs(self, segm_arrays, ion_centroids_df):
+        """ (peak_i, image) pairs of each ion. Centroids sorted by m/z are split into contiguous groups,
+        each group is imaged from the slice of all dataset peaks covering its m/z range
+        """
+        ppm = self.ds_config['image_generation']['ppm']
+        nrows, ncols = self._ds_reader.get_dims()
+        sp_inds, sp_mzs, sp_ints = segm_arrays
+
+        centr_df = ion_centroids_df.sort_values(by='mz')
+        tasks = []
+        for chunk in self._split(centr_df):
+            segm_centr_df = centr_df.iloc[chunk[0]:chunk[-1] + 1]
+            min_mz, max_mz = segm_centr_df.mz.iloc[0], segm_centr_df.mz.iloc[-1]
+            l = np.searchsorted(sp_mzs, min_mz - min_mz * ppm * 1e-6, 'left')
+            r = np.searchsorted(sp_mzs, max_mz + max_mz * ppm * 1e-6, 'right')
+            tasks.append(((sp_inds[l:r], sp_mzs[l:r], sp_ints[l:r]), segm_centr_df, nrows, ncols, ppm))
+
+        img_pairs = defaultdict(list)
+        for segm_images in self._pool.map(_gen_segment_images, tasks):
+            for ion, pair in segm_images:
+                img_pairs[ion].append(pair)
+        return img_pairs
+
+    def compute_sf_images(self, ion_centroids_df):
+        """ Compute isotopic images in two phases, principal peak images first, as MSMBasicSearch does
+
+        Returns
+        -------
+        : list
+            List of (ion, list[sm.engine.sparse_image.SparseImage]) pairs
+        """
+        segm_arrays = _segment_arrays(self._ds_reader.iter_spectra(), self._ds_reader.get_norm_img_pixel_inds())
+        logger.info('Loaded %s peaks', segm_arrays[1].shape[0])
+
+        principal_peak_mask = ion_centroids_df.peak_i == 0
+        img_pairs = self._gen_img_pairs(segm_arrays, ion_centroids_df[principal_peak_mask])
+        passes = principal_image_filter(self.ds_config['image_generation'])
+        passed_ions = [ion for ion, pairs in img_pairs.items() if passes(_img_pairs_to_list(pairs, None)[0])]
+        logger.info('%s of %s ions passed the principal peak image filter',
+                    len(passed_ions), ion_centroids_df[principal_peak_mask].shape[0])
+
+        other_centroids_df = ion_centroids_df[~principal_peak_mask & ion_centroids_df.index.isin(passed_ions)]
+        for ion, pairs in self._gen_img_pairs(segm_arrays, other_centroids_df).items():
+            img_pairs[ion].extend(pairs)
+        shape = self._ds_reader.get_dims()
+        return [(ion, _img_pairs_to_list(img_pairs[ion], shape)) for ion in sorted(passed_ions)]
+
+    def calc_metrics(self, sf_images, ion_centroids_df):
+        ion_centr_ints = (ion_centroids_df.reset_index().groupby(['ion_i'])
+                          .apply(lambda df: df.int.tolist()).to_dict())
+        sampled_pixel_inds = np.unique(self._ds_reader.get_norm_img_pixel_inds())
+        shape = self._ds_reader.get_dims()
+
+        tasks = []
+        for chunk in self._split(sf_images):
+            ion_images = sf_images[chunk[0]:chunk[-1] + 1]
+            tasks.append((self.metrics, sampled_pixel_inds, shape, self.ds_config['image_generation'],
+                          ion_images, {ion: ion_centr_ints[ion] for ion, _ in ion_images}))
+        sf_metrics = [row for chunk_metrics in self._pool.map(_calc_ion_metrics, tasks) for row in chunk_metrics]
+
+        columns = ['ion_i'] + list(self.metrics.keys())
+        sf_metrics_df = pd.DataFrame(sf_metrics, columns=columns).set_index(['ion_i'])
+        sf_metrics_df['msm'] = _calculate_msm(sf_metrics_df)
+        return sf_metrics_df
+
+    def filter_sf_images(self, sf_images, sf_metrics_df):
+        return [(ion, images) for ion, images in sf_images if ion in sf_metrics_df.index]
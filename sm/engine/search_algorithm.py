@@ -1,3 +1,5 @@
+from pyspark import StorageLevel
+
 from sm.engine.util import SMConfig
 
 
@@ -12,10 +14,30 @@ class SearchAlgorithm(object):
         self.ds_config = ds_config
         self.metrics = None
         self.sm_config = SMConfig.get_conf()
+        self._persisted_rdds = []
 
     def search(self):
         pass
 
+    def persist(self, rdd):
+        """ Persist the RDD with the storage level from the 'spark.storage_level' option
+        until unpersist is called, so that it is computed only once by all its consumers
+        """
+        storage_level = getattr(StorageLevel, self.sm_config['spark'].get('storage_level', 'MEMORY_AND_DISK'))
+        rdd = rdd.persist(storage_level)
+        self._persisted_rdds.append(rdd)
+        return rdd
+
+    def unpersist(self, keep=()):
+        """ Release all RDDs persisted by the search except the ones to keep """
+        kept_rdds = []
+        for rdd in self._persisted_rdds:
+            if any(rdd is kept_rdd for kept_rdd in keep):
+                kept_rdds.append(rdd)
+            else:
+                rdd.unpersist()
+        self._persisted_rdds = kept_rdds
+
     def calc_metrics(self, sf_images, ion_centroids_df):
         pass
 
@@ -13,12 +13,15 @@ import logging
 
 from sm.engine.isocalc_wrapper import IsocalcWrapper
 from sm.engine.msm_basic.msm_basic_search import MSMBasicSearch
+from sm.engine.msm_basic.msm_local_search import MSMLocalSearch
 from sm.engine.dataset import DatasetStatus
 from sm.engine.dataset_reader import DatasetReader
 from sm.engine.db import DB
-from sm.engine.fdr import FDR, DECOY_ADDUCTS
-from sm.engine.search_results import SearchResults
+from sm.engine.fdr import FDR, DECOY_ADDUCTS, DECOY_SAMPLE_SIZE
+from sm.engine.search_results import SearchResults, post_images_to_image_store
+from sm.engine.search_plan import plan_search
 from sm.engine.ion_centroids_gen import IonCentroidsGenerator
+from sm.engine.ion_catalog import IonCatalog
 from sm.engine.util import proj_root, SMConfig, read_json
 from sm.engine.work_dir import WorkDirManager, local_path
 from sm.engine.es_export import ESExporter
@@ -29,7 +32,7 @@ from sm.engine.queue import QueuePublisher, SM_DS_STATUS
 logger = logging.getLogger('engine')
 
 JOB_ID_MOLDB_ID_SEL = "SELECT id, db_id FROM job WHERE ds_id = %s AND status='FINISHED'"
-JOB_INS = "INSERT INTO job (db_id, ds_id, status, start) VALUES (%s, %s, %s, %s) RETURNING id"
+JOB_INS = "INSERT INTO job (db_id, ds_id, status, start, plan) VALUES (%s, %s, %s, %s, %s) RETURNING id"
 JOB_UPD = "UPDATE job set status=%s, finish=%s where id=%s"
 TARGET_DECOY_ADD_DEL = 'DELETE FROM target_decoy_add tda WHERE tda.job_id IN (SELECT id FROM job WHERE ds_id = %s)'
 
@@ -46,13 +49,12 @@ class SearchJob(object):
         self.no_clean = no_clean
         self._img_store = img_store
 
-        self._job_id = None
         self._sc = None
         self._db = None
         self._ds = None
         self._ds_reader = None
         self._status_queue = None
-        self._fdr = None
+        self._plan = None
         self._wd_manager = None
         self._es = None
 
@@ -60,12 +62,15 @@ class SearchJob(object):
 
         logger.debug('Using SM config:\n%s', pformat(self._sm_config))
 
-    def _configure_spark(self):
+    def _configure_spark(self, spark_conf=None):
+        """ Create Spark context from the 'spark' config section, `spark_conf` properties take precedence """
         logger.info('Configuring Spark')
         sconf = SparkConf()
         for prop, value in self._sm_config['spark'].items():
             if prop.startswith('spark.'):
                 sconf.set(prop, value)
+        for prop, value in (spark_conf or {}).items():
+            sconf.set(prop, value)
 
         if 'aws' in self._sm_config:
             sconf.set("spark.hadoop.fs.s3a.access.key", self._sm_config['aws']['aws_access_key_id'])
@@ -75,6 +80,31 @@ class SearchJob(object):
 
         self._sc = SparkContext(master=self._sm_config['spark']['master'], conf=sconf, appName='SM engine')
 
+    def _plan_search(self, mol_dbs):
+        """ Plan the search from the dataset statistics and the number of formulas in the molecular databases.
+        Spark is configured according to the plan unless the search runs locally
+        """
+        iso_gen_config = self._ds.config['isotope_generation']
+        target_adducts_n = len(iso_gen_config['adducts'])
+        decoy_adducts_n = min(DECOY_SAMPLE_SIZE * target_adducts_n, len(DECOY_ADDUCTS))
+        all_adducts_n = len(set(self._sm_config['defaults']['adducts'][iso_gen_config['charge']['polarity']])
+                            | set(DECOY_ADDUCTS))
+        # all databases are imaged together, isotope patterns are generated for each of them
+        union_sf_n = len(set(sf for mol_db in mol_dbs for sf in mol_db.sfs))
+        max_sf_n = max([len(mol_db.sfs) for mol_db in mol_dbs] or [0])
+
+        self._plan = plan_search(self._ds_reader.get_spectra_stats(),
+                                 ion_n=union_sf_n * (target_adducts_n + decoy_adducts_n),
+                                 iso_gen_ion_n=max_sf_n * all_adducts_n,
+                                 sm_config=self._sm_config, ds_config=self._ds.config)
+        self._ds_reader.spectra_partitions = self._plan.spectra_partitions
+        if self._plan.engine == 'local':
+            logger.info('Running local search without Spark')
+            self._ds_reader.download_spectra()
+        else:
+            self._configure_spark(self._plan.spark_conf)
+            self._ds_reader.set_spark_context(self._sc)
+
     def _init_db(self):
         logger.info('Connecting to the DB')
         self._db = DB(self._sm_config['db'])
@@ -82,58 +112,96 @@ class SearchJob(object):
     def store_job_meta(self, mol_db_id):
         """ Store search job metadata in the database """
         logger.info('Storing job metadata')
-        rows = [(mol_db_id, self._ds.id, 'STARTED', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))]
-        self._job_id = self._db.insert_return(JOB_INS, rows=rows)[0]
+        rows = [(mol_db_id, self._ds.id, 'STARTED', datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                 self._plan.to_json())]
+        return self._db.insert_return(JOB_INS, rows=rows)[0]
 
-    def _run_annotation_job(self, mol_db):
+    def _run_annotation_jobs(self, mol_dbs):
+        """ Run one job per molecular database. All databases are searched in one imaging pass,
+        FDR estimation and storing of the results is done for each job separately
+        """
+        job_ids = [self.store_job_meta(mol_db.id) for mol_db in mol_dbs]
+        isocalc = IsocalcWrapper(self._ds.config['isotope_generation'])
         try:
-            self.store_job_meta(mol_db.id)
-            mol_db.set_job_id(self._job_id)
-
-            logger.info("Running new job ds_id: %s, ds_name: %s, db_name: %s, db_version: %s",
-                        self._ds.id, self._ds.name, mol_db.name, mol_db.version)
-
             target_adducts = self._ds.config['isotope_generation']['adducts']
-            self._fdr = FDR(job_id=self._job_id,
-                            decoy_sample_size=20,
-                            target_adducts=target_adducts,
-                            db=self._db)
-
-            isocalc = IsocalcWrapper(self._ds.config['isotope_generation'])
-            centroids_gen = IonCentroidsGenerator(sc=self._sc, moldb_name=mol_db.name, isocalc=isocalc)
             polarity = self._ds.config['isotope_generation']['charge']['polarity']
             all_adducts = list(set(self._sm_config['defaults']['adducts'][polarity]) | set(DECOY_ADDUCTS))
-            centroids_gen.generate_if_not_exist(isocalc=isocalc,
-                                                sfs=mol_db.sfs,
-                                                adducts=all_adducts)
-            target_ions = centroids_gen.ions(target_adducts)
-            self._fdr.decoy_adducts_selection(target_ions)
-
-            search_alg = MSMBasicSearch(sc=self._sc, ds=self._ds, ds_reader=self._ds_reader,
-                                        mol_db=mol_db, centr_gen=centroids_gen,
-                                        fdr=self._fdr, ds_config=self._ds.config)
-            ion_metrics_df, ion_iso_images = search_alg.search()
-
-            search_results = SearchResults(mol_db.id, self._job_id, search_alg.metrics.keys())
-            mask = self._ds_reader.get_2d_sample_area_mask()
-            img_store_type = self._ds.get_ion_img_storage_type(self._db)
-            search_results.store(ion_metrics_df, ion_iso_images, mask, self._db, self._img_store, img_store_type)
+            # integer ids of all formulas and adducts of the job, shared by the FDRs of all databases
+            catalog = IonCatalog(sfs=(sf for mol_db in mol_dbs for sf in mol_db.sfs),
+                                 adducts=all_adducts + list(target_adducts))
+            centr_gens, fdrs = [], []
+            for mol_db, job_id in zip(mol_dbs, job_ids):
+                mol_db.set_job_id(job_id)
+                logger.info("Running new job ds_id: %s, ds_name: %s, db_name: %s, db_version: %s",
+                            self._ds.id, self._ds.name, mol_db.name, mol_db.version)
+
+                fdr = FDR(job_id=job_id,
+                          decoy_sample_size=DECOY_SAMPLE_SIZE,
+                          target_adducts=target_adducts,
+                          db=self._db,
+                          catalog=catalog)
+                centroids_gen = IonCentroidsGenerator(sc=self._sc, moldb_name=mol_db.name, isocalc=isocalc,
+                                                      iso_gen_part_n=self._plan.iso_gen_partitions)
+                centroids_gen.generate_if_not_exist(isocalc=isocalc,
+                                                    sfs=mol_db.sfs,
+                                                    adducts=all_adducts)
+                target_ions = centroids_gen.ions(target_adducts)
+                fdr.decoy_adducts_selection(target_ions)
+                centr_gens.append(centroids_gen)
+                fdrs.append(fdr)
+
+            if self._sc:
+                search_alg = MSMBasicSearch(sc=self._sc, ds=self._ds, ds_reader=self._ds_reader,
+                                            mol_db=None, centr_gen=None, fdr=None,
+                                            ds_config=self._ds.config, plan=self._plan)
+            else:
+                search_alg = MSMLocalSearch(ds=self._ds, ds_reader=self._ds_reader,
+                                            mol_db=None, centr_gen=None, fdr=None, ds_config=self._ds.config,
+                                            processes=self._sm_config.get('local_search', {}).get('processes', 4))
+            ion_metrics_dfs, ion_iso_images = search_alg.search_multi(centr_gens, fdrs)
+
+            try:
+                # images of ions shared by several databases are posted once
+                mask = self._ds_reader.get_2d_sample_area_mask()
+                img_store_type = self._ds.get_ion_img_storage_type(self._db)
+                ion_img_ids = post_images_to_image_store(ion_iso_images, mask, self._img_store, img_store_type)
+            finally:
+                search_alg.unpersist()
         except Exception as e:
-            self._db.alter(JOB_UPD, params=('FAILED', datetime.now().strftime('%Y-%m-%d %H:%M:%S'), self._job_id))
-            msg = 'Job failed(ds_id={}, mol_db={}): {}'.format(self._ds.id, mol_db, str(e))
+            for job_id in job_ids:
+                self._fail_job(job_id)
+            msg = 'Job failed(ds_id={}, mol_dbs={}): {}'.format(self._ds.id, ', '.join(map(str, mol_dbs)), str(e))
             raise JobFailedError(msg) from e
-        else:
-            self._export_search_results_to_es(mol_db, isocalc)
 
-    def _export_search_results_to_es(self, mol_db, isocalc):
+        for i, (mol_db, job_id, ion_metrics_df) in enumerate(zip(mol_dbs, job_ids, ion_metrics_dfs)):
+            try:
+                search_results = SearchResults(mol_db.id, job_id, search_alg.metrics.keys())
+                search_results.store_ion_metrics(ion_metrics_df, ion_img_ids, self._db)
+            except Exception as e:
+                for failed_job_id in job_ids[i:]:
+                    self._fail_job(failed_job_id)
+                msg = 'Job failed(ds_id={}, mol_db={}): {}'.format(self._ds.id, mol_db, str(e))
+                raise JobFailedError(msg) from e
+            try:
+                self._export_search_results_to_es(mol_db, job_id, isocalc)
+            except ESExportFailedError:
+                # the job of this database is already marked failed, the remaining ones never get results
+                for failed_job_id in job_ids[i + 1:]:
+                    self._fail_job(failed_job_id)
+                raise
+
+    def _fail_job(self, job_id):
+        self._db.alter(JOB_UPD, params=('FAILED', datetime.now().strftime('%Y-%m-%d %H:%M:%S'), job_id))
+
+    def _export_search_results_to_es(self, mol_db, job_id, isocalc):
         try:
             self._es.index_ds(self._ds.id, mol_db, isocalc)
         except Exception as e:
-            self._db.alter(JOB_UPD, params=('FAILED', datetime.now().strftime('%Y-%m-%d %H:%M:%S'), self._job_id))
+            self._fail_job(job_id)
             msg = 'Export to ES failed(ds_id={}, mol_db={}): {}'.format(self._ds.id, mol_db, str(e))
             raise ESExportFailedError(msg) from e
         else:
-            self._db.alter(JOB_UPD, params=('FINISHED', datetime.now().strftime('%Y-%m-%d %H:%M:%S'), self._job_id))
+            self._db.alter(JOB_UPD, params=('FINISHED', datetime.now().strftime('%Y-%m-%d %H:%M:%S'), job_id))
 
     def _remove_annotation_job(self, mol_db):
         logger.info("Removing job results ds_id: %s, ds_name: %s, db_name: %s, db_version: %s",
@@ -150,12 +218,13 @@ class SearchJob(object):
         return completed_moldb_ids, new_moldb_ids
 
     def _save_data_from_raw_ms_file(self):
-        ms_file_type_config = SMConfig.get_ms_file_handler(self._wd_manager.local_dir.ms_file_path)
+        ms_file_path = self._ds_reader.ms_file_path
+        ms_file_type_config = SMConfig.get_ms_file_handler(ms_file_path)
         acq_geometry_factory_module = ms_file_type_config['acq_geometry_factory']
         acq_geometry_factory = getattr(import_module(acq_geometry_factory_module['path']),
                                                 acq_geometry_factory_module['name'])
 
-        acq_geometry = acq_geometry_factory(self._wd_manager.local_dir.ms_file_path).create()
+        acq_geometry = acq_geometry_factory(ms_file_path).create()
         self._ds.save_acq_geometry(self._db, acq_geometry)
 
         self._ds.save_ion_img_storage_type(self._db, ms_file_type_config['img_storage_type'])
@@ -163,9 +232,12 @@ class SearchJob(object):
     def run(self, ds):
         """ Entry point of the engine. Molecule search is completed in several steps:
             * Copying input data to the engine work dir
-            * Conversion input mass spec files to plain text format. One line - one spectrum data
+            * Conversion input mass spec files to plain text or binary format (skipped when reading imzML directly)
+            * Planning of the search execution (engine, partitioning, Spark settings) from the dataset size
             * Generation and saving to the database theoretical peaks for all formulas from the molecule database
-            * Molecules search. The most compute intensive part. Spark is used to run it in distributed manner.
+            * Molecules search. The most compute intensive part. Spark is used to run it in distributed manner,
+              small datasets are searched on the local machine with a process pool. All new molecular databases
+              are searched in one pass
             * Saving results (isotope images and their metrics of quality for each putative molecule) to the database
 
         Args
@@ -188,12 +260,11 @@ class SearchJob(object):
             ds.set_status(self._db, self._es, self._status_queue, DatasetStatus.STARTED)
 
             self._wd_manager = WorkDirManager(ds.id)
-            self._configure_spark()
-
             if not self.no_clean:
                 self._wd_manager.clean()
 
-            self._ds_reader = DatasetReader(self._ds.input_path, self._sc, self._wd_manager)
+            # Spark is started only after conversion, once the dataset size is known
+            self._ds_reader = DatasetReader(self._ds.input_path, None, self._wd_manager)
             self._ds_reader.copy_convert_input_data()
 
             self._save_data_from_raw_ms_file()
@@ -204,13 +275,16 @@ class SearchJob(object):
             logger.info('Dataset config:\n%s', pformat(self._ds.config))
 
             completed_moldb_ids, new_moldb_ids = self._moldb_ids()
-            for moldb_id in completed_moldb_ids.symmetric_difference(new_moldb_ids):  # ignore ids present in both sets
+            for moldb_id in completed_moldb_ids - new_moldb_ids:
                 mol_db = MolecularDB(id=moldb_id, db=self._db,
                                      iso_gen_config=self._ds.config['isotope_generation'])
-                if moldb_id not in new_moldb_ids:
-                    self._remove_annotation_job(mol_db)
-                elif moldb_id not in completed_moldb_ids:
-                    self._run_annotation_job(mol_db)
+                self._remove_annotation_job(mol_db)
+
+            mol_dbs = [MolecularDB(id=moldb_id, db=self._db, iso_gen_config=self._ds.config['isotope_generation'])
+                       for moldb_id in sorted(new_moldb_ids - completed_moldb_ids)]
+            if mol_dbs:
+                self._plan_search(mol_dbs)
+                self._run_annotation_jobs(mol_dbs)
 
             ds.set_status(self._db, self._es, self._status_queue, DatasetStatus.FINISHED)
 
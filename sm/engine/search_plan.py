@@ -0,0 +1,132 @@
+"""
+
+:synopsis: Size-aware planning of search execution settings
+
+"""
+import json
+import numpy as np
+import logging
+
+logger = logging.getLogger('engine')
+
+PEAKS_PER_SEGMENT = 10**6
+PEAKS_PER_SPECTRA_PARTITION = 2 * 10**6
+ION_PIXELS_PER_IMAGE_PARTITION = 5 * 10**7
+IONS_PER_ISO_GEN_PARTITION = 500
+BYTES_PER_PEAK = 16  # int32 pixel index, float32 m/z, float64 intensity
+ISO_IMAGES_PER_ION = 4
+MAX_EXECUTOR_MEMORY = '64g'
+MAX_DRIVER_MEMORY = '32g'
+
+
+class SearchPlan(object):
+    """ Execution settings of a search job. Defaults are the former hard-coded values
+
+    Args
+    ----
+    engine : str
+        'spark' or 'local'
+    mz_segment_n : int
+        Number of m/z segments, None to let define_mz_segments pick it
+    spectra_partitions : int
+        Minimal number of partitions of the spectra RDD
+    image_partitions : int
+        Number of partitions of the ion images RDD
+    iso_gen_partitions : int
+        Number of partitions for isotope pattern generation
+    spark_conf : dict
+        Spark properties overriding the 'spark' config section
+    """
+    def __init__(self, engine='spark', mz_segment_n=None, spectra_partitions=16, image_partitions=256,
+                 iso_gen_partitions=512, spark_conf=None):
+        self.engine = engine
+        self.mz_segment_n = mz_segment_n
+        self.spectra_partitions = spectra_partitions
+        self.image_partitions = image_partitions
+        self.iso_gen_partitions = iso_gen_partitions
+        self.spark_conf = spark_conf or {}
+
+    def to_dict(self):
+        return dict(engine=self.engine, mz_segment_n=self.mz_segment_n,
+                    spectra_partitions=self.spectra_partitions, image_partitions=self.image_partitions,
+                    iso_gen_partitions=self.iso_gen_partitions, spark_conf=self.spark_conf)
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def __repr__(self):
+        return 'SearchPlan({})'.format(self.to_json())
+
+
+def _parse_mem_mb(value):
+    units = {'k': 2**-10, 'm': 1, 'g': 2**10, 't': 2**20}
+    value = str(value).strip().lower()
+    if value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value) // 2**20
+
+
+def _clip(value, lo, hi):
+    return int(np.clip(value, lo, hi))
+
+
+def plan_search(spectra_stats, ion_n, iso_gen_ion_n, sm_config, ds_config):
+    """ Derive search execution settings from the dataset and molecular database sizes
+
+    Args
+    ----
+    spectra_stats : sm.engine.spectra_stats.SpectraStats
+    ion_n : int
+        Expected number of target and decoy ions to search for
+    iso_gen_ion_n : int
+        Number of ions to generate isotope patterns for
+    sm_config : dict
+    ds_config : dict
+
+    Returns
+    -------
+    : SearchPlan
+    """
+    spectra_n, peaks_n = spectra_stats.spectra_n, spectra_stats.peaks_n
+    ion_pixels = ion_n * spectra_n
+
+    engine = ds_config.get('search_engine', None)
+    if not engine:
+        local_search_config = sm_config.get('local_search', None)
+        if local_search_config and peaks_n <= local_search_config.get('max_peaks', 0):
+            engine = 'local'
+        else:
+            engine = 'spark'
+
+    mz_segment_n = _clip(peaks_n // PEAKS_PER_SEGMENT, 8, 2048)
+    spectra_partitions = _clip(peaks_n // PEAKS_PER_SPECTRA_PARTITION, 4, 512)
+    image_partitions = _clip(ion_pixels // ION_PIXELS_PER_IMAGE_PARTITION, 8, 2048)
+    iso_gen_partitions = _clip(iso_gen_ion_n // IONS_PER_ISO_GEN_PARTITION, 8, 512)
+
+    spark_conf = {}
+    if engine == 'spark':
+        spark_config = sm_config.get('spark', {})
+        plan_config = sm_config.get('search_plan', {})
+        # estimates are capped by the configured maximum, memory is never set below the configured one
+        # an imaging task holds one segment and its images, a metrics task holds dense
+        # sampled pixel vectors of one ion
+        segment_mb = peaks_n / mz_segment_n * BYTES_PER_PEAK * 3 / 2**20
+        ion_vectors_mb = ISO_IMAGES_PER_ION * spectra_n * 8 * 3 / 2**20
+        executor_mem_mb = max(_parse_mem_mb(spark_config.get('spark.executor.memory', '2g')),
+                              min(int(1024 + 4 * max(segment_mb, ion_vectors_mb)),
+                                  _parse_mem_mb(plan_config.get('max_executor_memory', MAX_EXECUTOR_MEMORY))))
+        # the driver holds the ion centroids DataFrame it partitions by m/z segment and collects the ion metrics
+        driver_mem_mb = max(_parse_mem_mb(spark_config.get('spark.driver.memory', '4g')),
+                            min(int(2048 + ion_n * ISO_IMAGES_PER_ION * 200 / 2**20),
+                                _parse_mem_mb(plan_config.get('max_driver_memory', MAX_DRIVER_MEMORY))))
+        spark_conf = {
+            'spark.executor.memory': '{}m'.format(executor_mem_mb),
+            'spark.driver.memory': '{}m'.format(driver_mem_mb),
+            'spark.default.parallelism': str(image_partitions),
+        }
+
+    plan = SearchPlan(engine=engine, mz_segment_n=mz_segment_n, spectra_partitions=spectra_partitions,
+                      image_partitions=image_partitions, iso_gen_partitions=iso_gen_partitions,
+                      spark_conf=spark_conf)
+    logger.info('Search plan for %s spectra, %s peaks and %s ions: %s', spectra_n, peaks_n, ion_n, plan)
+    return plan
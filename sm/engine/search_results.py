@@ -13,6 +13,49 @@ VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
 '''
 
 
+def _image_inserter(img_store, img_store_type, alpha_channel):
+    png_generator = PngGenerator(alpha_channel, greyscale=True)
+
+    def _post_images(imgs):
+        imgs += [None] * (4 - len(imgs))
+
+        iso_image_ids = [None] * 4
+        for k, img in enumerate(imgs):
+            if img is not None:
+                fp = png_generator.generate_png(img.toarray())
+                iso_image_ids[k] = img_store.post_image(img_store_type, 'iso_image', fp)
+        return {
+            'iso_image_ids': iso_image_ids
+        }
+
+    return _post_images
+
+
+def post_images_to_image_store(ion_iso_images, alpha_channel, img_store, img_store_type):
+    """ Post isotope images of the ions to the image store, independent of any search job
+
+    Args
+    ---------
+    ion_iso_images : pyspark.RDD | iterable
+        (ion, images) pairs, images must be lists of sparse 2d intensity images
+    alpha_channel : numpy.array
+        Image alpha channel (2D, 0..1)
+    img_store : sm.engine.png_generator.ImageStoreServiceWrapper
+    img_store_type : str
+
+    Returns
+    ---------
+    : dict
+        ion -> {'iso_image_ids': list}
+    """
+    logger.info('Posting iso images to {}'.format(img_store))
+    post_images = _image_inserter(img_store, img_store_type, alpha_channel)
+    if hasattr(ion_iso_images, 'mapValues'):
+        return dict(ion_iso_images.mapValues(post_images).collect())
+    else:
+        return {ion: post_images(images) for ion, images in ion_iso_images}
+
+
 class SearchResults(object):
     """ Container for molecule search results
 
@@ -48,27 +91,8 @@ class SearchResults(object):
                                                 ion_img_ids))
         db.insert(METRICS_INS, rows)
 
-    def _image_inserter(self, img_store, img_store_type, alpha_channel):
-        png_generator = PngGenerator(alpha_channel, greyscale=True)
-
-        def _post_images(imgs):
-            imgs += [None] * (4 - len(imgs))
-
-            iso_image_ids = [None] * 4
-            for k, img in enumerate(imgs):
-                if img is not None:
-                    fp = png_generator.generate_png(img.toarray())
-                    iso_image_ids[k] = img_store.post_image(img_store_type, 'iso_image', fp)
-            return {
-                'iso_image_ids': iso_image_ids
-            }
-
-        return _post_images
-
     def post_images_to_image_store(self, ion_iso_images, alpha_channel, img_store, img_store_type):
-        logger.info('Posting iso images to {}'.format(img_store))
-        post_images = self._image_inserter(img_store, img_store_type, alpha_channel)
-        return dict(ion_iso_images.mapValues(post_images).collect())
+        return post_images_to_image_store(ion_iso_images, alpha_channel, img_store, img_store_type)
 
     def store(self, ion_metrics_df, ion_iso_images, alpha_channel, db, img_store, img_store_type):
         """ Save metrics and images
@@ -77,8 +101,9 @@ class SearchResults(object):
         ---------
         ion_metrics_df : pandas.Dataframe
             sf, adduct, msm, fdr, individual metrics
-        ion_iso_images : pyspark.RDD
-            values must be lists of 2d intensity arrays (in coo_matrix format)
+        ion_iso_images : pyspark.RDD | iterable
+            (ion, images) pairs, images must be lists of sparse 2d intensity images
+            (sm.engine.sparse_image.SparseImage)
         alpha_channel : numpy.array
             Image alpha channel (2D, 0..1)
         db : sm.engine.DB
@@ -0,0 +1,74 @@
+"""
+
+:synopsis: Compact sparse representation of ion images
+
+"""
+import numpy as np
+
+
+def _sparse_image_from_buffers(inds_buf, vals_buf, shape):
+    return SparseImage(np.frombuffer(inds_buf, dtype=np.int32), np.frombuffer(vals_buf, dtype=np.float32), shape)
+
+
+class SparseImage(object):
+    """ Ion image as flat pixel indices with intensities. Much smaller than scipy.sparse matrices
+    when pickled, as it is serialized as two raw buffers and the shape
+
+    Args
+    ----
+    inds : ndarray
+        Unique flat (row-wise) pixel indices
+    vals : ndarray
+        Intensities of the pixels
+    shape : tuple
+        Number of rows and columns
+    """
+    __slots__ = ('inds', 'vals', 'shape')
+
+    def __init__(self, inds, vals, shape):
+        self.inds = np.asarray(inds, dtype=np.int32)
+        self.vals = np.asarray(vals, dtype=np.float32)
+        self.shape = (int(shape[0]), int(shape[1]))
+
+    @classmethod
+    def from_pixels(cls, inds, vals, shape):
+        """ Create an image from pixel indices that may repeat, intensities of the same pixel are summed up """
+        uniq_inds, inverse = np.unique(inds, return_inverse=True)
+        if uniq_inds.shape[0] < inds.shape[0]:
+            vals = np.bincount(inverse, weights=vals)
+        else:
+            vals = vals[np.argsort(inds, kind='mergesort')]
+        return cls(uniq_inds, vals, shape)
+
+    def __reduce__(self):
+        return _sparse_image_from_buffers, (self.inds.tobytes(), self.vals.tobytes(), self.shape)
+
+    @property
+    def nnz(self):
+        return self.inds.shape[0]
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    def toarray(self):
+        """ Dense 2D float64 array """
+        arr = np.zeros(self.size)
+        arr[self.inds] = self.vals
+        return arr.reshape(self.shape)
+
+    def sum(self):
+        return float(self.vals.sum(dtype=np.float64))
+
+    def min(self):
+        if self.nnz < self.size:
+            return min(0., float(self.vals.min())) if self.nnz > 0 else 0.
+        return float(self.vals.min())
+
+    def max(self):
+        if self.nnz < self.size:
+            return max(0., float(self.vals.max())) if self.nnz > 0 else 0.
+        return float(self.vals.max())
+
+    def __repr__(self):
+        return 'SparseImage(shape={}, nnz={})'.format(self.shape, self.nnz)
@@ -0,0 +1,207 @@
+"""
+
+:synopsis: Dataset statistics collected in a single pass over spectra
+
+"""
+import json
+import zlib
+from base64 import b64encode, b64decode
+import numpy as np
+
+from sm.engine.errors import JobFailedError
+
+MAX_MZ_VALUE = 10**5
+MAX_INTENS_VALUE = 10**12
+MZ_HIST_BIN_WIDTH = 0.1
+PENDING_PEAKS_N = 10**6
+# m/z occupancy bins are 1 ppm wide, m/z values below the minimum fall into the first bin
+MZ_OCCUPANCY_MIN = 10.
+MZ_OCCUPANCY_BIN_PPM = 1
+MZ_OCCUPANCY_BIN_N = int(np.ceil(np.log(MAX_MZ_VALUE / MZ_OCCUPANCY_MIN) / np.log1p(MZ_OCCUPANCY_BIN_PPM * 1e-6)))
+
+
+def _occupancy_bins(mzs):
+    bins = np.log(np.maximum(mzs, MZ_OCCUPANCY_MIN) / MZ_OCCUPANCY_MIN) / np.log1p(MZ_OCCUPANCY_BIN_PPM * 1e-6)
+    return np.minimum(bins.astype(np.int64), MZ_OCCUPANCY_BIN_N - 1)
+
+
+class SpectraStats(object):
+    """ Spectra count, peak count, m/z histogram, m/z occupancy bitmap and data quality counters of a dataset.
+    Collected during conversion or with one pass over the spectra RDD and stored next to the spectra.
+    """
+    def __init__(self):
+        self.spectra_n = 0
+        self.peaks_n = 0
+        self.max_peaks_per_spectrum = 0
+        self.mz_min = None
+        self.mz_max = None
+        self.wrong_mz_n = 0
+        self.wrong_int_n = 0
+        self._mz_hist = np.zeros(0, dtype=np.int64)  # bin i covers [i * MZ_HIST_BIN_WIDTH, (i + 1) * ...)
+        self._mz_occupancy = None  # bool array over 1 ppm wide bins, None if not collected
+        self._mz_occupancy_cumsum = None
+        self._pending_mzs = []
+        self._pending_peaks_n = 0
+
+    def update(self, mzs, ints):
+        """ Account one spectrum """
+        self.spectra_n += 1
+        self.peaks_n += mzs.shape[0]
+        self.max_peaks_per_spectrum = max(self.max_peaks_per_spectrum, mzs.shape[0])
+        self.wrong_mz_n += int(np.count_nonzero((mzs < 0) | (mzs > MAX_MZ_VALUE)))
+        self.wrong_int_n += int(np.count_nonzero((ints < 0) | (ints > MAX_INTENS_VALUE)))
+
+        valid_mzs = mzs[(mzs >= 0) & (mzs <= MAX_MZ_VALUE)]
+        if valid_mzs.shape[0] > 0:
+            mz_min, mz_max = float(valid_mzs.min()), float(valid_mzs.max())
+            self.mz_min = mz_min if self.mz_min is None else min(self.mz_min, mz_min)
+            self.mz_max = mz_max if self.mz_max is None else max(self.mz_max, mz_max)
+            self._pending_mzs.append(valid_mzs)
+            self._pending_peaks_n += valid_mzs.shape[0]
+            if self._pending_peaks_n >= PENDING_PEAKS_N:
+                self._flush_pending()
+        return self
+
+    def update_all(self, spectra):
+        """ Account all (sp_id, mzs, ints) triples from the iterable """
+        for _, mzs, ints in spectra:
+            self.update(mzs, ints)
+        return self
+
+    def _add_hist(self, hist):
+        if hist.shape[0] > self._mz_hist.shape[0]:
+            hist[:self._mz_hist.shape[0]] += self._mz_hist
+            self._mz_hist = hist
+        else:
+            self._mz_hist[:hist.shape[0]] += hist
+
+    def _add_occupancy(self, occupancy):
+        if self._mz_occupancy is None:
+            self._mz_occupancy = np.zeros(MZ_OCCUPANCY_BIN_N, dtype=bool)
+        self._mz_occupancy |= occupancy
+        self._mz_occupancy_cumsum = None
+
+    def _flush_pending(self):
+        if self._pending_mzs:
+            mzs = np.concatenate(self._pending_mzs)
+            self._add_hist(np.bincount((mzs / MZ_HIST_BIN_WIDTH).astype(np.int64)).astype(np.int64))
+            if self._mz_occupancy is None:
+                self._mz_occupancy = np.zeros(MZ_OCCUPANCY_BIN_N, dtype=bool)
+            self._mz_occupancy[_occupancy_bins(mzs)] = True
+            self._mz_occupancy_cumsum = None
+            self._pending_mzs = []
+            self._pending_peaks_n = 0
+
+    def merge(self, other):
+        """ Merge statistics of another part of the dataset into this one """
+        self._flush_pending()
+        other._flush_pending()
+        self.spectra_n += other.spectra_n
+        self.peaks_n += other.peaks_n
+        self.max_peaks_per_spectrum = max(self.max_peaks_per_spectrum, other.max_peaks_per_spectrum)
+        self.wrong_mz_n += other.wrong_mz_n
+        self.wrong_int_n += other.wrong_int_n
+        self.mz_min = min(filter(lambda v: v is not None, [self.mz_min, other.mz_min]), default=None)
+        self.mz_max = max(filter(lambda v: v is not None, [self.mz_max, other.mz_max]), default=None)
+        self._add_hist(other._mz_hist.copy())
+        if other._mz_occupancy is not None:
+            self._add_occupancy(other._mz_occupancy)
+        return self
+
+    @property
+    def peaks_per_spectrum(self):
+        return self.peaks_n / max(1, self.spectra_n)
+
+    def mz_histogram(self):
+        """
+        Returns
+        -------
+        : tuple
+            (bin edges, peak counts) of the full resolution m/z histogram trimmed to the occupied range
+        """
+        self._flush_pending()
+        nonzero = np.nonzero(self._mz_hist)[0]
+        if nonzero.shape[0] == 0:
+            return np.zeros(1), np.zeros(0, dtype=np.int64)
+        first, last = nonzero[0], nonzero[-1] + 1
+        edges = np.arange(first, last + 1) * MZ_HIST_BIN_WIDTH
+        return edges, self._mz_hist[first:last]
+
+    def mz_occupied(self, mzs, ppm):
+        """ Check if the dataset has peaks within the ppm tolerance of the m/z values.
+        Peaks are looked up at 1 ppm bin resolution, so peaks slightly outside of the tolerance
+        may count too, but m/z values with peaks within the tolerance are never reported as empty
+
+        Args
+        ----
+        mzs : ndarray
+        ppm : float
+
+        Returns
+        -------
+        : ndarray
+            Boolean array, all True if the statistics were collected without the occupancy bitmap
+        """
+        mzs = np.asarray(mzs, dtype=np.float64)
+        self._flush_pending()
+        if self._mz_occupancy is None:
+            return np.ones(mzs.shape[0], dtype=bool)
+        if self._mz_occupancy_cumsum is None:
+            self._mz_occupancy_cumsum = np.concatenate([[0], np.cumsum(self._mz_occupancy, dtype=np.int64)])
+        left = _occupancy_bins(mzs * (1 - ppm * 1e-6))
+        right = _occupancy_bins(mzs * (1 + ppm * 1e-6))
+        return self._mz_occupancy_cumsum[right + 1] - self._mz_occupancy_cumsum[left] > 0
+
+    def check_quality(self):
+        """ Raise JobFailedError if spectra contain values out of the allowed ranges """
+        err_msgs = []
+        if self.wrong_mz_n > 0:
+            err_msgs.append('Mz arrays contain {} values outside of allowed range [0, {}]'
+                            .format(self.wrong_mz_n, MAX_MZ_VALUE))
+        if self.wrong_int_n > 0:
+            err_msgs.append('Intensity arrays contain {} values outside of allowed range [0, {}]'
+                            .format(self.wrong_int_n, MAX_INTENS_VALUE))
+        if len(err_msgs) > 0:
+            raise JobFailedError(' '.join(err_msgs))
+
+    def to_json(self):
+        edges, counts = self.mz_histogram()
+        mz_occupancy = None
+        if self._mz_occupancy is not None:
+            mz_occupancy = b64encode(zlib.compress(np.packbits(self._mz_occupancy).tobytes())).decode('ascii')
+        return json.dumps({
+            'spectra_n': self.spectra_n,
+            'peaks_n': self.peaks_n,
+            'max_peaks_per_spectrum': self.max_peaks_per_spectrum,
+            'mz_min': self.mz_min,
+            'mz_max': self.mz_max,
+            'wrong_mz_n': self.wrong_mz_n,
+            'wrong_int_n': self.wrong_int_n,
+            'mz_hist_bin_width': MZ_HIST_BIN_WIDTH,
+            'mz_hist_first_bin': int(round(edges[0] / MZ_HIST_BIN_WIDTH)),
+            'mz_hist_counts': counts.tolist(),
+            'mz_occupancy': mz_occupancy
+        })
+
+    @classmethod
+    def from_json(cls, s):
+        d = json.loads(s)
+        stats = cls()
+        for attr in ['spectra_n', 'peaks_n', 'max_peaks_per_spectrum', 'mz_min', 'mz_max',
+                     'wrong_mz_n', 'wrong_int_n']:
+            setattr(stats, attr, d[attr])
+        stats._mz_hist = np.concatenate([np.zeros(d['mz_hist_first_bin'], dtype=np.int64),
+                                         np.array(d['mz_hist_counts'], dtype=np.int64)])
+        if d.get('mz_occupancy', None):
+            packed = np.frombuffer(zlib.decompress(b64decode(d['mz_occupancy'])), dtype=np.uint8)
+            stats._mz_occupancy = np.unpackbits(packed)[:MZ_OCCUPANCY_BIN_N].astype(bool)
+        return stats
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_json())
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_json(f.read())
@@ -1,19 +1,31 @@
+import numpy as np
+import pandas as pd
+from copy import deepcopy
+from unittest.mock import MagicMock
 from scipy.sparse import coo_matrix
 
-from sm.engine.tests.util import pysparkling_context as spark_context
-from sm.engine.msm_basic.formula_imager_segm import gen_iso_sf_images
+from sm.engine.tests.util import pysparkling_context as spark_context, sm_config
+from sm.engine.msm_basic.formula_imager_segm import gen_iso_sf_images, define_mz_segments, \
+    _segment_arrays, _gen_iso_images, get_segment_files, filter_occupied_ions, _segment_centroids, \
+    _create_mz_segments, partition_centroids, gen_principal_images, gen_iso_peak_images, principal_image_filter
+from sm.engine.spectra_stats import SpectraStats
+from sm.engine.sparse_image import SparseImage
+from sm.engine.dataset_reader import DatasetReader
+from sm.engine.work_dir import WorkDirManager
+from sm.engine.util import SMConfig
 
 
 def test_gen_iso_sf_images(spark_context):
-    iso_peak_images = spark_context.parallelize([((3079, '+H'), (0, coo_matrix([[1., 0., 0.]]))),
-                                                 ((3079, '+H'), (3, coo_matrix([[2., 1., 0.]]))),
-                                                 ((3079, '+H'), (3, coo_matrix([[0., 0., 10.]])))])
+    iso_peak_images = spark_context.parallelize([((3079, '+H'), (False, (0, coo_matrix([[1., 0., 0.]])))),
+                                                 ((3079, '+H'), (False, (3, coo_matrix([[2., 1., 0.]])))),
+                                                 ((3080, '+H'), (True, [coo_matrix([[0., 0., 10.]])]))])
     exp_iso_sf_imgs = [((3079, '+H'), [coo_matrix([[1., 0., 0.]]),
                                        None,
                                        None,
-                                       coo_matrix([[2., 1., 0.]])])]
+                                       coo_matrix([[2., 1., 0.]])]),
+                       ((3080, '+H'), [coo_matrix([[0., 0., 10.]])])]
 
-    iso_sf_imgs = gen_iso_sf_images(iso_peak_images, shape=(1, 3)).collect()
+    iso_sf_imgs = sorted(gen_iso_sf_images(iso_peak_images, shape=(1, 3)).collect(), key=lambda item: item[0])
 
     assert len(iso_sf_imgs) == len(exp_iso_sf_imgs)
     for (k, l), (ek, el) in zip(iso_sf_imgs, exp_iso_sf_imgs):
@@ -24,3 +36,169 @@ def test_gen_iso_sf_images(spark_context):
                 assert m is None
             else:
                 assert (m.toarray() == em.toarray()).all()
+
+
+def test_define_mz_segments_from_stats():
+    spectra = [(i, np.array([100. + i, 500. + i, 900. + i]), np.ones(3)) for i in range(50)]
+    stats = SpectraStats().update_all(spectra)
+    sf_peak_df = pd.DataFrame({'mz': np.linspace(100, 1000, 500)})
+
+    mz_segments = define_mz_segments(stats, sf_peak_df, ppm=3)
+
+    assert len(mz_segments) > 1
+    assert mz_segments[0][0] == 0
+    lefts, rights = zip(*mz_segments)
+    assert all(r > l for l, r in mz_segments)
+    assert list(lefts) == sorted(lefts)
+
+
+def test_segment_arrays_sorted_by_mz():
+    sp_it = [(0, np.array([300., 100.]), np.array([1., 2.])),
+             (1, np.array([200.]), np.array([3.]))]
+
+    inds, mzs, ints = _segment_arrays(sp_it, sp_indexes=np.array([5, 7]))
+
+    assert list(mzs) == [100., 200., 300.]
+    assert list(inds) == [5, 7, 5]
+    assert list(ints) == [2., 3., 1.]
+
+
+def test_gen_iso_images():
+    segm_arrays = (np.array([0, 2, 1]), np.array([100., 100.0001, 200.]), np.array([1., 2., 3.]))
+    centr_df = pd.DataFrame({'mz': [100., 200., 300.], 'peak_i': [0, 1, 0]}, index=[10, 10, 11])
+
+    images = list(_gen_iso_images(segm_arrays, centr_df, nrows=1, ncols=3, ppm=3))
+
+    assert [(k, peak_i) for k, (peak_i, _) in images] == [(10, 0), (10, 1)]
+    assert (images[0][1][1].toarray() == [[1., 0., 2.]]).all()
+    assert (images[1][1][1].toarray() == [[0., 3., 0.]]).all()
+
+
+def test_get_segment_files_written_once(sm_config, spark_context, tmpdir):
+    config = deepcopy(sm_config)
+    config['fs']['base_path'] = str(tmpdir)
+    SMConfig._config_dict = config
+
+    spectra = [(i, np.array([100. + i, 500. + i]), np.array([1., 2.])) for i in range(4)]
+    ds_reader = MagicMock(DatasetReader)
+    ds_reader.spectra_wd = WorkDirManager('ds')
+    ds_reader.get_spectra.return_value = spark_context.parallelize(spectra)
+    ds_reader.get_spectra_stats.return_value = SpectraStats().update_all(spectra)
+    ds_reader.get_norm_img_pixel_inds.return_value = np.arange(4)
+
+    mz_segments, segm_arrays = get_segment_files(spark_context, ds_reader, ppm=3)
+    segments = dict(segm_arrays.collect())
+    mz_segments_2, _ = get_segment_files(spark_context, ds_reader, ppm=3)
+
+    assert ds_reader.get_spectra.call_count == 1
+    assert mz_segments_2 == mz_segments
+    peaks = np.concatenate([segments[s_i][1] for s_i in sorted(segments)])
+    assert sorted(peaks) == sorted(mz for _, mzs, _ in spectra for mz in mzs)
+    for inds, mzs, ints in segments.values():
+        assert list(mzs) == sorted(mzs)
+    assert segm_arrays.getNumPartitions() == len(mz_segments)
+    assert segm_arrays.mapPartitionsWithIndex(lambda i, it: [(i, [segm_i for segm_i, _ in it])]).collect() == \
+        [(segm_i, [segm_i]) for segm_i in range(len(mz_segments))]
+
+
+def test_filter_occupied_ions_checks_principal_peak():
+    stats = SpectraStats().update_all([(0, np.array([100., 201.]), np.array([1., 1.]))])
+    ion_centroids_df = pd.DataFrame({'ion_i': [0, 0, 1, 1],
+                                     'peak_i': [0, 1, 0, 1],
+                                     'mz': [100.0001, 300., 200., 201.],
+                                     'int': [100., 10., 100., 50.]}).set_index('ion_i')
+
+    df = filter_occupied_ions(ion_centroids_df, stats, ppm=3)
+
+    assert df.index.tolist() == [0, 0]
+
+
+def test_segment_centroids_cover_ppm_windows():
+    ppm = 3
+    mz_segments = _create_mz_segments([150., 200., 200.0002, 300.], ppm)
+    mzs = np.array([100., 150., 150.0001, 199.9999, 200.0001, 250., 1000.])
+    ion_centroids_df = pd.DataFrame({'ion_i': np.arange(mzs.shape[0]), 'peak_i': 0,
+                                     'mz': mzs, 'int': 100.}).set_index('ion_i')
+
+    segm_centroids = _segment_centroids(ion_centroids_df, mz_segments, ppm)
+
+    assert sorted(i for _, df in segm_centroids for i in df.index) == list(range(mzs.shape[0]))
+    for segm_i, df in segm_centroids:
+        l, r = mz_segments[segm_i]
+        assert np.all(df.mz * (1 - ppm * 1e-6) >= l) and np.all(df.mz * (1 + ppm * 1e-6) <= r)
+
+
+def test_segment_centroids_own_each_peak_once():
+    ppm = 3
+    mz_segments = _create_mz_segments([150., 200., 200.0002, 300.], ppm)
+    ion_centroids_df = pd.DataFrame({'ion_i': [0, 0, 1, 1],
+                                     'peak_i': [0, 1, 0, 1],
+                                     'mz': [160., 161., 199., 201.],
+                                     'int': 100.}).set_index('ion_i')
+
+    segm_centroids = _segment_centroids(ion_centroids_df, mz_segments, ppm)
+
+    centr_df = pd.concat([df for _, df in segm_centroids])
+    assert sorted(zip(centr_df.index, centr_df.peak_i)) == [(0, 0), (0, 1), (1, 0), (1, 1)]
+    assert centr_df.loc[0].complete.all() and not centr_df.loc[1].complete.any()
+    assert len([segm_i for segm_i, df in segm_centroids if 0 in df.index]) == 1
+
+
+def test_segment_centroids_without_principal_peaks_complete():
+    ppm = 3
+    mz_segments = _create_mz_segments([150., 200., 200.0002, 300.], ppm)
+    ion_centroids_df = pd.DataFrame({'ion_i': [0, 0, 1, 1],
+                                     'peak_i': [1, 2, 1, 2],
+                                     'mz': [161., 162., 199., 201.],
+                                     'int': 100.}).set_index('ion_i')
+
+    segm_centroids = _segment_centroids(ion_centroids_df, mz_segments, ppm)
+
+    centr_df = pd.concat([df for _, df in segm_centroids])
+    assert centr_df.loc[0].complete.all() and not centr_df.loc[1].complete.any()
+
+
+def test_gen_iso_peak_images_only_for_passed_principal_images(spark_context):
+    ppm = 3
+    mz_segments = _create_mz_segments([150., 200., 200.0002, 300.], ppm)
+    ion_centroids_df = pd.DataFrame({'ion_i': [0, 0, 1, 1, 2, 2],
+                                     'peak_i': [0, 1, 0, 1, 0, 1],
+                                     'mz': [161., 162., 199., 201., 250., 251.],
+                                     'int': 100.}).set_index('ion_i')
+    spectra = [(0, np.array([161., 162., 199., 201., 250., 251.]), np.array([1., 2., 3., 4., 5., 6.]))]
+    segm_arrays = spark_context.parallelize(
+        [(segm_i, _segment_arrays([(sp_i, mzs[(mzs >= l) & (mzs <= r)], ints[(mzs >= l) & (mzs <= r)])
+                                   for sp_i, mzs, ints in spectra], np.array([0])))
+         for segm_i, (l, r) in enumerate(mz_segments)], numSlices=len(mz_segments))
+    ds_reader = MagicMock(spec=DatasetReader)
+    ds_reader.get_dims.return_value = (1, 1)
+
+    segm_centroids, ion_segments = partition_centroids(spark_context, ion_centroids_df, mz_segments, ppm)
+    principal_images = gen_principal_images(ds_reader, segm_arrays, segm_centroids, ppm,
+                                            passes=lambda img: img.sum() < 5)
+    iso_peak_images = gen_iso_peak_images(spark_context, ds_reader, segm_arrays, segm_centroids,
+                                          ion_segments, principal_images, ppm).collect()
+    iso_sf_images = dict(gen_iso_sf_images(spark_context.parallelize(iso_peak_images), shape=(1, 1)).collect())
+
+    assert sorted(ion for ion, (complete, _) in iso_peak_images if complete) == [0]
+    assert sorted(iso_sf_images) == [0, 1]
+    assert [img.sum() for img in iso_sf_images[0]] == [1., 2.]
+    assert [img.sum() for img in iso_sf_images[1]] == [3., 4.]
+
+
+def test_principal_image_filter_thresholds_from_ds_config_then_engine_defaults(sm_config):
+    img = SparseImage(np.array([0, 2]), np.array([1., 3.]), (1, 3))
+    empty_img = SparseImage(np.zeros(0, dtype=np.int32), np.zeros(0), (1, 3))
+    config = deepcopy(sm_config)
+    config['defaults']['image_generation'] = {'principal_min_px': 1, 'principal_min_int': 5.}
+    SMConfig._config_dict = config
+    try:
+        assert not principal_image_filter({})(img)
+        assert principal_image_filter({'principal_min_int': 4.})(img)
+        assert not principal_image_filter({'principal_min_px': 3, 'principal_min_int': 0.})(img)
+
+        del config['defaults']['image_generation']
+        assert principal_image_filter({})(img)
+        assert not principal_image_filter({})(empty_img)
+    finally:
+        SMConfig._config_dict = sm_config
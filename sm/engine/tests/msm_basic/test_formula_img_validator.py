@@ -1,4 +1,5 @@
 from collections import OrderedDict
+from copy import deepcopy
 
 import numpy as np
 import pandas as pd
@@ -7,13 +8,17 @@ from unittest.mock import patch, MagicMock
 from numpy.testing import assert_array_almost_equal
 from pandas.util.testing import assert_frame_equal
 from scipy.sparse import csr_matrix
+from pyImagingMSpec.image_measures import isotope_image_correlation, isotope_pattern_match
+
+from sm.engine.sparse_image import SparseImage
 
 from sm.engine.dataset_manager import DatasetManager, Dataset
 from sm.engine import DatasetReader
 from sm.engine.fdr import FDR
 from sm.engine.mol_db import MolecularDB
-from sm.engine.msm_basic.formula_img_validator import ImgMetrics
-from sm.engine.msm_basic.formula_img_validator import sf_image_metrics, get_compute_img_metrics
+from sm.engine.msm_basic.formula_img_validator import ImgMetrics, _sampled_pixel_vector
+from sm.engine.msm_basic.formula_img_validator import sf_image_metrics, get_compute_img_metrics, \
+    get_compute_batch_img_metrics
 from sm.engine.tests.util import pysparkling_context as spark_context, ds_config, sm_config
 
 
@@ -26,16 +31,14 @@ def test_get_compute_img_measures_pass(chaos_mock, image_corr_mock, pattern_matc
         'do_preprocessing': False,
         'q': 99.0
     }
-    empty_matrix = np.zeros((2, 3))
     metrics = OrderedDict([('chaos', 0), ('spatial', 0), ('spectral', 0),
                            ('total_iso_ints', [0, 0, 0, 0]),
                            ('min_iso_ints', [0, 0, 0, 0]),
                            ('max_iso_ints', [0, 0, 0, 0])])
-    compute_measures = get_compute_img_metrics(metrics, np.ones(2*3).astype(bool),
-                                               empty_matrix, img_gen_conf)
+    compute_measures = get_compute_img_metrics(metrics, np.arange(2*3), (2, 3), img_gen_conf)
 
-    sf_iso_images = [csr_matrix([[0., 100., 100.], [10., 0., 3.]]),
-                     csr_matrix([[0., 50., 50.], [0., 20., 0.]])]
+    sf_iso_images = [SparseImage([1, 2, 3, 5], [100., 100., 10., 3.], (2, 3)),
+                     SparseImage([1, 2, 4], [50., 50., 20.], (2, 3))]
     sf_intensity = [100., 10., 1.]
 
     measures = compute_measures(sf_iso_images, sf_intensity)
@@ -50,6 +53,7 @@ def ds_formulas_images_mock():
     ds_reader_mock = MagicMock(spec=DatasetReader)
     ds_reader_mock.get_dims.return_value = (2, 3)
     ds_reader_mock.get_sample_area_mask.return_value = np.ones(2*3).astype(bool)
+    ds_reader_mock.get_norm_img_pixel_inds.return_value = np.arange(2*3)
 
     sf_iso_images = [(0, [csr_matrix([[0, 100, 100], [10, 0, 3]]), csr_matrix([[0, 50, 50], [0, 20, 0]])]),
                      (1, [csr_matrix([[0, 100, 100], [10, 0, 3]]), csr_matrix([[0, 50, 50], [0, 20, 0]])])]
@@ -58,8 +62,9 @@ def ds_formulas_images_mock():
 
 
 def test_sf_image_metrics(spark_context, ds_formulas_images_mock, ds_config):
-    with patch('sm.engine.msm_basic.formula_img_validator.get_compute_img_metrics') as mock:
-        mock.return_value = lambda *args: (0.9, 0.9, 0.9, [100., 10.], [0, 0], [10., 1.])
+    with patch('sm.engine.msm_basic.formula_img_validator.get_compute_batch_img_metrics') as mock:
+        mock.return_value = lambda ion_images, ion_centr_ints: [(ion, 0.9, 0.9, 0.9, [100., 10.], [0, 0], [10., 1.])
+                                                                for ion, _ in ion_images]
 
         ds_mock, ds_reader_mock, ref_images = ds_formulas_images_mock
         ref_images_rdd = spark_context.parallelize(ref_images)
@@ -84,3 +89,113 @@ def test_sf_image_metrics(spark_context, ds_formulas_images_mock, ds_config):
 def test_img_measures_replace_invalid_measure_values(nan_value):
     invalid_img_measures = ImgMetrics(OrderedDict([('chaos', None), ('spatial', np.NAN), ('spectral', np.inf)]))
     assert invalid_img_measures.to_tuple(replace_nan=True) == (0., 0., 0.)
+
+
+@patch('sm.engine.msm_basic.formula_img_validator.measure_of_chaos', return_value=0.99)
+def test_get_compute_img_metrics_sampled_pixels_only(chaos_mock):
+    img_gen_conf = {'nlevels': 30, 'do_preprocessing': False, 'q': 99.0}
+    metrics = OrderedDict([('chaos', 0), ('spatial', 0), ('spectral', 0),
+                           ('total_iso_ints', [0, 0]),
+                           ('min_iso_ints', [0, 0]),
+                           ('max_iso_ints', [0, 0])])
+    shape = (100, 100)
+    sampled_pixel_inds = np.array([7, 500, 9999])
+    sf_iso_images = [SparseImage([7, 500, 9999], [1., 2., 3.], shape),
+                     SparseImage([7, 500, 9999], [2., 4., 6.], shape)]
+
+    compute_measures = get_compute_img_metrics(metrics, sampled_pixel_inds, shape, img_gen_conf)
+    chaos, spatial, spectral, total_ints, min_ints, max_ints = compute_measures(sf_iso_images, [100., 50.])
+
+    assert spatial == pytest.approx(1.)
+    assert total_ints == [6., 12.]
+    assert min_ints == [0., 0.]
+    assert max_ints == [3., 6.]
+    assert chaos_mock.call_args[0][0].shape == shape
+
+
+@pytest.mark.parametrize('do_preprocessing', [False, True])
+def test_batch_img_metrics_same_as_single_ion(do_preprocessing):
+    img_gen_conf = {'nlevels': 30, 'do_preprocessing': do_preprocessing, 'q': 99.0}
+    metrics = OrderedDict([('chaos', 0), ('spatial', 0), ('spectral', 0),
+                           ('total_iso_ints', [0, 0, 0, 0]),
+                           ('min_iso_ints', [0, 0, 0, 0]),
+                           ('max_iso_ints', [0, 0, 0, 0])])
+    shape = (10, 20)
+    rs = np.random.RandomState(0)
+    sampled_pixel_inds = np.sort(rs.choice(np.arange(200), 150, replace=False))
+
+    def random_image(px_n):
+        inds = np.sort(rs.choice(np.arange(200), px_n, replace=False))
+        return SparseImage(inds, rs.uniform(1, 100, px_n), shape)
+
+    ion_images, ion_centr_ints = [], {}
+    for ion in range(40):
+        peak_n = rs.randint(1, 5)
+        images = [random_image(rs.randint(0, 50)) if rs.uniform() > 0.1 else None for _ in range(peak_n)]
+        ion_images.append((ion, images[:rs.randint(1, peak_n + 1)]))
+        ion_centr_ints[ion] = list(rs.uniform(1, 100, peak_n))
+    ion_images.append((40, [SparseImage([sampled_pixel_inds[0]], [1.], shape), None]))
+    ion_centr_ints[40] = [100., 50.]
+    principal_img = random_image(60)
+    ion_images.append((41, [principal_img] + [SparseImage(principal_img.inds, principal_img.vals * k +
+                                                          rs.uniform(0, 10, principal_img.nnz), shape)
+                                              for k in [0.5, 0.1]]))
+    ion_centr_ints[41] = [100., 50., 10.]
+
+    compute_metrics = get_compute_img_metrics(deepcopy(metrics), sampled_pixel_inds, shape, img_gen_conf)
+    compute_batch_metrics = get_compute_batch_img_metrics(metrics, sampled_pixel_inds, shape, img_gen_conf)
+    batch_metrics = compute_batch_metrics(ion_images, ion_centr_ints)
+
+    assert [ion for ion, *_ in batch_metrics] == [ion for ion, _ in ion_images]
+    for (ion, images), (_, *ion_metrics) in zip(ion_images, batch_metrics):
+        exp_metrics = compute_metrics(images, ion_centr_ints[ion])
+        for value, exp_value in zip(ion_metrics, exp_metrics):
+            assert value == pytest.approx(exp_value)
+
+
+@pytest.mark.parametrize('max_density', [0, 1])
+@patch('sm.engine.msm_basic.formula_img_validator.measure_of_chaos', return_value=0.99)
+def test_batch_sparse_and_dense_scores_same_as_reference(chaos_mock, max_density):
+    img_gen_conf = {'nlevels': 30, 'do_preprocessing': False, 'q': 99.0}
+    metrics = OrderedDict([('chaos', 0), ('spatial', 0), ('spectral', 0),
+                           ('total_iso_ints', [0, 0, 0]),
+                           ('min_iso_ints', [0, 0, 0]),
+                           ('max_iso_ints', [0, 0, 0])])
+    shape = (100, 100)
+    sampled_pixel_inds = np.arange(0, 10000, 2)
+    rs = np.random.RandomState(1)
+    inds = np.sort(rs.choice(np.arange(10000), 200, replace=False))
+    vals = rs.uniform(1, 100, 200)
+    sf_iso_images = [SparseImage(inds, vals, shape),
+                     SparseImage(inds[::2], vals[::2] * 0.5 + rs.uniform(0, 5, 100), shape),
+                     SparseImage(inds[50:60], vals[50:60], shape)]
+    sf_ints = [100., 40., 5.]
+
+    compute_measures = get_compute_batch_img_metrics(metrics, sampled_pixel_inds, shape, img_gen_conf)
+    with patch('sm.engine.msm_basic.formula_img_validator.SPARSE_SCORING_MAX_DENSITY', max_density):
+        [(_, chaos, spatial, spectral, *_)] = compute_measures([(0, sf_iso_images)], {0: sf_ints})
+
+    iso_imgs_flat = [_sampled_pixel_vector(img, sampled_pixel_inds) for img in sf_iso_images]
+    assert spatial == pytest.approx(isotope_image_correlation(iso_imgs_flat, weights=sf_ints[1:]))
+    assert spectral == pytest.approx(isotope_pattern_match(iso_imgs_flat, sf_ints))
+    assert 0 < spatial < 1 and 0 < spectral < 1
+
+
+def test_batch_img_metrics_split_into_column_limited_chunks():
+    img_gen_conf = {'nlevels': 30, 'do_preprocessing': False, 'q': 99.0}
+    metrics = OrderedDict([('chaos', 0), ('spatial', 0), ('spectral', 0),
+                           ('total_iso_ints', [0, 0]),
+                           ('min_iso_ints', [0, 0]),
+                           ('max_iso_ints', [0, 0])])
+    shape = (4, 5)
+    sampled_pixel_inds = np.arange(20)
+    ion_images = [(ion, [SparseImage(np.arange(20), np.arange(20) + ion + 1., shape),
+                         SparseImage(np.arange(20), (np.arange(20) + ion + 1.) ** 2, shape)]) for ion in range(5)]
+    ion_centr_ints = {ion: [100., 50.] for ion in range(5)}
+
+    compute_measures = get_compute_batch_img_metrics(metrics, sampled_pixel_inds, shape, img_gen_conf)
+    exp_metrics = compute_measures(ion_images, ion_centr_ints)
+    with patch('sm.engine.msm_basic.formula_img_validator.METRICS_BATCH_MAX_COLUMNS', 50):
+        chunk_metrics = compute_measures(ion_images, ion_centr_ints)
+
+    assert chunk_metrics == exp_metrics
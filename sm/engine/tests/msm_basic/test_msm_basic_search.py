@@ -2,12 +2,15 @@ from unittest.mock import MagicMock
 from pandas.util.testing import assert_frame_equal
 from scipy.sparse import csr_matrix
 import pandas as pd
+from pyspark import StorageLevel
 
 from sm.engine import MolecularDB
 from sm.engine.fdr import FDR
 from sm.engine.ion_centroids_gen import IonCentroidsGenerator
+from sm.engine.ion_catalog import IonCatalog
 from sm.engine.msm_basic.msm_basic_search import MSMBasicSearch
-from sm.engine.tests.util import pysparkling_context as spark_context
+from sm.engine.util import SMConfig
+from sm.engine.tests.util import pysparkling_context as spark_context, sm_config
 
 
 def test_filter_sf_images(spark_context):
@@ -39,8 +42,9 @@ def test_add_sf_image_est_fdr():
                                          columns=['ion_i', 'sf', 'adduct']).set_index('ion_i')
 
     fdr_mock = MagicMock(spec=FDR)
-    fdr_mock.estimate_fdr.return_value = pd.DataFrame([['H2O', '+H', 0.99], ['C2H2', '+H', 0.5]],
-                                                      columns=['sf', 'adduct', 'fdr']).set_index(['sf', 'adduct'])
+    fdr_mock.catalog = IonCatalog(['H2O', 'C2H2'], ['+H'])
+    fdr_mock.estimate_ion_fdr.return_value = pd.DataFrame(
+        {'fdr': [0.99, 0.5]}, index=fdr_mock.catalog.ion_ids(['H2O', 'C2H2'], ['+H', '+H']))
 
     search_alg = MSMBasicSearch(sc=None, ds=None, ds_reader=None, mol_db=None,
                                 centr_gen=centr_gen_mock, fdr=fdr_mock, ds_config=None)
@@ -53,3 +57,89 @@ def test_add_sf_image_est_fdr():
                                    [1, 0.5, 0.5, 0.5, [100.], [0], [10.], 0.5**3, 'C2H2', '+H', 0.5]],
                                   columns=exp_col_list).set_index(['ion_i'])
     assert_frame_equal(res_metrics_df, exp_metrics_df)
+
+
+def test_persisted_rdds_are_unpersisted(sm_config):
+    SMConfig._config_dict = sm_config
+    search_alg = MSMBasicSearch(sc=None, ds=None, ds_reader=None, mol_db=None,
+                                centr_gen=None, fdr=None, ds_config=None)
+    rdd_mock = MagicMock()
+    rdd_mock.persist.return_value = rdd_mock
+
+    assert search_alg.persist(rdd_mock) is rdd_mock
+    rdd_mock.persist.assert_called_once_with(StorageLevel.MEMORY_AND_DISK)
+
+    search_alg.unpersist()
+    rdd_mock.unpersist.assert_called_once_with()
+
+
+def test_unpersist_keeps_given_rdds(sm_config):
+    SMConfig._config_dict = sm_config
+    search_alg = MSMBasicSearch(sc=None, ds=None, ds_reader=None, mol_db=None,
+                                centr_gen=None, fdr=None, ds_config=None)
+    rdd_mocks = [MagicMock(), MagicMock()]
+    for rdd_mock in rdd_mocks:
+        rdd_mock.persist.return_value = rdd_mock
+        search_alg.persist(rdd_mock)
+
+    search_alg.unpersist(keep=[rdd_mocks[1]])
+    rdd_mocks[0].unpersist.assert_called_once_with()
+    rdd_mocks[1].unpersist.assert_not_called()
+
+    search_alg.unpersist()
+    rdd_mocks[1].unpersist.assert_called_once_with()
+
+
+def test_search_multi_computes_images_once(spark_context, sm_config):
+    SMConfig._config_dict = sm_config
+    ion_df = pd.DataFrame({'ion_i': [0, 1, 2, 3],
+                           'sf': ['H2O', 'H2O', 'C2H2', 'CO2'],
+                           'adduct': ['+H', '+He', '+H', '+H']}).set_index('ion_i')
+    catalog = IonCatalog(ion_df.sf, ion_df.adduct)
+    centr_gens, fdrs = [], []
+    for ion_inds in [[0, 1, 2], [0, 1, 3]]:
+        centr_gen_mock = MagicMock(spec=IonCentroidsGenerator)
+        centr_gen_mock.ion_df = ion_df.loc[ion_inds]
+        centr_gen_mock.ion_centroids_df = pd.DataFrame({'ion_i': ion_inds, 'peak_i': 0,
+                                                        'mz': [100. + i for i in ion_inds],
+                                                        'int': 100.}).set_index('ion_i')
+        centr_gens.append(centr_gen_mock)
+        fdr_mock = MagicMock(spec=FDR)
+        fdr_mock.catalog = catalog
+        fdr_mock.ion_index.return_value = pd.MultiIndex.from_frame(ion_df.loc[ion_inds, ['sf', 'adduct']])
+        fdr_mock.ion_ids.return_value = catalog.ion_ids(ion_df.loc[ion_inds].sf, ion_df.loc[ion_inds].adduct)
+        fdr_mock.estimate_ion_fdr.side_effect = lambda msm: msm.to_frame('fdr').assign(fdr=0.1)
+        fdrs.append(fdr_mock)
+
+    search_alg = MSMBasicSearch(sc=spark_context, ds=None, ds_reader=None, mol_db=None,
+                                centr_gen=None, fdr=None, ds_config=None)
+    search_alg.compute_images_metrics = MagicMock()
+    search_alg.compute_images_metrics.side_effect = lambda centr_df: (
+        spark_context.parallelize([(i, []) for i in centr_df.index.unique()]),
+        pd.DataFrame({'ion_i': sorted(centr_df.index.unique()), 'msm': 0.9}).set_index('ion_i'))
+
+    ion_metrics_dfs, ion_images = search_alg.search_multi(centr_gens, fdrs)
+
+    search_alg.compute_images_metrics.assert_called_once()
+    centr_df = search_alg.compute_images_metrics.call_args[0][0]
+    assert centr_df.shape[0] == 4
+    assert [sorted(zip(df.sf, df.adduct)) for df in ion_metrics_dfs] == \
+        [[('C2H2', '+H'), ('H2O', '+H'), ('H2O', '+He')], [('CO2', '+H'), ('H2O', '+H'), ('H2O', '+He')]]
+    assert sorted(dict(ion_images.collect()).keys()) == [0, 1, 2, 3]
+
+
+def test_estimate_fdr_fans_out_metrics_of_same_ions():
+    sf_metrics_df = pd.DataFrame({'ion_i': [0], 'msm': [0.9]}).set_index('ion_i')
+    ion_df = pd.DataFrame([[0, 'C6H12O6', '+H'], [0, 'C6H11O6', '+H2']],
+                          columns=['ion_i', 'sf', 'adduct']).set_index('ion_i')
+    fdr_mock = MagicMock(spec=FDR)
+    fdr_mock.catalog = IonCatalog(ion_df.sf, ion_df.adduct)
+    fdr_mock.estimate_ion_fdr.side_effect = lambda msm: msm.to_frame('fdr').assign(fdr=0.1)
+
+    search_alg = MSMBasicSearch(sc=None, ds=None, ds_reader=None, mol_db=None,
+                                centr_gen=None, fdr=None, ds_config=None)
+    res_metrics_df = search_alg.estimate_fdr(sf_metrics_df, ion_df=ion_df, fdr=fdr_mock)
+
+    assert res_metrics_df.index.tolist() == [0, 0]
+    assert sorted(res_metrics_df.sf) == ['C6H11O6', 'C6H12O6']
+    assert res_metrics_df.msm.tolist() == [0.9, 0.9]
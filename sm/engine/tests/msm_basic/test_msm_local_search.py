@@ -0,0 +1,92 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from unittest.mock import MagicMock
+import numpy as np
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+
+from sm.engine.dataset_reader import DatasetReader
+from sm.engine.dataset_manager import Dataset
+from sm.engine.msm_basic.msm_local_search import MSMLocalSearch
+from sm.engine.msm_basic.msm_basic_search import MSMBasicSearch
+from sm.engine.msm_basic.formula_img_validator import sf_image_metrics
+from sm.engine.spectra_stats import SpectraStats
+from sm.engine.util import SMConfig
+from sm.engine.tests.util import pysparkling_context as spark_context, sm_config, ds_config
+
+
+def _ds_reader_mock(spark_context):
+    rs = np.random.RandomState(0)
+    spectra = [(sp_id, np.sort(rs.choice([100., 100.0001, 101., 200., 201.], 3, replace=False)),
+                rs.uniform(1, 10, 3)) for sp_id in range(12)]
+    ds_reader = MagicMock(spec=DatasetReader)
+    ds_reader.get_dims.return_value = (3, 4)
+    ds_reader.get_norm_img_pixel_inds.return_value = np.arange(12)
+    ds_reader.get_spectra.return_value = spark_context.parallelize(spectra)
+    ds_reader.get_spectra_stats.return_value = SpectraStats().update_all(spectra)
+    ds_reader.iter_spectra.side_effect = lambda: iter(spectra)
+    return ds_reader
+
+
+def _ion_centroids_df():
+    return pd.DataFrame({'ion_i': [0, 0, 1, 1],
+                         'peak_i': [0, 1, 0, 1],
+                         'mz': [100., 101., 200., 201.],
+                         'int': [100., 10., 100., 50.]}).set_index('ion_i')
+
+
+def test_local_search_same_as_spark(spark_context, sm_config, ds_config):
+    SMConfig._config_dict = sm_config
+    ds = Dataset('ds_id')
+    ds.config = ds_config
+    ds_reader = _ds_reader_mock(spark_context)
+    ion_centroids_df = _ion_centroids_df()
+
+    search_alg = MSMLocalSearch(ds=ds, ds_reader=ds_reader, mol_db=None, centr_gen=None,
+                                fdr=None, ds_config=ds_config, processes=2)
+    with ProcessPoolExecutor(max_workers=2) as search_alg._pool:
+        local_images = search_alg.compute_sf_images(ion_centroids_df)
+        local_metrics_df = search_alg.calc_metrics(local_images, ion_centroids_df)
+
+    spark_search_alg = MSMBasicSearch(sc=spark_context, ds=ds, ds_reader=ds_reader, mol_db=None, centr_gen=None,
+                                      fdr=None, ds_config=ds_config)
+    spark_images = spark_search_alg.compute_sf_images(ion_centroids_df).collect()
+    ion_centr_ints = {0: [100., 10.], 1: [100., 50.]}
+    spark_metrics_df = sf_image_metrics(spark_context.parallelize(spark_images), search_alg.metrics, ds,
+                                        ds_reader, ion_centr_ints, spark_context)
+
+    assert [ion for ion, _ in local_images] == sorted(ion for ion, _ in spark_images)
+    for ion, images in local_images:
+        exp_images = dict(spark_images)[ion]
+        assert [img.toarray().tolist() for img in images] == [img.toarray().tolist() for img in exp_images]
+    assert_frame_equal(local_metrics_df, spark_metrics_df.sort_index())
+
+
+def test_filter_sf_images_works_with_lists():
+    search_alg = MSMLocalSearch(ds=None, ds_reader=None, mol_db=None, centr_gen=None,
+                                fdr=None, ds_config=None)
+    sf_metrics_df = pd.DataFrame({'ion_i': [1], 'msm': [0.9]}).set_index('ion_i')
+
+    assert search_alg.filter_sf_images([(0, []), (1, [])], sf_metrics_df) == [(1, [])]
+
+
+def test_ions_with_weak_principal_image_rejected(spark_context, sm_config, ds_config):
+    SMConfig._config_dict = sm_config
+    ds = Dataset('ds_id')
+    ds.config = ds_config
+    ds_reader = _ds_reader_mock(spark_context)
+    ion_centroids_df = _ion_centroids_df()
+    search_alg = MSMLocalSearch(ds=ds, ds_reader=ds_reader, mol_db=None, centr_gen=None,
+                                fdr=None, ds_config=ds_config, processes=2)
+    spark_search_alg = MSMBasicSearch(sc=spark_context, ds=ds, ds_reader=ds_reader, mol_db=None, centr_gen=None,
+                                      fdr=None, ds_config=ds_config)
+
+    with ProcessPoolExecutor(max_workers=2) as search_alg._pool:
+        principal_ints = {ion: images[0].sum() for ion, images in search_alg.compute_sf_images(ion_centroids_df)}
+        ds_config['image_generation']['principal_min_int'] = max(principal_ints.values())
+        local_images = search_alg.compute_sf_images(ion_centroids_df)
+    spark_images = spark_search_alg.compute_sf_images(ion_centroids_df).collect()
+
+    exp_ions = [max(principal_ints, key=principal_ints.get)]
+    assert [ion for ion, _ in local_images] == exp_ions
+    assert [ion for ion, _ in spark_images] == exp_ions
@@ -0,0 +1,97 @@
+from copy import deepcopy
+from os import makedirs, utime
+from os.path import join, exists
+from unittest.mock import MagicMock
+
+import pytest
+
+from sm.engine.conversion_cache import ConversionCache
+from sm.engine.util import SMConfig
+from sm.engine.tests.util import sm_config
+
+
+@pytest.fixture()
+def cache_config(sm_config, tmpdir):
+    config = deepcopy(sm_config)
+    config['fs']['base_path'] = str(tmpdir)
+    config['fs']['s3_base_path'] = ''
+    config['fs']['conversion_cache'] = {'local_max_size_gb': 1e-6}  # ~1KB
+    SMConfig._config_dict = config
+    yield config
+    SMConfig._config_dict = sm_config
+
+
+def create_input(path, ibd_content):
+    makedirs(path, exist_ok=True)
+    with open(join(path, 'ds.imzML'), 'w') as f:
+        f.write('<imzML/>')
+    with open(join(path, 'ds.ibd'), 'w') as f:
+        f.write(ibd_content)
+    with open(join(path, 'meta.json'), 'w') as f:
+        f.write('{}')
+
+
+def test_key_depends_on_content_only(cache_config, tmpdir):
+    create_input(join(str(tmpdir), 'input_1'), 'spectra')
+    create_input(join(str(tmpdir), 'input_2'), 'spectra')
+    create_input(join(str(tmpdir), 'input_3'), 'other spectra')
+    with open(join(str(tmpdir), 'input_2', 'meta.json'), 'w') as f:
+        f.write('{"a": 1}')
+
+    cache = ConversionCache(MagicMock())
+    keys = [cache.key(join(str(tmpdir), 'input_{}'.format(i))) for i in [1, 2, 3]]
+
+    assert keys[0] == keys[1]
+    assert keys[0] != keys[2]
+
+
+def test_evict_removes_least_recently_used_entries(cache_config, tmpdir):
+    cache = ConversionCache(MagicMock())
+    for i, key in enumerate(['a', 'b', 'c']):
+        cache.touch(key)
+        entry_dir = cache.entry(key).local_dir.ds_path
+        with open(join(entry_dir, 'ds.txt'), 'w') as f:
+            f.write('x' * 500)
+        utime(join(entry_dir, '.last_used'), (1000 + i, 1000 + i))
+    cache.touch('a')
+
+    cache.evict(keep_key='a')
+
+    cache_path = join(str(tmpdir), 'conversion_cache')
+    assert exists(join(cache_path, 'a'))
+    assert not exists(join(cache_path, 'b'))
+    assert exists(join(cache_path, 'c'))
+
+
+def test_key_of_unchanged_files_not_recomputed(cache_config, tmpdir):
+    input_path = join(str(tmpdir), 'input')
+    create_input(input_path, 'spectra')
+    ibd_path = join(input_path, 'ds.ibd')
+    utime(ibd_path, (1000, 1000))
+
+    cache = ConversionCache(MagicMock())
+    key = cache.key(input_path)
+    with open(ibd_path, 'w') as f:
+        f.write('SPECTRA')
+    utime(ibd_path, (1000, 1000))
+    assert cache.key(input_path) == key
+
+    utime(ibd_path, (2000, 2000))
+    assert cache.key(input_path) != key
+
+
+def test_evict_keeps_entries_used_within_grace_period(cache_config, tmpdir):
+    cache = ConversionCache(MagicMock())
+    for i, key in enumerate(['a', 'b', 'c']):
+        cache.touch(key)
+        entry_dir = cache.entry(key).local_dir.ds_path
+        with open(join(entry_dir, 'ds.txt'), 'w') as f:
+            f.write('x' * 700)
+    utime(join(cache.entry('a').local_dir.ds_path, '.last_used'), (1000, 1000))
+
+    cache.evict(keep_key='c')
+
+    cache_path = join(str(tmpdir), 'conversion_cache')
+    assert not exists(join(cache_path, 'a'))
+    assert exists(join(cache_path, 'b'))
+    assert exists(join(cache_path, 'c'))
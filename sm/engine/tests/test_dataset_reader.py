@@ -1,3 +1,4 @@
+from copy import deepcopy
 import pytest
 import numpy as np
 from unittest.mock import patch, MagicMock
@@ -5,6 +6,9 @@ from numpy.testing import assert_array_equal
 
 from sm.engine import DatasetReader, DB
 from sm.engine.work_dir import WorkDirManager
+from sm.engine.ms_npy_converter import encode_spectra_chunk
+from sm.engine.conversion_cache import ConversionCache
+from sm.engine.spectra_stats import SpectraStats
 from sm.engine.util import SMConfig
 from sm.engine.tests.util import sm_config, ds_config
 from sm.engine.tests.util import pysparkling_context as spark_context
@@ -46,3 +50,111 @@ def test_dataset_reader_get_spectra_works(sm_config, spark_context):
         second_spectra = spectra_list[1]
         assert_array_equal(second_spectra[1], np.array([200.0, 300.0]))
         assert_array_equal(second_spectra[2], np.array([10.0, 20.0]))
+
+
+def test_dataset_reader_get_spectra_npy_format_works(sm_config, spark_context):
+    work_dir_man_mock = MagicMock(WorkDirManager)
+    work_dir_man_mock.npy_path = '/npy_path'
+    SMConfig._config_dict = sm_config
+
+    chunk = encode_spectra_chunk([0, 2],
+                                 [np.array([100.0, 200.0]), np.array([200.0, 300.0])],
+                                 [np.array([1000.0, 0]), np.array([10.0, 20.0])])
+    with patch('sm.engine.tests.util.SparkContext.binaryFiles', create=True) as m:
+        m.return_value = spark_context.parallelize([('/npy_path/chunk_00000.npz', chunk)])
+
+        ds_reader = DatasetReader('input_path', spark_context, work_dir_man_mock)
+        ds_reader._spectra_format = 'npy'
+        spectra_list = ds_reader.get_spectra().collect()
+
+        assert [t[0] for t in spectra_list] == [0, 2]
+        assert_array_equal(spectra_list[0][1], np.array([100.0, 200.0]))
+        assert_array_equal(spectra_list[1][2], np.array([10.0, 20.0]))
+
+
+def test_dataset_reader_computes_spectra_stats_once(sm_config, spark_context, tmpdir):
+    work_dir_man_mock = MagicMock(WorkDirManager)
+    work_dir_man_mock.local_fs_only = True
+    work_dir_man_mock.local_dir = MagicMock(ds_path=str(tmpdir), stats_path=str(tmpdir.join('ds_stats.json')))
+    SMConfig._config_dict = sm_config
+
+    with patch('sm.engine.tests.util.SparkContext.textFile') as m:
+        m.side_effect = [spark_context.parallelize([b'0|100.0 200.0|1000.0 1\n', b'2|200.0 300.0|10.0 20.0\n'])]
+
+        ds_reader = DatasetReader('input_path', spark_context, work_dir_man_mock)
+        stats = ds_reader.get_spectra_stats()
+
+        assert stats.spectra_n == 2
+        assert stats.peaks_n == 4
+        assert ds_reader.get_spectra_stats() is stats
+        assert m.call_count == 1
+        assert tmpdir.join('ds_stats.json').check()
+
+
+def test_dataset_reader_iter_spectra_npy_format_without_spark(sm_config, tmpdir):
+    work_dir_man_mock = MagicMock(WorkDirManager)
+    work_dir_man_mock.local_dir = MagicMock(npy_path=str(tmpdir))
+    SMConfig._config_dict = sm_config
+
+    chunk = encode_spectra_chunk([0, 2],
+                                 [np.array([100.0, 200.0]), np.array([200.0, 300.0])],
+                                 [np.array([1000.0, 0]), np.array([10.0, 20.0])])
+    tmpdir.join('chunk_00000.npz').write_binary(chunk)
+    tmpdir.join('_SUCCESS').write('')
+
+    ds_reader = DatasetReader('input_path', None, work_dir_man_mock)
+    ds_reader._spectra_format = 'npy'
+    spectra_list = list(ds_reader.iter_spectra())
+
+    assert [t[0] for t in spectra_list] == [0, 2]
+    assert_array_equal(spectra_list[1][1], np.array([200.0, 300.0]))
+
+
+class FakeTxtConverter(object):
+
+    def __init__(self, out_dir, fail):
+        self.out_dir = out_dir
+        self.fail = fail
+        self.stats = SpectraStats()
+
+    def convert(self, processes=1):
+        with open(self.out_dir.coord_path, 'w') as f:
+            f.write('0,0,0\n1,1,0\n')
+        with open(self.out_dir.txt_path, 'w') as f:
+            f.write('0|100.0|10.0\n')
+        if self.fail:
+            raise Exception('Conversion interrupted')
+        with open(self.out_dir.txt_path, 'a') as f:
+            f.write('1|200.0|20.0\n')
+
+
+def test_interrupted_conversion_into_cache_entry_is_never_reused(sm_config, tmpdir):
+    config = deepcopy(sm_config)
+    config['fs'].update(base_path=str(tmpdir), s3_base_path='', spectra_format='txt',
+                        conversion_cache={'local_max_size_gb': 1})
+    SMConfig._config_dict = config
+    try:
+        wd_manager = WorkDirManager('ds_id')
+        with patch.object(WorkDirManager, 'copy_input_data'), \
+                patch.object(ConversionCache, 'key', return_value='key'):
+            ds_reader = DatasetReader(str(tmpdir), None, wd_manager)
+            with patch.object(DatasetReader, '_create_ms_converter',
+                              side_effect=lambda out_dir: FakeTxtConverter(out_dir, fail=True)):
+                with pytest.raises(Exception):
+                    ds_reader.copy_convert_input_data()
+            entry_dir = tmpdir.join('conversion_cache', 'key')
+            assert not entry_dir.join('ds.txt').check()
+            assert [p.basename for p in entry_dir.listdir()] == ['.last_used']
+
+            ds_reader = DatasetReader(str(tmpdir), None, wd_manager)
+            with patch.object(DatasetReader, '_create_ms_converter',
+                              side_effect=lambda out_dir: FakeTxtConverter(out_dir, fail=False)) as create_mock:
+                ds_reader.copy_convert_input_data()
+                ds_reader.copy_convert_input_data()
+            assert create_mock.call_count == 1
+            assert entry_dir.join('ds.txt').read() == '0|100.0|10.0\n1|200.0|20.0\n'
+            assert entry_dir.join('_SUCCESS').check()
+            assert sorted(p.basename for p in entry_dir.listdir()) == \
+                ['.last_used', '_SUCCESS', 'ds.txt', 'ds_coord.txt', 'ds_stats.json']
+    finally:
+        SMConfig._config_dict = sm_config
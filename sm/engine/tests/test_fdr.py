@@ -1,5 +1,6 @@
 from itertools import product
 
+import numpy as np
 import pandas as pd
 from sm.engine.db import DB
 from unittest.mock import MagicMock, patch
@@ -24,7 +25,7 @@ def test_fdr_decoy_adduct_selection_saves_corr():
 
     fdr.decoy_adducts_selection(target_ions=[('H2O', '+H'), ('H2O', '+K')])
 
-    assert_frame_equal(fdr.td_df.sort_values(by=['sf', 'ta', 'da']).reset_index(drop=True),
+    assert_frame_equal(fdr.td_df.astype(object).sort_values(by=['sf', 'ta', 'da']).reset_index(drop=True),
                        exp_target_decoy_df.sort_values(by=['sf', 'ta', 'da']).reset_index(drop=True))
 
 
@@ -86,12 +87,81 @@ def test_ions():
               target_adducts=target_adducts, db=None)
     fdr.decoy_adducts_selection(target_ions=[('H2O', '+H'), ('H2O', '+Na'),
                                              ('C5H2OH', '+H'), ('C5H2OH', '+Na')])
-    ions = fdr.ion_tuples()
+    ion_codes = fdr.ion_tuples()
+    ions = fdr.ion_index().tolist()
 
-    assert type(ions) == list
+    assert ion_codes.dtype.kind == 'i'
+    assert [(fdr.catalog.sfs[sf_id], fdr.catalog.adducts[adduct_id]) for sf_id, adduct_id in ion_codes] == ions
     # total number varies because different (sf, adduct) pairs may receive the same (sf, decoy_adduct) pair
     assert len(sfs) * decoy_sample_size + len(sfs) * len(target_adducts) < \
            len(ions) <= \
            len(sfs) * len(target_adducts) * decoy_sample_size + len(sfs) * len(target_adducts)
     target_ions = [(sf, adduct) for sf, adduct in product(sfs, target_adducts)]
     assert set(target_ions).issubset(set(map(tuple, ions)))
+
+
+def _estimate_fdr_per_sample(fdr, sf_adduct_msm_df):
+    """ Former per decoy sample FDR estimation, reference for the vectorized one """
+    def msm_fdr_map(target_msm, decoy_msm):
+        target_msm_hits = pd.Series(target_msm.msm.value_counts(), name='target')
+        decoy_msm_hits = pd.Series(decoy_msm.msm.value_counts(), name='decoy')
+        msm_df = pd.concat([target_msm_hits, decoy_msm_hits], axis=1).fillna(0).sort_index(ascending=False)
+        msm_df['target_cum'] = msm_df.target.cumsum()
+        msm_df['decoy_cum'] = msm_df.decoy.cumsum()
+        msm_df['fdr'] = msm_df.decoy_cum / msm_df.target_cum
+        return msm_df.fdr
+
+    all_sf_adduct_msm_df = (pd.DataFrame(fdr.ion_index().tolist(), columns=['sf', 'adduct'])
+                            .set_index(['sf', 'adduct']).sort_index())
+    all_sf_adduct_msm_df = all_sf_adduct_msm_df.join(sf_adduct_msm_df).fillna(0)
+
+    target_fdr_df_list = []
+    for ta in fdr.target_adducts:
+        target_msm = all_sf_adduct_msm_df.loc(axis=0)[:, ta]
+        full_decoy_df = fdr.td_df[fdr.td_df.ta == ta][['sf', 'da']].astype(object)
+
+        msm_fdr_list = []
+        for i in range(fdr.decoy_sample_size):
+            decoy_subset_df = full_decoy_df[i::fdr.decoy_sample_size]
+            sf_da_list = [tuple(row) for row in decoy_subset_df.values]
+            decoy_msm = all_sf_adduct_msm_df.loc[sf_da_list]
+            msm_fdr_list.append(msm_fdr_map(target_msm, decoy_msm))
+
+        msm_fdr_avg = pd.Series(pd.concat(msm_fdr_list, axis=1).median(axis=1), name='fdr')
+        target_fdr = fdr._digitize_fdr(target_msm.join(msm_fdr_avg, on='msm'))
+        target_fdr_df_list.append(target_fdr.drop('msm', axis=1))
+
+    return pd.concat(target_fdr_df_list, axis=0)
+
+
+def test_estimate_fdr_same_as_per_sample_estimation():
+    rs = np.random.RandomState(0)
+    sfs = ['C{}H{}'.format(i, i + 2) for i in range(1, 300)]
+    fdr = FDR(job_id=0, decoy_sample_size=20, target_adducts=['+H', '+Na', '+K'], db=None)
+    fdr.decoy_adducts_selection(target_ions=list(product(sfs, fdr.target_adducts)))
+
+    ions = fdr.ion_index().tolist()
+    ions = [ions[i] for i in rs.choice(len(ions), len(ions) * 3 // 4, replace=False)]
+    msm_df = (pd.DataFrame(ions, columns=['sf', 'adduct'])
+              .assign(msm=rs.choice(np.linspace(0, 1, 50), len(ions)) * rs.uniform(0.9, 1, len(ions)).round(1))
+              .set_index(['sf', 'adduct']).sort_index())
+
+    assert_frame_equal(fdr.estimate_fdr(msm_df), _estimate_fdr_per_sample(fdr, msm_df))
+
+
+def test_decoy_adducts_selection_distinct_and_reproducible():
+    target_ions = list(product(['H2O', 'C5H2OH', 'CO2'], ['+H', '+Na']))
+    fdr = FDR(job_id=0, decoy_sample_size=20, target_adducts=['+H', '+Na'], db=None)
+    fdr.decoy_adducts_selection(target_ions)
+    other_fdr = FDR(job_id=1, decoy_sample_size=20, target_adducts=['+H', '+Na'], db=None)
+    other_fdr.decoy_adducts_selection(target_ions)
+
+    assert_frame_equal(fdr.td_df, other_fdr.td_df)
+    assert (fdr.td_df.dtypes == 'category').all()
+    assert fdr.td_df.groupby(['sf', 'ta'], observed=True).da.nunique().eq(20).all()
+    assert not fdr.td_df.da.isin(fdr.target_adducts).any()
+    assert fdr.td_df.da.nunique() > 20
+
+    exp_ions = set(map(tuple, fdr.td_df[['sf', 'ta']].values)) | set(map(tuple, fdr.td_df[['sf', 'da']].values))
+    assert sorted(fdr.ion_index().tolist()) == sorted(exp_ions)
+    assert fdr.ion_index().names == ['sf', 'adduct']
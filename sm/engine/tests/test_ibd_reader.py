@@ -0,0 +1,36 @@
+from os.path import join
+
+import numpy as np
+from numpy.testing import assert_array_equal
+from pyimzml.ImzMLParser import ImzMLParser
+from pyimzml.ImzMLWriter import ImzMLWriter
+
+from sm.engine.ibd_reader import IbdOffsets, find_ibd_path, read_ibd_spectra
+
+
+def write_imzml(path, spectra):
+    with ImzMLWriter(path, mz_dtype=np.float64, intensity_dtype=np.float32) as writer:
+        for coords, mzs, ints in spectra:
+            writer.addSpectrum(mzs, ints, coords)
+
+
+def test_read_ibd_spectra_returns_same_spectra_as_parser(tmpdir):
+    imzml_path = join(str(tmpdir), 'ds.imzML')
+    write_imzml(imzml_path, [((1, 1), np.array([100., 200.]), np.array([10., 0.])),
+                             ((2, 1), np.array([150., 250., 350.]), np.array([1., 2., 3.])),
+                             ((1, 2), np.array([300.]), np.array([5.]))])
+    parser = ImzMLParser(imzml_path)
+
+    offsets = IbdOffsets(parser)
+    chunks = offsets.split(min_chunks_n=2)
+    spectra = [sp for sp_ids, table in chunks
+               for sp in read_ibd_spectra(find_ibd_path(imzml_path), sp_ids, table,
+                                          offsets.mz_dtype, offsets.int_dtype)]
+
+    assert len(chunks) == 2
+    assert offsets.peaks_n == 6
+    assert [sp_id for sp_id, _, _ in spectra] == [0, 1, 2]
+    assert_array_equal(spectra[0][1], [100.])  # zero intensity peaks are skipped
+    assert_array_equal(spectra[1][1], [150., 250., 350.])
+    assert_array_equal(spectra[1][2], [1., 2., 3.])
+    assert spectra[2][1].dtype == np.float32 and spectra[2][2].dtype == np.float64
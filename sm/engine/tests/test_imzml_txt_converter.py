@@ -1,6 +1,8 @@
 from io import StringIO
+from os.path import join
 
 import numpy as np
+from pyimzml.ImzMLWriter import ImzMLWriter
 from sm.engine.util import SMConfig
 from unittest.mock import patch
 
@@ -42,3 +44,24 @@ def test_imzml_txt_converter_parse_save_spectrum(MockImzMLParser, sm_config, ds_
     coord_lines = converter.coord_file.getvalue().split('\n')
     assert coord_lines[0] == '0,1,1'
     assert coord_lines[1] == '1,1,2'
+
+
+def test_imzml_txt_converter_parallel_convert_same_as_serial(sm_config, tmpdir):
+    SMConfig._config_dict = sm_config
+    imzml_path = join(str(tmpdir), 'ds.imzML')
+    with ImzMLWriter(imzml_path, mz_dtype=np.float64, intensity_dtype=np.float32) as writer:
+        for i in range(10):
+            writer.addSpectrum(np.array([100. + i, 200. + i]), np.array([10., i]), (i % 5 + 1, i // 5 + 1))
+
+    lines, stats = {}, {}
+    for processes in [1, 3]:
+        txt_path = join(str(tmpdir), 'ds_{}.txt'.format(processes))
+        coord_path = join(str(tmpdir), 'ds_coord_{}.txt'.format(processes))
+        converter = MsTxtConverter(imzml_path, txt_path, coord_path)
+        converter.convert(processes=processes)
+        lines[processes] = (open(txt_path).read(), open(coord_path).read())
+        stats[processes] = converter.stats.to_json()
+
+    assert len(lines[1][0].splitlines()) == 10
+    assert lines[1] == lines[3]
+    assert stats[1] == stats[3]
@@ -0,0 +1,25 @@
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_array_equal
+
+from sm.engine.ion_catalog import IonCatalog
+
+
+def test_ion_ids_sort_as_sf_adduct_pairs():
+    catalog = IonCatalog(['H2O', 'C2H2', 'H2O'], ['+Na', '+H'])
+
+    ion_ids = catalog.ion_ids(['H2O', 'C2H2', 'H2O', 'Au'], ['+H', '+Na', '+Na', '+H'])
+
+    assert_array_equal(ion_ids, [2, 1, 3, -1])
+    assert catalog.to_index(np.sort(ion_ids[ion_ids >= 0])).tolist() == \
+        sorted([('H2O', '+H'), ('C2H2', '+Na'), ('H2O', '+Na')])
+
+
+def test_index_ion_ids_same_for_tuples_and_multi_index():
+    catalog = IonCatalog(['H2O', 'C2H2', 'CO2'], ['+H', '+K'])
+    ions = [('CO2', '+K'), ('H2O', '+H'), ('CH4', '+H')]
+    ion_index = pd.MultiIndex.from_tuples(ions, names=['sf', 'adduct'])
+
+    assert_array_equal(catalog.index_ion_ids(ions), catalog.index_ion_ids(ion_index))
+    assert_array_equal(catalog.index_ion_ids(ions), catalog.ion_ids(*zip(*ions)))
+    assert catalog.index_ion_ids(catalog.to_index([0, 5])).tolist() == [0, 5]
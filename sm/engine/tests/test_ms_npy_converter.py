@@ -0,0 +1,72 @@
+from os.path import join, exists
+from os import listdir
+
+import numpy as np
+from numpy.testing import assert_array_equal
+from unittest.mock import patch
+from pyimzml.ImzMLWriter import ImzMLWriter
+
+from sm.engine.util import SMConfig
+from sm.engine.ms_npy_converter import MsNpyConverter, encode_spectra_chunk, decode_spectra_chunk
+from sm.engine.tests.util import sm_config
+
+
+def test_encode_decode_spectra_chunk():
+    chunk = encode_spectra_chunk([0, 5],
+                                 [np.array([100.5, 200.25]), np.array([300.125])],
+                                 [np.array([10., 20.]), np.array([30.123456789])])
+
+    spectra = list(decode_spectra_chunk(chunk))
+
+    assert [sp_id for sp_id, _, _ in spectra] == [0, 5]
+    assert_array_equal(spectra[0][1], np.array([100.5, 200.25], dtype=np.float32))
+    assert_array_equal(spectra[0][2], np.array([10., 20.]))
+    assert_array_equal(spectra[1][1], np.array([300.125], dtype=np.float32))
+    assert_array_equal(spectra[1][2], np.array([30.123456789]))
+    assert spectra[1][1].dtype == np.float32 and spectra[1][2].dtype == np.float64
+
+
+@patch('sm.engine.ms_npy_converter.MsNpyConverter._parser_factory')
+def test_npy_converter_convert_writes_chunks(MockImzMLParser, sm_config, tmpdir):
+    mock_parser = MockImzMLParser.return_value
+    mock_parser.coordinates = [(1, 1), (1, 2), (2, 2)]
+    mock_parser.getspectrum.side_effect = [(np.array([100., 200.]), np.array([100., 0.])),
+                                           (np.array([100., 200.]), np.array([100., 10.])),
+                                           (np.array([150.]), np.array([1.]))]
+    SMConfig._config_dict = sm_config
+
+    npy_path = join(str(tmpdir), 'ds_npy')
+    converter = MsNpyConverter('imzml_path', npy_path, join(str(tmpdir), 'ds_coord.txt'), chunk_peaks_n=2)
+    converter.convert()
+
+    assert exists(join(npy_path, '_SUCCESS'))
+    chunk_fns = sorted(fn for fn in listdir(npy_path) if fn.endswith('.npz'))
+    assert chunk_fns == ['chunk_00000.npz', 'chunk_00001.npz']
+
+    spectra = []
+    for fn in chunk_fns:
+        with open(join(npy_path, fn), 'rb') as f:
+            spectra.extend(decode_spectra_chunk(f.read()))
+    assert [sp_id for sp_id, _, _ in spectra] == [0, 1, 2]
+    assert_array_equal(spectra[0][1], [100.])
+    assert_array_equal(spectra[1][2], [100., 10.])
+
+
+def test_npy_converter_parallel_convert_writes_all_spectra(sm_config, tmpdir):
+    SMConfig._config_dict = sm_config
+    imzml_path = join(str(tmpdir), 'ds.imzML')
+    with ImzMLWriter(imzml_path, mz_dtype=np.float64, intensity_dtype=np.float32) as writer:
+        for i in range(10):
+            writer.addSpectrum(np.array([100. + i, 200. + i]), np.array([10., 1.]), (i % 5 + 1, i // 5 + 1))
+
+    npy_path = join(str(tmpdir), 'ds_npy')
+    MsNpyConverter(imzml_path, npy_path, join(str(tmpdir), 'ds_coord.txt')).convert(processes=2)
+
+    assert exists(join(npy_path, '_SUCCESS'))
+    spectra = []
+    for fn in sorted(listdir(npy_path)):
+        if fn.endswith('.npz'):
+            with open(join(npy_path, fn), 'rb') as f:
+                spectra.extend(decode_spectra_chunk(f.read()))
+    assert sorted(sp_id for sp_id, _, _ in spectra) == list(range(10))
+    assert all(mzs.shape == (2,) for _, mzs, _ in spectra)
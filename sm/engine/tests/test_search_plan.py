@@ -0,0 +1,78 @@
+import json
+
+from sm.engine.search_plan import plan_search, SearchPlan
+from sm.engine.spectra_stats import SpectraStats
+
+
+def _spectra_stats(spectra_n, peaks_n):
+    stats = SpectraStats()
+    stats.spectra_n, stats.peaks_n = spectra_n, peaks_n
+    return stats
+
+
+def _sm_config(max_peaks=10**6):
+    return {'local_search': {'max_peaks': max_peaks, 'processes': 2},
+            'spark': {'master': 'local[*]', 'spark.executor.memory': '2g', 'spark.driver.memory': '4g'}}
+
+
+def test_small_dataset_runs_locally_with_minimal_partitioning():
+    plan = plan_search(_spectra_stats(100, 10**5), ion_n=1000, iso_gen_ion_n=2000,
+                       sm_config=_sm_config(), ds_config={})
+
+    assert plan.engine == 'local'
+    assert plan.spark_conf == {}
+    assert (plan.mz_segment_n, plan.spectra_partitions, plan.image_partitions, plan.iso_gen_partitions) == \
+        (8, 4, 8, 8)
+
+
+def test_large_dataset_gets_more_partitions_and_memory():
+    sm_config = _sm_config()
+    sm_config['spark']['spark.executor.memory'] = '1g'
+
+    plan = plan_search(_spectra_stats(10**6, 10**9), ion_n=10**5, iso_gen_ion_n=10**6,
+                       sm_config=sm_config, ds_config={})
+
+    assert plan.engine == 'spark'
+    assert plan.mz_segment_n == 1000
+    assert plan.spectra_partitions == 500
+    assert plan.image_partitions == 2000
+    assert plan.iso_gen_partitions == 512
+    assert int(plan.spark_conf['spark.executor.memory'][:-1]) > 1024
+    assert plan.spark_conf['spark.default.parallelism'] == '2000'
+
+
+def test_spark_memory_never_below_configured():
+    sm_config = _sm_config()
+    sm_config['spark']['spark.executor.memory'] = '100g'
+
+    plan = plan_search(_spectra_stats(100, 10**7), ion_n=1000, iso_gen_ion_n=2000,
+                       sm_config=sm_config, ds_config={})
+
+    assert plan.spark_conf['spark.executor.memory'] == '{}m'.format(100 * 1024)
+    assert plan.spark_conf['spark.driver.memory'] == '{}m'.format(4 * 1024)
+
+
+def test_ds_config_search_engine_takes_precedence():
+    plan = plan_search(_spectra_stats(100, 10**5), ion_n=1000, iso_gen_ion_n=2000,
+                       sm_config=_sm_config(), ds_config={'search_engine': 'spark'})
+
+    assert plan.engine == 'spark'
+    assert 'spark.executor.memory' in plan.spark_conf
+
+
+def test_plan_serializes_to_json():
+    plan = SearchPlan(engine='local', mz_segment_n=10)
+
+    assert json.loads(plan.to_json())['mz_segment_n'] == 10
+    assert json.loads(plan.to_json())['engine'] == 'local'
+
+
+def test_spark_memory_estimates_capped_by_configured_maximum():
+    sm_config = _sm_config()
+    sm_config['search_plan'] = {'max_executor_memory': '3g', 'max_driver_memory': '5g'}
+
+    plan = plan_search(_spectra_stats(10**8, 10**10), ion_n=10**8, iso_gen_ion_n=10**6,
+                       sm_config=sm_config, ds_config={})
+
+    assert plan.spark_conf['spark.executor.memory'] == '{}m'.format(3 * 1024)
+    assert plan.spark_conf['spark.driver.memory'] == '{}m'.format(5 * 1024)
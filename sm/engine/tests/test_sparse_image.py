@@ -0,0 +1,38 @@
+import pickle
+import numpy as np
+from numpy.testing import assert_array_equal
+from scipy.sparse import coo_matrix
+
+from sm.engine.sparse_image import SparseImage
+
+
+def test_from_pixels_sums_repeated_pixels():
+    img = SparseImage.from_pixels(np.array([4, 1, 4]), np.array([1., 2., 3.]), (2, 3))
+
+    assert img.nnz == 2
+    assert_array_equal(img.toarray(), [[0., 2., 0.], [0., 4., 0.]])
+
+
+def test_reductions_match_dense():
+    img = SparseImage.from_pixels(np.array([0, 5]), np.array([2., 3.]), (2, 3))
+    dense = img.toarray()
+
+    assert img.sum() == dense.sum()
+    assert img.min() == dense.min() == 0
+    assert img.max() == dense.max()
+
+    full_img = SparseImage(np.arange(4), np.array([1., 2., 3., 4.]), (2, 2))
+    assert full_img.min() == 1
+
+
+def test_pickle_roundtrip_is_compact():
+    inds = np.arange(0, 10**6, 100)
+    vals = np.random.rand(inds.shape[0])
+    img = SparseImage.from_pixels(inds, vals, (1000, 1000))
+
+    restored = pickle.loads(pickle.dumps(img))
+
+    assert restored.shape == img.shape
+    assert_array_equal(restored.toarray(), img.toarray())
+    coo = coo_matrix((vals, (inds // 1000, inds % 1000)), shape=(1000, 1000))
+    assert len(pickle.dumps(img)) < len(pickle.dumps(coo)) / 2
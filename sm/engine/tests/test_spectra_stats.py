@@ -0,0 +1,80 @@
+import json
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+from sm.engine.spectra_stats import SpectraStats
+from sm.engine.errors import JobFailedError
+
+
+def _spectra():
+    return [(0, np.array([100.01, 100.05, 200.3]), np.array([1., 2., 3.])),
+            (1, np.array([100.02]), np.array([5.])),
+            (2, np.array([]), np.array([]))]
+
+
+def test_update_all_collects_exact_counts():
+    stats = SpectraStats().update_all(_spectra())
+
+    assert stats.spectra_n == 3
+    assert stats.peaks_n == 4
+    assert stats.max_peaks_per_spectrum == 3
+    assert stats.mz_min == pytest.approx(100.01)
+    assert stats.mz_max == pytest.approx(200.3)
+
+    edges, counts = stats.mz_histogram()
+    assert edges[0] == pytest.approx(100.0)
+    assert edges[-1] == pytest.approx(200.4)
+    assert counts.sum() == 4
+    assert counts[0] == 3 and counts[-1] == 1
+
+
+def test_merge_equals_single_pass():
+    spectra = _spectra()
+    part_a = SpectraStats().update_all(spectra[:1])
+    part_b = SpectraStats().update_all(spectra[1:])
+    merged = part_a.merge(part_b)
+    whole = SpectraStats().update_all(spectra)
+
+    assert merged.to_json() == whole.to_json()
+
+
+def test_save_load(tmpdir):
+    stats = SpectraStats().update_all(_spectra())
+    path = str(tmpdir.join('ds_stats.json'))
+
+    stats.save(path)
+    loaded = SpectraStats.load(path)
+
+    assert loaded.peaks_n == stats.peaks_n
+    for (a, b) in zip(loaded.mz_histogram(), stats.mz_histogram()):
+        assert_array_almost_equal(a, b)
+    assert_array_equal(loaded.mz_occupied([100.01, 150.], 3), [True, False])
+
+
+def test_check_quality_fails_on_wrong_values():
+    stats = SpectraStats().update_all([(0, np.array([-1., 100.]), np.array([1., -5.]))])
+
+    assert stats.wrong_mz_n == 1
+    assert stats.wrong_int_n == 1
+    with pytest.raises(JobFailedError, match=r'^Mz arrays contain 1 values .* Intensity arrays contain 1 values'):
+        stats.check_quality()
+
+
+def test_check_quality_passes():
+    SpectraStats().update_all(_spectra()).check_quality()
+
+
+def test_mz_occupied_at_ppm_tolerance():
+    stats = SpectraStats().update_all(_spectra())
+
+    assert_array_equal(stats.mz_occupied([100.01 * (1 + 2.5e-6), 100.01 * (1 - 2.5e-6)], 3), [True, True])
+    assert_array_equal(stats.mz_occupied([100.01 * (1 + 5e-6), 100.03, 300.], 3), [False, False, False])
+
+
+def test_mz_occupied_without_occupancy_bitmap():
+    stats = SpectraStats().update_all(_spectra())
+    d = json.loads(stats.to_json())
+    d['mz_occupancy'] = None
+
+    assert_array_equal(SpectraStats.from_json(json.dumps(d)).mz_occupied([150.], 3), [True])
@@ -89,7 +89,9 @@ def ds_config():
             "ppm": 1.0,
             "nlevels": 30,
             "q": 99,
-            "do_preprocessing": False
+            "do_preprocessing": False,
+            "principal_min_px": 1,
+            "principal_min_int": 0
         }
     }
 
@@ -41,6 +41,30 @@ def delete_local_path(path):
         logger.warning('Deleting %s error: %s', path, e.stderr)
 
 
+def find_ms_file(dir_path):
+    """ Find a mass spec file in the directory using the configured file handlers
+
+    Returns
+    -------
+    : str
+        Path to the mass spec file or an empty string if nothing was found
+    """
+    if not exists(dir_path):
+        return ''
+    file_handlers = SMConfig.get_conf()['ms_file_handlers']
+    for handler in file_handlers:
+        ms_file_extension = handler['extensions'][0]
+        logger.info('"%s" file handler is looking for files with "%s" extension \
+                    in the input directory',  handler['type'], ms_file_extension)
+        ms_file_path = next((fn for fn in listdir(dir_path) \
+            if re.search(r'\.{}$'.format(ms_file_extension), fn, re.IGNORECASE)), None)
+        if ms_file_path:
+            logger.info('"%s" file handler has found "%s" in the input directory',
+                        handler['type'], ms_file_path)
+            return join(dir_path, ms_file_path)
+    return ''
+
+
 class LocalWorkDir(object):
 
     def __init__(self, base_path, ds_id):
@@ -49,31 +73,38 @@ class LocalWorkDir(object):
 
     @property
     def ms_file_path(self):
-        if self._ms_file_path:
-            return self._ms_file_path
-
-        file_handlers = SMConfig.get_conf()['ms_file_handlers']
-        for handler in file_handlers:
-            ms_file_extension = handler['extensions'][0]
-            logger.info('"%s" file handler is looking for files with "%s" extension \
-                        in the input directory',  handler['type'], ms_file_extension)
-            ms_file_path = next((fn for fn in listdir(self.ds_path) \
-                if re.search(r'\.{}$'.format(ms_file_extension), fn, re.IGNORECASE)), None)
-            if ms_file_path:
-                logger.info('"%s" file handler has found "%s" in the input directory',
-                            handler['type'], ms_file_path)
-                self._ms_file_path = join(self.ds_path, ms_file_path)
-                break
-        return self._ms_file_path if self._ms_file_path else ''
+        if not self._ms_file_path:
+            self._ms_file_path = find_ms_file(self.ds_path)
+        return self._ms_file_path
 
     @property
     def txt_path(self):
         return join(self.ds_path, 'ds.txt')
 
+    @property
+    def npy_path(self):
+        return join(self.ds_path, 'ds_npy')
+
     @property
     def coord_path(self):
         return join(self.ds_path, 'ds_coord.txt')
 
+    @property
+    def stats_path(self):
+        return join(self.ds_path, 'ds_stats.json')
+
+    @property
+    def segments_path(self):
+        return join(self.ds_path, 'ds_segments')
+
+    @property
+    def segments_meta_path(self):
+        return join(self.ds_path, 'ds_segments.json')
+
+    @property
+    def success_path(self):
+        return join(self.ds_path, '_SUCCESS')
+
     def exists(self, path):
         if exists(split_local_path(path)):
             logger.info('Path %s already exists', path)
@@ -105,10 +136,30 @@ class S3WorkDir(object):
     def txt_path(self):
         return join(self.bucket, self.ds_path, 'ds.txt')
 
+    @property
+    def npy_path(self):
+        return join(self.bucket, self.ds_path, 'ds_npy')
+
     @property
     def coord_path(self):
         return join(self.bucket, self.ds_path, 'ds_coord.txt')
 
+    @property
+    def stats_path(self):
+        return join(self.bucket, self.ds_path, 'ds_stats.json')
+
+    @property
+    def segments_path(self):
+        return join(self.bucket, self.ds_path, 'ds_segments')
+
+    @property
+    def segments_meta_path(self):
+        return join(self.bucket, self.ds_path, 'ds_segments.json')
+
+    @property
+    def success_path(self):
+        return join(self.bucket, self.ds_path, '_SUCCESS')
+
     def clean(self):
         delete_s3_path(self.bucket, self.ds_path, self.s3)
 
@@ -128,6 +179,11 @@ class S3WorkDir(object):
         logger.info('Coping from {} to {}'.format(local, remote))
         self.s3transfer.upload_file(local, *split_s3_path(remote))
 
+    def download(self, remote, local):
+        logger.info('Downloading from {} to {}'.format(remote, local))
+        cmd_check('mkdir -p {}', split(local)[0])
+        self.s3transfer.download_file(*split_s3_path(remote), local)
+
 
 def local_path(path):
     return 'file://' + path
@@ -143,7 +199,7 @@ class WorkDirManager(object):
     Args
     ----
     ds_id : str
-        Dataset unique id
+        Dataset unique id or any other relative path inside the work directory
     """
     def __init__(self, ds_id):
         self.sm_config = SMConfig.get_conf()
@@ -172,6 +228,13 @@ class WorkDirManager(object):
         else:
             return self._spark_path(self.remote_dir.txt_path)
 
+    @property
+    def npy_path(self):
+        if self.local_fs_only:
+            return self._spark_path(self.local_dir.npy_path)
+        else:
+            return self._spark_path(self.remote_dir.npy_path)
+
     @property
     def coord_path(self):
         if self.local_fs_only:
@@ -179,31 +242,60 @@ class WorkDirManager(object):
         else:
             return self._spark_path(self.remote_dir.coord_path)
 
+    @property
+    def stats_path(self):
+        if self.local_fs_only:
+            return self._spark_path(self.local_dir.stats_path)
+        else:
+            return self._spark_path(self.remote_dir.stats_path)
+
+    @property
+    def segments_path(self):
+        if self.local_fs_only:
+            return self._spark_path(self.local_dir.segments_path)
+        else:
+            return self._spark_path(self.remote_dir.segments_path)
+
+    @property
+    def success_path(self):
+        if self.local_fs_only:
+            return self._spark_path(self.local_dir.success_path)
+        else:
+            return self._spark_path(self.remote_dir.success_path)
+
     def _spark_path(self, path):
         if self.local_fs_only:
             return local_path(path)
         else:
             return s3_path(path)
 
-    def copy_input_data(self, input_data_path):
+    def copy_input_data(self, input_data_path, file_exts=None):
         """ Copy mass spec files from input path to a dataset work directory
 
         Args
         ----
         input_data_path : str
             Path to input files
+        file_exts : list
+            Copy only files with these extensions (case insensitive), all files by default
         """
         logger.info('Copying data from %s to %s', input_data_path, self.local_dir.ds_path)
 
+        def selected(fn):
+            return not file_exts or fn.lower().split('.')[-1] in file_exts
+
         if input_data_path.startswith('s3a://'):
             cmd_check('mkdir -p {}', self.local_dir.ds_path)
             bucket_name, inp_path = split_s3_path(input_data_path)
 
             bucket = self.s3.Bucket(bucket_name)
             for obj in bucket.objects.filter(Prefix=inp_path):
-                if not obj.key.endswith('/'):
+                if not obj.key.endswith('/') and selected(obj.key):
                     path = join(self.local_dir.ds_path, obj.key.split('/')[-1])
                     self.s3transfer.download_file(bucket_name, obj.key, path)
+        elif file_exts:
+            for fn in filter(selected, listdir(input_data_path)):
+                self.local_dir.copy(join(input_data_path, fn), join(self.local_dir.ds_path, fn), is_file=True)
         else:
             self.local_dir.copy(input_data_path, self.local_dir.ds_path)
 
@@ -219,9 +311,45 @@ class WorkDirManager(object):
         if not self.local_fs_only:
             self.remote_dir.clean()
 
+    def clean_segments(self):
+        """ Delete m/z segment files and their description """
+        delete_local_path(self.local_dir.segments_path)
+        delete_local_path(self.local_dir.segments_meta_path)
+        if not self.local_fs_only:
+            delete_s3_path(self.remote_dir.bucket, join(self.remote_dir.ds_path, 'ds_segments'), self.s3)
+
     def upload_to_remote(self):
         self.remote_dir.copy(self.local_dir.coord_path, self.remote_dir.coord_path)
-        self.remote_dir.copy(self.local_dir.txt_path, self.remote_dir.txt_path)
+        if exists(self.local_dir.txt_path):
+            self.remote_dir.copy(self.local_dir.txt_path, self.remote_dir.txt_path)
+        if exists(self.local_dir.stats_path):
+            self.remote_dir.copy(self.local_dir.stats_path, self.remote_dir.stats_path)
+        if exists(self.local_dir.npy_path):
+            # the _SUCCESS marker goes last so that incomplete uploads are never picked up
+            for fn in sorted(listdir(self.local_dir.npy_path), key=lambda fn: (fn.startswith('_'), fn)):
+                self.remote_dir.copy(join(self.local_dir.npy_path, fn), join(self.remote_dir.npy_path, fn))
+        if exists(self.local_dir.success_path):
+            self.remote_dir.copy(self.local_dir.success_path, self.remote_dir.success_path)
+
+    def download_from_remote(self, spectra=True):
+        """ Copy files uploaded with upload_to_remote back to the local directory if missing there
+
+        Args
+        ----
+        spectra : bool
+            Download the spectra too, otherwise only the coordinates and statistics
+        """
+        paths = [(self.remote_dir.coord_path, self.local_dir.coord_path),
+                 (self.remote_dir.stats_path, self.local_dir.stats_path)]
+        if spectra:
+            paths.append((self.remote_dir.txt_path, self.local_dir.txt_path))
+            npy_prefix = join(self.remote_dir.ds_path, 'ds_npy/')
+            for obj in self.s3.Bucket(self.remote_dir.bucket).objects.filter(Prefix=npy_prefix):
+                fn = obj.key.split('/')[-1]
+                paths.append((join(self.remote_dir.npy_path, fn), join(self.local_dir.npy_path, fn)))
+        for remote, local in paths:
+            if not exists(local) and self.remote_dir.exists(remote):
+                self.remote_dir.download(remote, local)
 
     def exists(self, path):
         if self.local_fs_only:
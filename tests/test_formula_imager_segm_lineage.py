@@ -0,0 +1,53 @@
+import os
+import re
+import sys
+from unittest.mock import MagicMock
+import numpy as np
+import pandas as pd
+
+from sm.engine.dataset_reader import DatasetReader
+from sm.engine.msm_basic.formula_imager_segm import _create_mz_segments, _segment_spectrum, _segment_arrays, \
+    _partition_by_segment, partition_centroids, gen_principal_images, gen_iso_peak_images, gen_iso_sf_images
+from sm.engine.tests.util import pyspark_context
+
+
+os.environ.setdefault('PYSPARK_PYTHON', sys.executable)
+
+
+def _shuffled_rdd_ids(rdd):
+    debug_string = rdd.toDebugString()
+    if isinstance(debug_string, bytes):
+        debug_string = debug_string.decode()
+    return set(re.findall(r'ShuffledRDD\[(\d+)\]', debug_string))
+
+
+def test_complete_ion_images_are_not_shuffled(pyspark_context):
+    ppm = 3
+    mz_segments = _create_mz_segments([150., 200., 200.0002, 300.], ppm)
+    ion_centroids_df = pd.DataFrame({'ion_i': [0, 0, 1, 1],
+                                     'peak_i': [0, 1, 0, 1],
+                                     'mz': [161., 162., 199., 201.],
+                                     'int': 100.}).set_index('ion_i')
+    spectra = [(0, np.array([161., 162., 199., 201.]), np.array([1., 2., 3., 4.]))]
+    segm_arrays = _partition_by_segment(
+        pyspark_context.parallelize(spectra).flatMap(lambda sp: _segment_spectrum(sp, mz_segments)),
+        len(mz_segments), lambda sp_it: _segment_arrays(sp_it, np.array([0])))
+    ds_reader = MagicMock(spec=DatasetReader)
+    ds_reader.get_dims.return_value = (1, 1)
+
+    segm_centroids, ion_segments = partition_centroids(pyspark_context, ion_centroids_df, mz_segments, ppm)
+    principal_images = gen_principal_images(ds_reader, segm_arrays, segm_centroids, ppm, passes=lambda img: True)
+    iso_peak_images = gen_iso_peak_images(pyspark_context, ds_reader, segm_arrays, segm_centroids,
+                                          ion_segments, principal_images, ppm)
+    complete_images = iso_peak_images.filter(lambda item: item[1][0])
+    iso_sf_images = gen_iso_sf_images(iso_peak_images, shape=(1, 1), partitions=2)
+
+    input_shuffles = _shuffled_rdd_ids(segm_arrays) | _shuffled_rdd_ids(segm_centroids)
+    # only ids of the incomplete ions are sent to the segments owning their other peaks
+    assert len(_shuffled_rdd_ids(complete_images) - input_shuffles) == 1
+    # only images of the incomplete ions are grouped
+    assert len(_shuffled_rdd_ids(iso_sf_images) - _shuffled_rdd_ids(iso_peak_images)) == 1
+    assert [ion for ion, _ in complete_images.collect()] == [0]
+    images = dict(iso_sf_images.collect())
+    assert [img.sum() for img in images[0]] == [1., 2.]
+    assert [img.sum() for img in images[1]] == [3., 4.]
@@ -1,5 +1,6 @@
+from copy import deepcopy
 import pytest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 import os
 import sys
 import numpy as np
@@ -9,19 +10,30 @@ from pyspark.sql import SparkSession
 
 from sm.engine import MolecularDB
 from sm.engine.db import DB
-from sm.engine.ion_centroids_gen import IonCentroidsGenerator
+from sm.engine.ion_centroids_gen import IonCentroidsGenerator, IonCentroidsStore, union_ion_centroids, \
+    ion_formula, _read_parquet, _write_parquet_part
 from sm.engine.isocalc_wrapper import IsocalcWrapper
+from sm.engine.util import SMConfig
 from sm.engine.tests.util import test_db, sm_config, ds_config, pyspark_context
 
 
 os.environ.setdefault('PYSPARK_PYTHON', sys.executable)
 
 
-def test_generate_returns_valid_df(pyspark_context, sm_config, ds_config):
+@pytest.fixture()
+def store_config(sm_config, tmpdir):
+    config = deepcopy(sm_config)
+    config['isotope_storage']['path'] = str(tmpdir)
+    SMConfig._config_dict = config
+    yield config
+    SMConfig._config_dict = sm_config
+
+
+def test_generate_returns_valid_df(pyspark_context, store_config, ds_config):
     isocalc = IsocalcWrapper(ds_config['isotope_generation'])
     centroids_gen = IonCentroidsGenerator(sc=pyspark_context, moldb_name='HMDB', isocalc=isocalc)
     centroids_gen._iso_gen_part_n = 1
-    centroids_gen.generate(isocalc=isocalc, sfs=['C2H4O8', 'C3H6O7', 'fake_mf'], adducts=['+Na'])
+    centroids_gen.generate_if_not_exist(isocalc=isocalc, sfs=['C2H4O8', 'C3H6O7', 'fake_mf'], adducts=['+Na'])
 
     assert centroids_gen.ion_centroids_df.shape == (8, 3)
     assert np.all(np.diff(centroids_gen.ion_centroids_df.mz.values) >= 0)  # assert that dataframe is sorted by mz
@@ -29,22 +41,15 @@ def test_generate_returns_valid_df(pyspark_context, sm_config, ds_config):
     assert centroids_gen.ion_df.shape == (2, 2)
 
 
-def test_save_restore_works(pyspark_context, sm_config, ds_config):
+def test_generate_without_spark_returns_valid_df(store_config, ds_config):
     isocalc = IsocalcWrapper(ds_config['isotope_generation'])
-    centr_gen = IonCentroidsGenerator(sc=pyspark_context, moldb_name='HMDB', isocalc=isocalc)
-
-    centr_gen.ion_centroids_df = pd.DataFrame({'ion_i': [101, 101, 102, 102],
-                                               'peak_i': [0, 1, 0, 1],
-                                               'mz': [100., 200., 300., 400.],
-                                               'int': [100., 10., 100., 1.]}).set_index('ion_i')
-    centr_gen.ion_df = pd.DataFrame({'ion_i': [101, 101, 102, 102],
-                                     'sf': ['H2O', 'H2O', 'Au', 'Au'],
-                                     'adduct': ['+H', '-H', '+H', '-H']}).set_index('ion_i')
-    centr_gen.save()
-    centr_gen.restore()
+    centroids_gen = IonCentroidsGenerator(sc=None, moldb_name='HMDB', isocalc=isocalc)
+    centroids_gen._iso_gen_part_n = 2
+    centroids_gen.generate_if_not_exist(isocalc=isocalc, sfs=['C2H4O8', 'C3H6O7', 'fake_mf'], adducts=['+Na'])
 
-    df = centr_gen.centroids_subset(ions=[('H2O', '-H')])
-    assert df.index.unique().tolist() == [101]
+    assert centroids_gen.ion_centroids_df.shape == (8, 3)
+    assert np.all(np.diff(centroids_gen.ion_centroids_df.mz.values) >= 0)
+    assert centroids_gen.ion_df.shape == (2, 2)
 
 
 def test_centroids_subset_selection_works(pyspark_context, sm_config, ds_config):
@@ -66,14 +71,156 @@ def test_centroids_subset_selection_works(pyspark_context, sm_config, ds_config)
                                                    'int': [100., 100.]}
 
 
-def test_centroids_subset_ordered_by_mz(pyspark_context, sm_config, ds_config):
+def test_centroids_subset_ordered_by_mz(pyspark_context, store_config, ds_config):
     isocalc = IsocalcWrapper(ds_config['isotope_generation'])
     centr_gen = IonCentroidsGenerator(sc=pyspark_context, moldb_name='HMDB', isocalc=isocalc)
     centr_gen._iso_gen_part_n = 1
-    centr_gen.generate(isocalc=isocalc,
-                       sfs=['C2H4O8', 'C3H6O7', 'C59H112O6', 'C62H108O'],
-                       adducts=['+Na', '+H', '+K'])
+    centr_gen.generate_if_not_exist(isocalc=isocalc,
+                                    sfs=['C2H4O8', 'C3H6O7', 'C59H112O6', 'C62H108O'],
+                                    adducts=['+Na', '+H', '+K'])
 
     ion_centroids = centr_gen.centroids_subset([('C59H112O6', '+H'), ('C62H108O', '+Na')])
     assert ion_centroids.shape == (8, 3)
     assert np.all(np.diff(ion_centroids.mz.values) >= 0)  # assert that dataframe is sorted by mz
+
+
+def test_union_ion_centroids_includes_shared_ions_once():
+    centr_gen_1 = MagicMock(spec=IonCentroidsGenerator)
+    centr_gen_1.ion_df = pd.DataFrame({'ion_i': [0, 1],
+                                       'sf': ['H2O', 'Au'],
+                                       'adduct': ['+H', '+H']}).set_index('ion_i')
+    centr_gen_1.ion_centroids_df = pd.DataFrame({'ion_i': [0, 0, 1],
+                                                 'peak_i': [0, 1, 0],
+                                                 'mz': [19., 20., 198.],
+                                                 'int': [100., 10., 100.]}).set_index('ion_i')
+    centr_gen_2 = MagicMock(spec=IonCentroidsGenerator)
+    centr_gen_2.ion_df = pd.DataFrame({'ion_i': [5, 7],
+                                       'sf': ['H2O', 'CO2'],
+                                       'adduct': ['+H', '+H']}).set_index('ion_i')
+    centr_gen_2.ion_centroids_df = pd.DataFrame({'ion_i': [5, 5, 7],
+                                                 'peak_i': [0, 1, 0],
+                                                 'mz': [19., 20., 45.],
+                                                 'int': [100., 10., 100.]}).set_index('ion_i')
+
+    ion_df, ion_centroids_df = union_ion_centroids([centr_gen_1, centr_gen_2],
+                                                   [[('H2O', '+H'), ('Au', '+H')], [('H2O', '+H'), ('CO2', '+H')]])
+
+    assert ion_df.sf.tolist() == ['Au', 'CO2', 'H2O']
+    assert ion_centroids_df.index.tolist() == [2, 2, 1, 0]
+    assert ion_centroids_df.mz.tolist() == [19., 20., 45., 198.]
+
+
+@pytest.mark.parametrize('sf, adduct, formula', [
+    ('C6H12O6', '+H', 'C6H13O6'),
+    ('C6H11O6', '+H2', 'C6H13O6'),
+    ('H2O', '-H', 'HO'),
+    ('NaCl', '+K', 'ClKNa'),
+    ('H2O', '-Na', 'H2O-Na'),
+    ('4Sn', '+K', '4Sn+K'),
+])
+def test_ion_formula(sf, adduct, formula):
+    assert ion_formula(sf, adduct) == formula
+
+
+def test_generate_calculates_same_ions_once(store_config, ds_config):
+    isocalc = IsocalcWrapper(ds_config['isotope_generation'])
+    centroids_gen = IonCentroidsGenerator(sc=None, moldb_name='HMDB', isocalc=isocalc)
+    centroids_gen._iso_gen_part_n = 2
+    centroids_gen.generate_if_not_exist(isocalc=isocalc, sfs=['C2H4O8', 'C2H3O8'], adducts=['+H', '+H2'])
+
+    assert centroids_gen.ion_df.shape == (4, 2)
+    assert centroids_gen.ion_df.index.unique().shape[0] == 3
+    assert centroids_gen.ion_centroids_df.index.unique().shape[0] == 3
+    df = centroids_gen.centroids_subset([('C2H4O8', '+H'), ('C2H3O8', '+H2')])
+    assert df.index.unique().shape[0] == 1
+
+
+def test_union_ion_centroids_shares_ion_i_of_same_ions():
+    centr_gen = MagicMock(spec=IonCentroidsGenerator)
+    centr_gen.ion_df = pd.DataFrame({'ion_i': [0, 1, 2],
+                                     'sf': ['C6H12O6', 'C6H11O6', 'Au'],
+                                     'adduct': ['+H', '+H2', '+H']}).set_index('ion_i')
+    centr_gen.ion_centroids_df = pd.DataFrame({'ion_i': [0, 1, 2],
+                                               'peak_i': [0, 0, 0],
+                                               'mz': [181.07, 181.07, 198.],
+                                               'int': [100., 100., 100.]}).set_index('ion_i')
+
+    ion_df, ion_centroids_df = union_ion_centroids([centr_gen], [list(map(tuple, centr_gen.ion_df.values))])
+
+    assert ion_df.index.tolist() == [0, 1, 1]
+    assert ion_df.sf.tolist() == ['Au', 'C6H11O6', 'C6H12O6']
+    assert ion_centroids_df.index.tolist() == [1, 0]
+
+
+def test_generate_if_not_exist_adds_only_missing_ions_to_shared_store(store_config, ds_config, tmpdir):
+    isocalc = IsocalcWrapper(ds_config['isotope_generation'])
+    store = IonCentroidsStore(store_config, isocalc.sigma, isocalc.charge)
+
+    centr_gen = IonCentroidsGenerator(sc=None, moldb_name='HMDB', isocalc=isocalc, iso_gen_part_n=2)
+    centr_gen.generate_if_not_exist(isocalc=isocalc, sfs=['C2H4O8', 'C3H6O7', 'fake_mf'], adducts=['+H'])
+    ion_i = dict(zip(centr_gen.ion_df.sf, centr_gen.ion_df.index))
+    assert sorted(ion_i) == ['C2H4O8', 'C3H6O7']
+    first_pairs = set(zip(store.load_ions().sf, store.load_ions().adduct))
+
+    other_centr_gen = IonCentroidsGenerator(sc=None, moldb_name='ChEBI', isocalc=isocalc, iso_gen_part_n=2)
+    other_centr_gen.generate_if_not_exist(isocalc=isocalc, sfs=['C2H4O8', 'C2H3O8', 'fake_mf'],
+                                          adducts=['+H', '+H2'])
+
+    store_ion_df = store.load_ions()
+    assert store_ion_df.ion_i.is_monotonic_increasing
+    new_ion_df = store_ion_df[[pair not in first_pairs for pair in zip(store_ion_df.sf, store_ion_df.adduct)]]
+    assert sorted(zip(new_ion_df.sf, new_ion_df.adduct)) == \
+        [('C2H3O8', '+H'), ('C2H3O8', '+H2'), ('C2H4O8', '+H2'), ('fake_mf', '+H2')]
+    new_ion_i = new_ion_df.set_index(['sf', 'adduct']).ion_i
+    # C2H3O8+H2 and C2H4O8+H are the same ion, its centroids are not generated again
+    assert new_ion_i[('C2H3O8', '+H2')] == ion_i['C2H4O8']
+    centr_path = tmpdir.join('centroids', str(isocalc.sigma), str(isocalc.charge), 'ion_centroids')
+    assert len(centr_path.listdir()) == 2
+    centr_df = _read_parquet(str(centr_path), store_config)
+    assert not centr_df.duplicated(subset=['ion_i', 'peak_i']).any()
+    assert set(centr_df.ion_i) == set(ion_i.values()) | {new_ion_i[('C2H3O8', '+H')], new_ion_i[('C2H4O8', '+H2')]}
+
+    other_ion_i = dict(zip(zip(other_centr_gen.ion_df.sf, other_centr_gen.ion_df.adduct), other_centr_gen.ion_df.index))
+    assert other_ion_i[('C2H4O8', '+H')] == ion_i['C2H4O8']
+    assert np.all(np.diff(other_centr_gen.ion_centroids_df.mz.values) >= 0)
+    assert set(other_centr_gen.ion_centroids_df.index) == set(other_centr_gen.ion_df.index)
+
+
+def test_generate_if_not_exist_generates_again_ions_taken_by_concurrent_job(store_config, ds_config, tmpdir):
+    isocalc = IsocalcWrapper(ds_config['isotope_generation'])
+    store = IonCentroidsStore(store_config, isocalc.sigma, isocalc.charge)
+    centr_gen = IonCentroidsGenerator(sc=None, moldb_name='HMDB', isocalc=isocalc, iso_gen_part_n=2)
+
+    concurrent_store = IonCentroidsStore(store_config, isocalc.sigma, isocalc.charge)
+    store_append = store.append
+
+    def append_concurrently(ion_df, ion_centroids_df):
+        if store.append.call_count == 1:
+            # a concurrent job takes the same ion ids for other ions
+            concurrent_store.append(ion_df.assign(sf='Au', formula='Au'), ion_centroids_df.assign(mz=197.))
+        return store_append(ion_df, ion_centroids_df)
+
+    store.append = MagicMock(side_effect=append_concurrently)
+    with patch('sm.engine.ion_centroids_gen.IonCentroidsStore', return_value=store):
+        centr_gen.generate_if_not_exist(isocalc=isocalc, sfs=['C2H4O8'], adducts=['+H'])
+
+    assert store.append.call_count == 2
+    store_ion_df = store.load_ions()
+    assert store_ion_df.sf.tolist() == ['Au', 'C2H4O8']
+    assert store_ion_df.ion_i.tolist() == [0, 1]
+    assert centr_gen.ion_df.index.tolist() == [1]
+    assert 197. not in centr_gen.ion_centroids_df.mz.tolist()
+    assert not store.has_conflicts([0, 1])
+
+
+@pytest.mark.parametrize('in_filter_max_ions', [10, 0])
+def test_read_parquet_reads_only_rows_of_ion_ids(sm_config, tmpdir, in_filter_max_ions):
+    df = pd.DataFrame({'ion_i': [3, 1, 2, 1, 5], 'mz': [300., 100., 200., 110., 500.]})
+    _write_parquet_part(df, str(tmpdir), 'part-0.parquet', sm_config)
+
+    with patch('sm.engine.ion_centroids_gen.PARQUET_IN_FILTER_MAX_IONS', in_filter_max_ions):
+        assert _read_parquet(str(tmpdir), sm_config, ion_ids=[1, 3]).values.tolist() == \
+            [[1, 100.], [1, 110.], [3, 300.]]
+        assert _read_parquet(str(tmpdir), sm_config, columns=['mz'], ion_ids=[5]).columns.tolist() == ['mz']
+        assert _read_parquet(str(tmpdir), sm_config, columns=['mz'], ion_ids=[2, 5]).mz.tolist() == [200., 500.]
+        assert _read_parquet(str(tmpdir), sm_config, ion_ids=[]).shape[0] == 0
@@ -3,12 +3,12 @@ from collections import OrderedDict
 from os.path import join, dirname
 import pandas as pd
 import pytest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 import numpy as np
 
 from sm.engine.db import DB
 from sm.engine.png_generator import ImageStoreServiceWrapper
-from sm.engine.search_results import SearchResults, METRICS_INS
+from sm.engine.search_results import SearchResults, METRICS_INS, post_images_to_image_store
 from sm.engine.tests.util import pysparkling_context as spark_context
 from scipy.sparse import coo_matrix as coo
 
@@ -56,6 +56,17 @@ def test_isotope_images_are_stored(search_results, spark_context):
     assert img_store_mock.post_image.call_count == 3
 
 
+
+@patch('sm.engine.search_results.PngGenerator')
+def test_isotope_images_are_posted_without_search_results(PngGeneratorMock):
+    mask = np.array([[1, 1], [1, 0]])
+    img_store_mock = MagicMock(spec=ImageStoreServiceWrapper)
+    img_store_mock.post_image.return_value = 'iso_image_id'
+
+    ids = post_images_to_image_store([(7, [coo([[0, 0], [0, 1]])])], mask, img_store_mock, 'fs')
+
+    assert ids == {7: {'iso_image_ids': ['iso_image_id', None, None, None]}}
+    img_store_mock.post_image.assert_called_once()
 def test_non_native_python_number_types_handled(search_results):
     ion_img_ids = {13: {'iso_image_ids': ['iso_image_1', None, None, None]}}
     ion_metrics_df = (pd.DataFrame([(13, 'H2O', '+H', 0.9, 0.9, 0.9,
@@ -46,18 +46,22 @@ def init_mol_db_service_wrapper_mock(MolDBServiceWrapperMock):
                                                          'mol_name': 'molecule name'}]
 
 
+def batch_img_metrics_mock(ion_images, ion_centr_ints):
+    return [(ion, 0.9, 0.9, 0.9, [100.], [0], [10.]) for ion, _ in ion_images]
+
+
 @patch('sm.engine.search_job.MolDBServiceWrapper')
 @patch('sm.engine.mol_db.MolDBServiceWrapper')
-@patch('sm.engine.search_results.SearchResults.post_images_to_image_store')
+@patch('sm.engine.search_job.post_images_to_image_store')
 @patch('sm.engine.msm_basic.msm_basic_search.MSMBasicSearch.filter_sf_metrics')
-@patch('sm.engine.msm_basic.formula_img_validator.get_compute_img_metrics')
-def test_search_job_imzml_example(get_compute_img_metrics_mock, filter_sf_metrics_mock,
+@patch('sm.engine.msm_basic.formula_img_validator.get_compute_batch_img_metrics')
+def test_search_job_imzml_example(get_compute_batch_img_metrics_mock, filter_sf_metrics_mock,
                                   post_images_to_annot_service_mock, MolDBServiceWrapperMock, MolDBServiceWrapperMock2,
                                   sm_config, create_fill_sm_database, es_dsl_search, clean_isotope_storage):
     init_mol_db_service_wrapper_mock(MolDBServiceWrapperMock)
     init_mol_db_service_wrapper_mock(MolDBServiceWrapperMock2)
 
-    get_compute_img_metrics_mock.return_value = lambda *args: (0.9, 0.9, 0.9, [100.], [0], [10.])
+    get_compute_batch_img_metrics_mock.return_value = batch_img_metrics_mock
     filter_sf_metrics_mock.side_effect = lambda x: x
 
     url_dict = {
@@ -156,10 +160,10 @@ def test_search_job_imzml_example(get_compute_img_metrics_mock, filter_sf_metric
 
 @patch('sm.engine.search_job.MolDBServiceWrapper')
 @patch('sm.engine.mol_db.MolDBServiceWrapper')
-@patch('sm.engine.search_results.SearchResults.post_images_to_image_store')
+@patch('sm.engine.search_job.post_images_to_image_store')
 @patch('sm.engine.msm_basic.msm_basic_search.MSMBasicSearch.filter_sf_metrics')
-@patch('sm.engine.msm_basic.formula_img_validator.get_compute_img_metrics')
-def test_search_job_imzml_example_annotation_job_fails(get_compute_img_metrics_mock, filter_sf_metrics_mock,
+@patch('sm.engine.msm_basic.formula_img_validator.get_compute_batch_img_metrics')
+def test_search_job_imzml_example_annotation_job_fails(get_compute_batch_img_metrics_mock, filter_sf_metrics_mock,
                                                        post_images_to_annot_service_mock,
                                                        MolDBServiceWrapperMock, MolDBServiceWrapperMock2,
                                                        sm_config, create_fill_sm_database, es_dsl_search,
@@ -169,7 +173,7 @@ def test_search_job_imzml_example_annotation_job_fails(get_compute_img_metrics_m
 
     def throw_exception_function(*args):
         raise Exception('Test')
-    get_compute_img_metrics_mock.return_value = throw_exception_function
+    get_compute_batch_img_metrics_mock.return_value = throw_exception_function
     filter_sf_metrics_mock.side_effect = lambda x: x
 
     url_dict = {
@@ -225,10 +229,10 @@ def test_search_job_imzml_example_annotation_job_fails(get_compute_img_metrics_m
 
 @patch('sm.engine.search_job.MolDBServiceWrapper')
 @patch('sm.engine.mol_db.MolDBServiceWrapper')
-@patch('sm.engine.search_results.SearchResults.post_images_to_image_store')
+@patch('sm.engine.search_job.post_images_to_image_store')
 @patch('sm.engine.msm_basic.msm_basic_search.MSMBasicSearch.filter_sf_metrics')
-@patch('sm.engine.msm_basic.formula_img_validator.get_compute_img_metrics')
-def test_search_job_imzml_example_es_export_fails(get_compute_img_metrics_mock, filter_sf_metrics_mock,
+@patch('sm.engine.msm_basic.formula_img_validator.get_compute_batch_img_metrics')
+def test_search_job_imzml_example_es_export_fails(get_compute_batch_img_metrics_mock, filter_sf_metrics_mock,
                                                   post_images_to_annot_service_mock,
                                                   MolDBServiceWrapperMock, MolDBServiceWrapperMock2,
                                                   sm_config, create_fill_sm_database, es_dsl_search,
@@ -236,7 +240,7 @@ def test_search_job_imzml_example_es_export_fails(get_compute_img_metrics_mock,
     init_mol_db_service_wrapper_mock(MolDBServiceWrapperMock)
     init_mol_db_service_wrapper_mock(MolDBServiceWrapperMock2)
 
-    get_compute_img_metrics_mock.return_value = lambda *args: (0.9, 0.9, 0.9, [100.], [0], [10.])
+    get_compute_batch_img_metrics_mock.return_value = batch_img_metrics_mock
     filter_sf_metrics_mock.side_effect = lambda x: x
 
     url_dict = {
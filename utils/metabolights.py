@@ -71,7 +71,9 @@ def sm_engine_config(meta_json, mass_accuracy_ppm=2):
             "ppm": float(mass_accuracy_ppm),
             "nlevels": 30,
             "q": 99,
-            "do_preprocessing": False
+            "do_preprocessing": False,
+            "principal_min_px": 1,
+            "principal_min_int": 0
         }
     }
 